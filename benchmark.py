@@ -0,0 +1,426 @@
+#!/usr/bin/python
+
+import argparse
+import collections
+import datetime
+import distutils.spawn
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import yaml
+
+import fault_injector as fi
+
+"""
+Measures how much of each fault is spent in the fault injector itself rather
+than in the outage. Fault functions are driven against a simulated deployment
+on a clock that turns every minute of downtime into microseconds, so what is
+left is orchestration overhead. Results are saved as JSON, pass a previous
+result with --compare to see what changed between versions
+"""
+
+repo_path = os.path.dirname(os.path.abspath(__file__))
+
+
+class Recorder:
+    """ Collects duration samples by phase from any number of threads.
+        Time spent in clock waits is tracked per thread so the overhead of a fault
+        can be told apart from its (compressed) downtime and recovery time
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = collections.defaultdict(list)
+        self.local = threading.local()
+
+    def add(self, phase, seconds):
+        with self.lock:
+            self.samples[phase].append(seconds)
+
+    def timed(self, phase, function):
+        """ Returns function wrapped so every call is recorded under phase
+        """
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.add(phase, time.time() - start)
+        return wrapper
+
+    def waited(self, function):
+        """ Returns function wrapped so the time of every call counts as waiting for the calling thread
+        """
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.local.waited = getattr(self.local, 'waited', 0.0) + time.time() - start
+        return wrapper
+
+    def fault(self, function):
+        """ Returns a fault function wrapped so its total time and overhead (total minus waits) are recorded
+        """
+        def wrapper(*args, **kwargs):
+            self.local.waited = 0.0
+            start = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed = time.time() - start
+                self.add('fault', elapsed)
+                self.add('wait', self.local.waited)
+                self.add('overhead', elapsed - self.local.waited)
+        return wrapper
+
+    def report(self):
+        """ Returns {phase: {count, p50, p99, max}} in milliseconds
+        """
+        with self.lock:
+            return dict((phase, summarize(samples)) for phase, samples in self.samples.items())
+
+
+def percentile(ordered, fraction):
+    # nearest rank
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(round(fraction * len(ordered) + 0.5)) - 1)]
+
+
+def summarize(samples):
+    ordered = sorted(samples)
+    return {'count': len(ordered),
+            'p50': round(percentile(ordered, 0.50) * 1000, 4),
+            'p99': round(percentile(ordered, 0.99) * 1000, 4),
+            'max': round(ordered[-1] * 1000, 4)}
+
+
+def write_config(filename, threads):
+    """ Writes a config.yaml large enough that threads faults of each type never wait on each other
+    """
+    nodes = {}
+    # enough monitors that half of them (the most that may be faulted) covers every thread
+    for i in range(2 * threads + 1):
+        nodes['controller-{}'.format(i)] = {'node_ip': '10.0.0.{}'.format(i + 1), 'node_name': 'controller-{}'.format(i),
+                                            'node_type': 'controller', 'num_osds': 0, 'osds': []}
+    for i in range(threads):
+        osds = [2 * i, 2 * i + 1]
+        nodes['cephstorage-{}'.format(i)] = {'node_ip': '10.0.1.{}'.format(i + 1),
+                                             'node_name': 'cephstorage-{}'.format(i), 'node_type': 'cephstorage',
+                                             'num_osds': len(osds), 'osds': osds}
+    for i in range(2 * threads):
+        nodes['novacompute-{}'.format(i)] = {'node_ip': '10.0.2.{}'.format(i + 1),
+                                             'node_name': 'novacompute-{}'.format(i), 'node_type': 'novacompute',
+                                             'num_osds': 0, 'osds': []}
+    config = {'deployment': {'hci': False, 'num_nodes': len(nodes), 'nodes': nodes},
+              'ceph': {'minimum_replication_size': 2 * threads + 1,
+                       'pools_and_replication_size': {'rbd': 2 * threads + 1}}}
+    with open(filename, 'w') as f:
+        yaml.safe_dump(config, f, default_flow_style=False)
+
+
+def setup_injector(threads, speedup, recorder):
+    """ Points the fault injector's globals at a fresh simulated deployment with every
+        backend call recorded, returns the deployment
+    """
+    write_config('config.yaml', threads)
+    deployment = fi.Deployment('config.yaml')
+
+    fi.clock = fi.Scaled_clock(time.time(), speedup)
+    fi.clock.sleep = recorder.waited(fi.clock.sleep)
+    fi.clock.wait = recorder.waited(fi.clock.wait)
+    fi.global_starttime = datetime.datetime.now()
+    fi.scheduler = fi.Scheduler()
+    fi.timelimit = sys.maxsize
+    fi.timeout = sys.maxsize
+    fi.fault_time = 1
+    fi.recovery_time = 1
+    fi.variability = None
+
+    cluster = fi.Simulated_cluster(deployment)
+    cluster.exec_command = recorder.timed('ceph-query', cluster.exec_command)
+    cluster.is_reachable = recorder.timed('reachability', cluster.is_reachable)
+    executor = fi.Simulated_executor(cluster)
+    for step in ('crash_node', 'restore_node', 'stop_service', 'start_service'):
+        method = 'do_' + step
+        setattr(executor, method, recorder.timed(step.replace('_', '-'), getattr(executor, method)))
+    fi.simulator = cluster
+    fi.ssh_pool = cluster
+    fi.prober = cluster
+    fi.executor = executor
+    if fi.ceph_watcher is not None:
+        fi.ceph_watcher.stop()
+    fi.ceph_watcher = fi.Ceph_watcher(deployment)
+    fi.ceph_watcher.start()
+    return deployment
+
+
+def run_threads(threads, function):
+    workers = [threading.Thread(target=function) for i in range(threads)]
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return time.time() - start
+
+
+def bench_fault(name, threads, faults, speedup):
+    """ Runs faults of one type on threads threads, each thread running them back to back
+    """
+    recorder = Recorder()
+    deployment = setup_injector(threads, speedup, recorder)
+    if name == 'node-kill-fault':
+        function = fi.Node_fault(deployment).node_kill_fault
+    elif name == 'ceph-osd-fault':
+        function = fi.Ceph(deployment).osd_service_fault
+    else:
+        function = fi.Ceph(deployment).mon_service_fault
+    function = recorder.fault(function)
+    completed = []
+
+    def worker():
+        for i in range(faults):
+            if function() is not None:
+                completed.append(1)
+
+    elapsed = run_threads(threads, worker)
+    return result(recorder, len(completed), threads * faults, elapsed)
+
+
+def bench_deterministic(threads, faults, speedup):
+    """ Replays a generated deterministic file through the scheduler, threads faults overlap at any time
+    """
+    recorder = Recorder()
+    deployment = setup_injector(threads, speedup, recorder)
+    node_fault = fi.Node_fault(deployment)
+    ceph = fi.Ceph(deployment)
+    fi.plugins = [ceph, node_fault]
+
+    # one row per fault, threads of them start in every three minute slot so about that many overlap
+    writer = fi.Deterministic_writer('replay.txt')
+    computes = deployment.by_role['compute']
+    controllers = deployment.controllers()
+    for i in range(threads * faults):
+        start = str(datetime.timedelta(minutes=3 * (i // threads), seconds=i % threads))
+        kind = i % 3
+        if kind == 0:
+            node = computes[i % len(computes)]
+            writer.write_row(node_fault.__repr__(), ['node-kill-fault', node.ip, start, start, '1', '1'])
+        elif kind == 1:
+            node = random.choice(deployment.osd_nodes())
+            writer.write_row(ceph.__repr__(), ['ceph-osd-fault', node.ip, start, '1', '1', str(node.osds[0])])
+        else:
+            node = controllers[i % len(controllers)]
+            writer.write_row(ceph.__repr__(), ['ceph-mon-fault', node.ip, start, '1', '1', '-'])
+    writer.close()
+
+    plan = fi.Replay_plan(fi.plugins)
+    plan.fire = recorder.fault(plan.fire)
+    recorder.timed('replay-compile', plan.compile)('replay.txt')
+
+    start = time.time()
+    plan.start()
+    fi.scheduler.wait_all()
+    elapsed = time.time() - start
+    fi.scheduler.shutdown()
+    # drift is in clock seconds, recorded in real ones like every other phase
+    for drift in plan.drifts:
+        recorder.add('start-drift', drift / speedup)
+    return result(recorder, len(recorder.samples['fault']), threads * faults, elapsed)
+
+
+def result(recorder, completed, attempted, elapsed):
+    return {'attempted': attempted,
+            'completed': completed,
+            'seconds': round(elapsed, 4),
+            'faults_per_minute': round(completed / elapsed * 60, 1) if elapsed > 0 else None,
+            'phases': recorder.report()}
+
+
+def bench_components(samples, ssh_host, ssh_user):
+    """ Times the pieces of tool overhead that exist outside the fault functions
+    """
+    recorder = Recorder()
+
+    # playbook templates: parsed once at startup, rendered (yaml dump) for every step
+    load = recorder.timed('playbook-load', fi.Playbooks)
+    playbooks = load(os.path.join(repo_path, 'playbooks/'))
+    for i in range(samples - 1):
+        load(os.path.join(repo_path, 'playbooks/'))
+    render = recorder.timed('playbook-render', playbooks.node_crash)
+    for i in range(samples):
+        render('10.0.0.{}'.format(i % 250 + 1))
+
+    # ansible-playbook startup, the cost every ansible executor step pays before its first task
+    if distutils.spawn.find_executable('ansible-playbook'):
+        version = recorder.timed('ansible-startup', subprocess.call)
+        with open(os.devnull, 'w') as devnull:
+            for i in range(min(samples, 10)):
+                version(['ansible-playbook', '--version'], stdout=devnull, stderr=devnull)
+
+    # reachability: a forked ping per check against one probe of the prober
+    prober = fi.Reachability_prober(['127.0.0.1'])
+    probe = recorder.timed('prober-probe', prober.probe)
+    for i in range(samples):
+        probe(['127.0.0.1'])
+    if distutils.spawn.find_executable('ping'):
+        ping = recorder.timed('ping-fork', subprocess.call)
+        with open(os.devnull, 'w') as devnull:
+            for i in range(min(samples, 20)):
+                ping('ping -c 1 -W 1 127.0.0.1', shell=True, stdout=devnull, stderr=devnull)
+
+    # deterministic file: one fsync per row against the group-commit writer
+    row = ['node-kill-fault', '10.0.0.1', '0:00:00', '0:01:00', '1', '1']
+    line = fi.Deterministic_writer.row.format('Node_fault', ' | ', row[0], ' | ', row[1], ' | ', row[2], ' | ',
+                                              row[3], ' | ', row[4], ' | ', row[5]) + '\n'
+    with open('fsync-rows.txt', 'w') as f:
+        for i in range(samples):
+            start = time.time()
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+            recorder.add('row-fsync', time.time() - start)
+    writer = fi.Deterministic_writer('writer-rows.txt')
+    write_row = recorder.timed('row-queue', writer.write_row)
+    for i in range(samples):
+        write_row('Node_fault', row)
+    recorder.timed('writer-close', writer.close)()
+
+    # ssh: a full paramiko handshake per command against a pooled connection
+    if ssh_host is not None:
+        pool = fi.SSH_pool(username=ssh_user)
+        exec_command = recorder.timed('ssh-pooled-exec', pool.exec_command)
+        for i in range(min(samples, 20)):
+            client = pool.get_client(ssh_host)
+            pool.evict(ssh_host, client)
+            start = time.time()
+            pool.exec_command(ssh_host, 'true')
+            recorder.add('ssh-connect-exec', time.time() - start)
+            exec_command(ssh_host, 'true')
+        pool.close()
+
+    return recorder.report()
+
+
+def compare(results, previous):
+    """ Prints p50 and throughput of this run next to a previous one
+    """
+    print '\nCompared to {} ({})'.format(previous.get('timestamp'), previous.get('revision'))
+    row = "{:34}{:>14}{:>14}{:>9}"
+    print row.format('', 'previous', 'current', 'change')
+
+    def line(name, old, new):
+        if old is None or new is None:
+            return
+        change = '{:+.0f}%'.format((new - old) * 100.0 / old) if old else '-'
+        print row.format(name, old, new, change)
+
+    for phase, stats in sorted(results['components'].items()):
+        line(phase + ' p50 (ms)', previous.get('components', {}).get(phase, {}).get('p50'), stats['p50'])
+    for name, runs in sorted(results['faults'].items()):
+        for threads, run in sorted(runs.items(), key=lambda item: int(item[0])):
+            old = previous.get('faults', {}).get(name, {}).get(threads)
+            if old is None:
+                continue
+            line('{} x{} faults/min'.format(name, threads), old['faults_per_minute'], run['faults_per_minute'])
+            line('{} x{} overhead p50 (ms)'.format(name, threads), old['phases'].get('overhead', {}).get('p50'),
+                 run['phases'].get('overhead', {}).get('p50'))
+
+
+def revision():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=repo_path,
+                                           stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fault Injector Benchmark')
+    parser.add_argument('-th', '--threads', help='thread counts to run every fault type with', type=int, nargs='+',
+                        default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument('-f', '--faults', help='faults run back to back by every thread', type=int, default=20)
+    parser.add_argument('-s', '--speedup', help='how much faster than real time downtime and recovery pass',
+                        type=float, default=1000000)
+    parser.add_argument('-n', '--samples', help='samples taken of every component', type=int, default=200)
+    parser.add_argument('--ssh-host', help='also time ssh handshakes and pooled commands against this host',
+                        dest='ssh_host')
+    parser.add_argument('--ssh-user', help='user for --ssh-host', dest='ssh_user', default='heat-admin')
+    parser.add_argument('-o', '--output', help='file to save the results to (default: benchmark-results/<time>.json)')
+    parser.add_argument('-c', '--compare', help='previous results file to compare against')
+    args = parser.parse_args()
+
+    timestamp = datetime.datetime.now()
+    output = args.output
+    if output is None:
+        output = os.path.join(repo_path, 'benchmark-results', str(timestamp).replace(' ', '_') + '.json')
+    output = os.path.abspath(output)
+
+    results = {'timestamp': str(timestamp), 'revision': revision(), 'python': sys.version.split()[0],
+               'settings': {'threads': args.threads, 'faults': args.faults, 'speedup': args.speedup,
+                            'samples': args.samples},
+               'components': {}, 'faults': {}}
+
+    # the deployment writes config.yaml, hosts and the run files into the working directory
+    work_dir = tempfile.mkdtemp(prefix='fault-injector-benchmark-')
+    os.chdir(work_dir)
+    fi.log = fi.Event_log(os.path.join(work_dir, 'FaultInjector.log'))
+    fi.log.start()
+    # the fault functions print every step, only the results go to the console
+    console = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        print >> console, 'Timing components...'
+        results['components'] = bench_components(args.samples, args.ssh_host, args.ssh_user)
+
+        row = "{:18}{:>8}{:>11}{:>14}{:>16}{:>16}"
+        print >> console, '\n' + row.format('fault', 'threads', 'completed', 'faults/min', 'overhead p50 ms',
+                                           'overhead p99 ms')
+        for name in ('node-kill-fault', 'ceph-osd-fault', 'ceph-mon-fault', 'deterministic'):
+            results['faults'][name] = {}
+            for threads in args.threads:
+                if name == 'deterministic':
+                    run = bench_deterministic(threads, args.faults, args.speedup)
+                else:
+                    run = bench_fault(name, threads, args.faults, args.speedup)
+                results['faults'][name][str(threads)] = run
+                overhead = run['phases'].get('overhead', {})
+                print >> console, row.format(name, threads, run['completed'], run['faults_per_minute'],
+                                             overhead.get('p50'), overhead.get('p99'))
+    finally:
+        sys.stdout.close()
+        sys.stdout = console
+        if fi.ceph_watcher is not None:
+            fi.ceph_watcher.stop()
+        fi.log.close()
+        os.chdir(repo_path)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print '\nComponents (ms)'
+    row = "{:20}{:>8}{:>12}{:>12}{:>12}"
+    print row.format('', 'count', 'p50', 'p99', 'max')
+    for phase, stats in sorted(results['components'].items()):
+        print row.format(phase, stats['count'], stats['p50'], stats['p99'], stats['max'])
+
+    if not os.path.exists(os.path.dirname(output)):
+        os.makedirs(os.path.dirname(output))
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print '\nResults saved to {}'.format(output)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,26 @@
 #!/usr/bin/python
 
 import argparse
+import atexit
+import collections
+import copy
+import ctypes
 import datetime
+import errno
+import gzip
+import hashlib
+import heapq
+import json
 import math
 import os
 import paramiko
+import Queue
 import random
 import re
+import select
+import shutil
 import signal
-import string
+import socket
 import subprocess
 import sys
 import threading
@@ -38,29 +50,93 @@ class Fault:
     def deterministic(self, args):
         raise NotImplementedError
 
+    def compile(self, args, prepare=True):
+        """ Turns a row of a deterministic file into the function that replays it.
+            Plugins check the row here and raise ValueError if it can not be replayed. With prepare
+            they also set up what they can ahead of its start, without it the row is only checked
+        """
+        return lambda: self.deterministic(args)
+
     def check_exit_signal(self):
         if stopper.is_set():
             sys.exit(0)
 
+    def sleep(self, seconds):
+        """ Sleeps seconds of clock time, the fault exits as soon as the exit signal is set
+        """
+        if stopper.sleep(seconds):
+            sys.exit(0)
+
+    def wait_downtime(self, minutes, source, host):
+        """ Waits out the downtime of a fault. The wait ends as soon as the exit signal is set,
+            so the fault restores its target right away rather than leaving it to the signal handler
+        """
+        if stopper.sleep(60 * minutes):
+            log.event(source, 'exit signal received, restoring right away', node=host, phase='downtime')
+
     def time_limit_reached(self):
-        # Check if fault and recovery time exceeds time left
-        if variability is not None:
-            time.sleep(5)
-            return ((timeout - time.time()) / 60) <= (fault_time + recovery_time + variability)
+        # Check if even the shortest fault no longer fits in the time left
+        return admission.closed()
 
+    def wait_until_ready(self, ready, recovery_time):
+        """ Waits for a restored target to recover, for at most recovery_time minutes.
+            ready(seconds) checks the target once and may block up to seconds for it to become ready.
+            Returns the minutes it took to recover, or None if the target did not recover in time
+        """
+        start = clock.time()
+        deadline = start + 60 * recovery_time
+        while not ready(min(60, max(0, deadline - clock.time()))):
+            if clock.time() >= deadline:
+                # one last check, a target that came up during the last wait has recovered in time
+                return (clock.time() - start) / 60 if ready(0) else None
+            # check for exit signal
+            self.check_exit_signal()
+        return (clock.time() - start) / 60
+
+    @staticmethod
+    def recovery_field(recovered, recovery_time):
+        """ The recovery column of a row. A target that did not recover is written as '>' followed by
+            the minutes it was given, so it is never mistaken for a measured time
+        """
+        if recovered is None:
+            return '>{:.2f}'.format(recovery_time)
+        return '{:.2f}'.format(recovered)
+
+    # a replayed fault waits this many times the recovery measured in the recorded run
+    replay_margin = 2
+
+    @classmethod
+    def recovery_limit(cls, field):
+        """ The minutes a replayed fault waits for its target, read from the recovery column of a row.
+            A measured recovery is given replay_margin times as long, a target that did not recover in
+            the recorded run is given as long as it was given then. Never less than -rt if it is set,
+            or a minute (the shortest -rt) otherwise
+        """
+        if field.startswith('>'):
+            limit = float(field[1:])
         else:
-            time.sleep(5)
-            return ((timeout - time.time()) / 60) <= (fault_time + recovery_time)
+            limit = float(field) * cls.replay_margin
+        return max(limit, recovery_time or 1)
+
+    def log_recovery(self, source, target, host, recovered, recovery_time):
+        if recovered is None:
+            print '[{}] {} did not recover within {} minutes'.format(source, target, recovery_time)
+            log.event(source, '{} did not recover within {} minutes'.format(target, recovery_time),
+                      node=host, phase='recovered')
+        else:
+            print '[{}] {} recovered in {:.2f} minutes'.format(source, target, recovered)
+            log.event(source, '{} recovered in {:.2f} minutes'.format(target, recovered), node=host,
+                      phase='recovered')
 
     # Write fault functions below --------------------------------------------- 
 
     def template_fault(self):
         print 'template_fault was called'
 
-        start_time = datetime.datetime.now() - global_starttime
-        # Call to playbook goes here
+        start_time = clock.now() - global_starttime
+        # Call to executor goes here
         # Delay x amount of time
-        end_time = datetime.datetime.now() - global_starttime
+        end_time = clock.now() - global_starttime
         # Placeholder fault function
         return [start_time, end_time, 'Exit Status']  # Placeholder exit status variable
 
@@ -70,10 +146,18 @@ class Node_fault(Fault):
         Fault.__init__(self, deployment)
         # create a list of fault functions
         self.functions = [self.node_kill_fault]
+        # groups of nodes correlated faults take down together
+        self.groups = []
 
     def __repr__(self):
         return 'Node_fault'
 
+    def correlate(self, groups):
+        """ Makes stateless faults take down all nodes of one of groups at once instead of a single node
+        """
+        self.groups = groups
+        self.functions = [self.correlated_fault]
+
     def stateless(self, deterministic_file):
         # Infinite loop for indefinite mode
         while timeout == sys.maxsize:
@@ -81,59 +165,77 @@ class Node_fault(Fault):
             result = fault_function()
             if result is None:
                 continue
-            log.write('{:%Y-%m-%d %H:%M:%S} [stateless-mode] executing a node fault\n'.format(datetime.datetime.now()))
-            row = "{:6}{:2}{:18}{:2}{:18}{:2}{:18}{:2}{:18}{:2}{:4}{:2}{:12}"  # build formatter string
-            deterministic_file.write(
-                row.format(self.__repr__(), ' | ', result[0], ' | ', result[1], ' | ', result[2], ' | ',
-                           result[3], ' | ', result[4], ' | ', result[5]) + '\n')
-            deterministic_file.flush()
-            os.fsync(deterministic_file.fileno())
+            log.event('stateless-mode', 'executing a node fault', node=result[1])
+            deterministic_file.write_row(self.__repr__(), result)
             # check for exit signal
             self.check_exit_signal()
 
-        # Standard runtime loop
-        while time.time() < timeout:
+        # Standard runtime loop, runs until no fault fits in the time left
+        while not admission.closed():
             fault_function = random.choice(self.functions)
             result = fault_function()
             if result is None:
                 continue
-            log.write('{:%Y-%m-%d %H:%M:%S} [stateless-mode] executing a node fault\n'.format(datetime.datetime.now()))
-
-            row = "{:6}{:2}{:18}{:2}{:18}{:2}{:18}{:2}{:18}{:2}{:4}{:2}{:12}"  # build formatter string
-            deterministic_file.write(
-                row.format(self.__repr__(), ' | ', result[0], ' | ', result[1], ' | ', result[2], ' | ',
-                           result[3], ' | ', result[4], ' | ', result[5]) + '\n')
-            deterministic_file.flush()
-            os.fsync(deterministic_file.fileno())
+            log.event('stateless-mode', 'executing a node fault', node=result[1])
+            deterministic_file.write_row(self.__repr__(), result)
             # check for exit signal
             self.check_exit_signal()
 
-        log.write('{:%Y-%m-%d %H:%M:%S} [stateless-mode] thread time out reached\n'.format(datetime.datetime.now()))
+        admission.retire()
+        log.event('stateless-mode', 'thread time out reached')
 
-    def deterministic(self, args):
-        # convert end time to seconds
-        l = args[3].split(':')
-        secs = int(l[0]) * 3600 + int(l[1]) * 60 + int(float(l[2]))
+    @staticmethod
+    def node_ready(node, interruptible=True):
+        """ Returns a readiness check for wait_until_ready: the node answers over ssh and
+            the services setup.py recorded on it are active again
+        """
+        sleep = stopper.sleep if interruptible else clock.sleep
+        command = 'systemctl is-active ' + ' '.join(node.services) if node.services else 'true'
 
-        # find target node (if it exists)
-        target = None
-        for node in self.deployment.nodes:
-            if node[0].ip.strip() == args[2].strip():
-                target = node
-                break
+        def ready(seconds):
+            try:
+                states = ssh_pool.exec_command(node.ip, command, timeout=30).split()
+                if all(state == 'active' for state in states):
+                    return True
+            except Exception:
+                pass
+            sleep(min(10, seconds))
+            return False
+        return ready
 
-        # wait until start time
-        while time.time() < int(global_starttime.strftime('%s')) + secs:
-            self.check_exit_signal()
-            time.sleep(1)
+    def deterministic(self, args):
+        """ Started by the scheduler once the entry's start time is reached
+        """
+        try:
+            fault = self.compile(args)
+        except ValueError as e:
+            print '[deterministic-mode] {}, skipping {}'.format(e, args[1])
+            log.event('deterministic-mode', '{}, skipping {}'.format(e, args[1]), node=args[2])
+            return
+        log.event('deterministic-mode', 'executing {}'.format(args[1]), node=args[2])
+        fault()
+
+    def compile(self, args, prepare=True):
+        """ Resolves the targets of a row and, with prepare, prepares their crash steps
+        """
+        downtime = int(args[5])
+        recovery = self.recovery_limit(args[6])
+        # a correlated fault lists the ips of all of its targets
+        ips = args[2].split(',')
+        targets = [self.deployment.by_ip.get(ip) for ip in ips]
+        if None in targets:
+            raise ValueError('no node found at {}'.format(ips[targets.index(None)]))
+        if not (args[1] == 'node-kill-fault' and len(targets) == 1 or args[1] == 'correlated-fault'):
+            raise ValueError('no matching function found for {}'.format(args[1]))
+        if not prepare:
+            return None
 
-        # call fault
         if args[1] == 'node-kill-fault':
-            log.write('{:%Y-%m-%d %H:%M:%S} [deterministic-mode] executing node-kill-fault at {0}{1}\n'
-                      .format(str(target[0].ip), datetime.datetime.now()))
-            self.det_node_kill_fault(target, int(args[5]), int(args[6]))
-        else:
-            print '[det-service-fault] No matching function found'
+            crash = executor.prepare_crash_node(targets[0].ip, targets[0].id, quiet=False)
+            return lambda: self.det_node_kill_fault(targets[0], downtime, recovery, crash)
+        if args[1] == 'correlated-fault':
+            crashes = [executor.prepare_crash_node(node.ip, node.id, quiet=False) for node in targets]
+            return lambda: self.det_correlated_fault(targets, downtime, recovery, crashes)
 
     # Fault functions below ---------------------------------------------
 
@@ -148,180 +250,248 @@ class Node_fault(Fault):
         if self.time_limit_reached():
             return
 
-        # Choose node to fault
-        target_node = random.choice(self.deployment.nodes)
-        while target_node[0].occupied:
-            target_node = random.choice(self.deployment.nodes)
-            time.sleep(1)
-
-        target_node[0].occupied = True
-
-        # Check for exit signal
-        self.check_exit_signal()
+        # Choose a random free node to fault, reserving it so no other thread can pick it.
+        # Waits for a fault to finish if every node is taken
+        target_node = self.deployment.budget.acquire_free_node()
+        if target_node is None:
+            return
 
-        # Create temporary file for playbook
-        crash_filename = 'tmp_' + ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(5))
-        restore_filename = 'tmp_' + ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(5))
-
-        # Modify crash playbook
-        with open('playbooks/system-crash.yml') as f:
-            crash_config = yaml.load(f)
-            crash_config[0]['hosts'] = target_node[0].ip
-            for task in crash_config[0]['tasks']:
-                if task['name'] == 'Power off server':
-                    task['local_action'] = 'shell . ~/stackrc && nova stop ' + target_node[0].id
-
-        with open('playbooks/' + crash_filename, 'w') as f:
-            yaml.dump(crash_config, f, default_flow_style=False)
-
-        # Modify restore playbook
-        with open('playbooks/system-restore.yml') as f:
-            restore_config = yaml.load(f)
-            restore_config[0]['hosts'] = target_node[0].ip
-            for task in restore_config[0]['tasks']:
-                if task['name'] == 'Power on server':
-                    task['local_action'] = 'shell . ~/stackrc && nova start ' + target_node[0].id
-                if task['name'] == 'waiting 30 secs for server to come back':
-                    task['local_action'] = 'wait_for host=' + target_node[
-                        0].ip + ' port=22 state=started delay=30 timeout=120'
-
-        with open('playbooks/' + restore_filename, 'w') as f:
-            yaml.dump(restore_config, f, default_flow_style=False)
+        # Downtime that fits in the time left, the wait for a free node may have used some of it
+        downtime = admission.admit()
+        if downtime is None:
+            self.deployment.budget.release_node(target_node)
+            return
+        log.begin_fault()
 
         # Check for exit signal
         self.check_exit_signal()
 
         # Crash system
-        start_time = datetime.datetime.now() - global_starttime
-        subprocess.call('ansible-playbook playbooks/' + crash_filename, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                        shell=True)
-        print '[node-kill-fault] {} killed at {}'.format(target_node[0].name, target_node[0].ip)
-        log.write('{:%Y-%m-%d %H:%M:%S} [node-kill-fault] {} killed at {}\n'
-                  .format(datetime.datetime.now(), target_node[0].name, target_node[0].ip))
-
-        # Wait to recover
-        if variability is not None:
-            downtime = random.randint(fault_time, fault_time + variability)
-        else:
-            downtime = fault_time
+        start_time = clock.now() - global_starttime
+        executor.crash_node(target_node.ip, target_node.id)
+        print '[node-kill-fault] {} killed at {}'.format(target_node.name, target_node.ip)
+        log.event('node-kill-fault', '{} killed'.format(target_node.name), node=target_node.ip, phase='crash')
 
         print '[node-kill-fault] waiting {} minutes before restoring'.format(str(downtime))
-        log.write('{:%Y-%m-%d %H:%M:%S} [node-kill-fault] waiting {} minutes before restoring\n'
-                  .format(datetime.datetime.now(), str(downtime)))
+        log.event('node-kill-fault', 'waiting {} minutes before restoring'.format(downtime),
+                  node=target_node.ip, phase='downtime')
 
-        counter = downtime
-        while counter > 0:
-            # Check for exit signal
-            self.check_exit_signal()
-            time.sleep(60)
-            counter -= 1
+        self.wait_downtime(downtime, 'node-kill-fault', target_node.ip)
 
         # Restore system
-        subprocess.call('ansible-playbook playbooks/' + restore_filename, stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE, shell=True)
-        print '[node-kill-fault] restoring {}'.format(target_node[0].name)
-        log.write('{:%Y-%m-%d %H:%M:%S} [node-kill-fault] restoring {}\n'
-                  .format(datetime.datetime.now(), target_node[0].name))
+        executor.restore_node(target_node.ip, target_node.id)
+        print '[node-kill-fault] restoring {}'.format(target_node.name)
+        log.event('node-kill-fault', 'restoring {}'.format(target_node.name), node=target_node.ip, phase='restore')
 
-        # Give the node time to recover
-        print '[node-kill-fault] giving node {} minutes to recover'.format(recovery_time)
-        log.write('{:%Y-%m-%d %H:%M:%S} [ceph-kill-fault] giving node {} minutes to recover\n'
-                  .format(datetime.datetime.now(), recovery_time))
-        time.sleep(60 * recovery_time)
+        # Wait for the node to recover
+        print '[node-kill-fault] waiting up to {} minutes for {} to recover'.format(recovery_time, target_node.name)
+        log.event('node-kill-fault', 'waiting up to {} minutes for node to recover'.format(recovery_time),
+                  node=target_node.ip, phase='recovery')
+        recovered = self.wait_until_ready(self.node_ready(target_node), recovery_time)
+        self.log_recovery('node-kill-fault', target_node.name, target_node.ip, recovered, recovery_time)
 
-        end_time = datetime.datetime.now() - global_starttime
+        end_time = clock.now() - global_starttime
 
-        target_node[0].occupied = False
+        self.deployment.budget.release_node(target_node)
         self.print_status()
 
-        # Clean up temporary files
-        os.remove(os.path.join('playbooks/', crash_filename))
-        os.remove(os.path.join('playbooks/', restore_filename))
+        return ['node-kill-fault', target_node.ip, str(start_time), str(end_time), str(downtime),
+                self.recovery_field(recovered, recovery_time)]
 
-        return ['node-kill-fault', target_node[0].ip, str(start_time), str(end_time), str(downtime), str(recovery_time)]
-
-    def det_node_kill_fault(self, target_node, downtime, recovery_time):
+    def det_node_kill_fault(self, target_node, downtime, recovery_time, crash=None):
         """ Deterministic version of node_kill_fault() which is called by the
             deterministic function. Uses the information in the file to execute a fault
-            on a given node. Does not return anything.
+            on a given node. crash is the crash step prepared by compile(). Does not return anything.
 
         """
-        target_node[0].occupied = True
+        log.begin_fault()
+
+        # Reserve the node so no other fault takes it, it is released on every way out of the fault
+        if not self.deployment.budget.acquire_within(lambda: self.deployment.budget.acquire_node(target_node)):
+            print '[det_node_kill_fault] error: {} is already being faulted, exiting fault function' \
+                .format(target_node.name)
+            log.event('det_node_kill_fault', 'error: target node is already being faulted, exiting fault function',
+                      node=target_node.ip)
+            return None
+        try:
+            host = target_node.ip
+            reachable = prober.is_reachable(host)
 
-        host = target_node[0].ip
-        response = subprocess.call(['ping', '-c', '5', '-W', '3', host],
-                                   stdout=open(os.devnull, 'w'),
-                                   stderr=open(os.devnull, 'w'))
+            # Make sure target node is reachable
+            if not reachable:
+                print '[det_node_kill_fault] error: target node unreachable at {}, exiting fault function' \
+                    .format(str(target_node.ip))
+                log.event('det_node_kill_fault', 'error: target node unreachable, exiting fault function',
+                          node=target_node.ip)
+                return None
 
-        # Make sure target node is reachable
-        if response != 0:
-            print '[det_node_kill_fault] error: target node unreachable at {}, exiting fault function' \
-                .format(str(target_node[0].ip))
-            log.write('{:%Y-%m-%d %H:%M:%S} [det_node_kill_fault] error: target node unreachable at {}, '
-                      'exiting fault function'.format(datetime.datetime.now(), str(target_node[0].ip)))
-            return None
+            # check for exit signal
+            self.check_exit_signal()
 
-        # check for exit signal
-        self.check_exit_signal()
+            # crash system
+            if crash is None:
+                executor.crash_node(target_node.ip, target_node.id, quiet=False)
+            else:
+                crash()
+            log.event('node-kill-fault', 'Node killed', node=target_node.ip, phase='crash')
+
+            # wait
+            log.event('node-kill-fault', 'waiting {} minutes before restoring'.format(downtime),
+                      node=target_node.ip, phase='downtime')
+            self.wait_downtime(downtime, 'node-kill-fault', target_node.ip)
+
+            # restore system
+            executor.restore_node(target_node.ip, target_node.id, quiet=False)
+            log.event('node-kill-fault', 'Node restored', node=target_node.ip, phase='restore')
+
+            # Wait for the node to recover, the recovery time of the original run is the limit
+            log.event('node-kill-fault', 'waiting up to {} minutes for node to recover'.format(recovery_time),
+                      node=target_node.ip, phase='recovery')
+            recovered = self.wait_until_ready(self.node_ready(target_node), recovery_time)
+            self.log_recovery('node-kill-fault', target_node.name, target_node.ip, recovered, recovery_time)
+        finally:
+            self.deployment.budget.release_node(target_node)
+
+    def correlated_fault(self):
+        """ Called by the stateless function, picks one of the groups set by correlate() and
+            crashes all of its nodes at the same moment, like the loss of a rack or zone.
+
+            Returns a list used to construct the deterministic file, with the ips of all targets
+        """
+
+        # Exit if time limit is reached
+        if self.time_limit_reached():
+            return
 
-        # create tmp file for playbook
-        crash_filename = 'tmp_' + ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(5))
-        restore_filename = 'tmp_' + ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(5))
-
-        # modify crash playbook
-        with open('playbooks/system-crash.yml') as f:
-            crash_config = yaml.load(f)
-            crash_config[0]['hosts'] = target_node[0].ip
-            for task in crash_config[0]['tasks']:
-                if task['name'] == 'Power off server':
-                    task['local_action'] = 'shell . ~/stackrc && nova stop ' + target_node[0].id
-
-        with open('playbooks/' + crash_filename, 'w') as f:
-            yaml.dump(crash_config, f, default_flow_style=False)
-
-        # modify restore playbook
-        with open('playbooks/system-restore.yml') as f:
-            restore_config = yaml.load(f)
-            restore_config[0]['hosts'] = target_node[0].ip
-            for task in restore_config[0]['tasks']:
-                if task['name'] == 'Power on server':
-                    task['local_action'] = 'shell . ~/stackrc && nova start ' + target_node[0].id
-                if task['name'] == 'waiting 30 secs for server to come back':
-                    task['local_action'] = 'wait_for host=' + target_node[
-                        0].ip + ' port=22 state=started delay=30 timeout=120'
-
-        with open('playbooks/' + restore_filename, 'w') as f:
-            yaml.dump(restore_config, f, default_flow_style=False)
+        # Reserve a random group whose nodes are all free, waits for faults to finish if there is none
+        targets = self.deployment.budget.acquire_free_group(self.groups)
+        if targets is None:
+            return
 
-        # check for exit signal
+        downtime = admission.admit()
+        if downtime is None:
+            self.deployment.budget.release_nodes(targets)
+            return
+        log.begin_fault()
+
+        # Check for exit signal
         self.check_exit_signal()
 
-        # crash system
-        subprocess.call('ansible-playbook playbooks/' + crash_filename, shell=True)
-        log.write('{:%Y-%m-%d %H:%M:%S} [node-kill-fault] Node killed\n'.format(datetime.datetime.now()))
+        ips = ','.join(node.ip for node in targets)
+        names = ', '.join(node.name for node in targets)
 
-        # wait
-        log.write('{:%Y-%m-%d %H:%M:%S} [node-kill-fault] waiting ' +
-                  str(downtime) + ' minutes before restoring \
-                      \n'.format(datetime.datetime.now()))
-        while downtime > 0:
-            # check for exit signal
-            self.check_exit_signal()
-            time.sleep(60)
-            downtime -= 1
+        # Crash every node at once
+        start_time = clock.now() - global_starttime
+        spread = self.crash_group(targets, quiet=True)
+        print '[correlated-fault] {} killed, crashes delivered within {:.1f}ms'.format(names, spread * 1000)
+        log.event('correlated-fault', '{} killed, crashes delivered within {:.1f}ms'.format(names, spread * 1000),
+                  node=ips, phase='crash')
+
+        print '[correlated-fault] waiting {} minutes before restoring'.format(str(downtime))
+        log.event('correlated-fault', 'waiting {} minutes before restoring'.format(downtime), node=ips,
+                  phase='downtime')
+
+        self.wait_downtime(downtime, 'correlated-fault', ips)
+
+        # Restore every node at once and wait for all of them to recover
+        print '[correlated-fault] restoring {}, waiting up to {} minutes for them to recover'.format(names,
+                                                                                                  recovery_time)
+        log.event('correlated-fault', 'restoring, waiting up to {} minutes for nodes to recover'
+                  .format(recovery_time), node=ips, phase='restore')
+        recovered = self.restore_group(targets, recovery_time, quiet=True)
+
+        end_time = clock.now() - global_starttime
 
-        # restore system
-        subprocess.call('ansible-playbook playbooks/' + restore_filename, shell=True)
-        log.write('{:%Y-%m-%d %H:%M:%S} [node-kill-fault] Node restored\n'.format(datetime.datetime.now()))
+        self.deployment.budget.release_nodes(targets)
+        self.print_status()
+
+        return ['correlated-fault', ips, str(start_time), str(end_time), str(downtime),
+                self.recovery_field(recovered, recovery_time)]
+
+    def det_correlated_fault(self, targets, downtime, recovery_time, crashes=None):
+        """ Deterministic version of correlated_fault() which is called by the
+            deterministic function. crashes are the crash steps prepared by compile(). Does not return anything.
+        """
+        log.begin_fault()
+
+        ips = ','.join(node.ip for node in targets)
+
+        # Reserve every node so no other fault takes them, they are released on every way out of the fault
+        if not self.deployment.budget.acquire_within(lambda: self.deployment.budget.acquire_nodes(targets)):
+            print '[det_correlated_fault] error: some of {} are already being faulted, exiting fault function' \
+                .format(ips)
+            log.event('det_correlated_fault', 'error: target nodes are already being faulted, exiting fault function',
+                      node=ips)
+            return None
+        try:
+            # Make sure every target node is reachable
+            unreachable = [node.ip for node in targets if not prober.is_reachable(node.ip)]
+            if unreachable:
+                print '[det_correlated_fault] error: target nodes unreachable at {}, exiting fault function' \
+                    .format(', '.join(unreachable))
+                log.event('det_correlated_fault', 'error: target nodes unreachable, exiting fault function', node=ips)
+                return None
 
-        # Give node time to recover
-        time.sleep(60 * recovery_time)
+            # check for exit signal
+            self.check_exit_signal()
 
-        target_node[0].occupied = False
+            # crash every node at once
+            spread = self.crash_group(targets, quiet=False, actions=crashes)
+            log.event('correlated-fault', 'Nodes killed, crashes delivered within {:.1f}ms'.format(spread * 1000),
+                      node=ips, phase='crash')
+
+            # wait
+            log.event('correlated-fault', 'waiting {} minutes before restoring'.format(downtime), node=ips,
+                      phase='downtime')
+            self.wait_downtime(downtime, 'correlated-fault', ips)
+
+            # restore every node at once, the recovery time of the original run is the limit
+            log.event('correlated-fault', 'restoring, waiting up to {} minutes for nodes to recover'
+                      .format(recovery_time), node=ips, phase='restore')
+            self.restore_group(targets, recovery_time, quiet=False)
+        finally:
+            self.deployment.budget.release_nodes(targets)
+
+    def crash_group(self, targets, quiet, actions=None):
+        """ Crashes every node of targets at the same moment. The crash steps are prepared first
+            unless actions already holds them, then one thread per node waits at a barrier and fires
+            its step as soon as all are ready.
+            Returns the seconds between the first and the last crash being delivered
+        """
+        if actions is None:
+            # a replay connected to every target before it started, here it is done now
+            for node in targets:
+                executor.connect(ssh_pool, node.ip)
+            actions = [executor.prepare_crash_node(node.ip, node.id, quiet) for node in targets]
+        barrier = Barrier(len(actions))
+
+        def fire(i):
+            barrier.wait()
+            return actions[i]()
+        delivered = in_parallel([lambda i=i: fire(i) for i in range(len(actions))], 'correlated-fault')
+
+        missed = [node.name for node, moment in zip(targets, delivered) if moment is None]
+        if missed:
+            print '[correlated-fault] the crash of {} was not delivered'.format(', '.join(missed))
+            log.event('correlated-fault', 'the crash of {} was not delivered'.format(', '.join(missed)),
+                      node=','.join(node.ip for node in targets), phase='crash')
+        delivered = [moment for moment in delivered if moment is not None]
+        return max(delivered) - min(delivered) if delivered else 0.0
+
+    def restore_group(self, targets, recovery_time, quiet):
+        """ Restores every node of targets at once and waits for all of them to recover.
+            Returns the minutes until the last one recovered, or None if any did not recover in time
+        """
+        def restore(node):
+            executor.restore_node(node.ip, node.id, quiet)
+            return self.wait_until_ready(self.node_ready(node), recovery_time)
+        recovered = in_parallel([lambda node=node: restore(node) for node in targets], 'correlated-fault')
 
-        # clean up tmp files
-        os.remove(os.path.join('playbooks/', crash_filename))
-        os.remove(os.path.join('playbooks/', restore_filename))
+        # a node thread exits on the exit signal, so does the fault
+        self.check_exit_signal()
+        for node, minutes in zip(targets, recovered):
+            self.log_recovery('correlated-fault', node.name, node.ip, minutes, recovery_time)
+        return None if None in recovered else max(recovered)
 
     def print_status(self):
         """ Function used to print out the current status of the deployment.
@@ -335,7 +505,7 @@ class Node_fault(Fault):
         print "|-Name------------Type---------Address---------Faulted-+"
         print "|                                                      |"
         for node in self.deployment.nodes:
-            line = [node[0].name, node[0].type, node[0].ip, str(node[0].occupied)]
+            line = [node.name, node.type, node.ip, str(node.occupied)]
             print '| ' + row.format(line[0], line[1], line[2], line[3]) + '  |'
         print '+------------------------------------------------------+\n'
 
@@ -359,64 +529,45 @@ class Ceph(Fault):
 
         thread_count = self.deployment.min_replication_size + int(math.ceil(self.deployment.num_mons / 2.0))
 
-        # create threads and append them to the global thread list and fault thread list
-        fault_threads = []
+        # schedule the fault threads 3 seconds apart, stateful_start waits for them to conclude
+        start = clock.time()
         for i in range(thread_count):
-            thread = threading.Thread(target=self.fault_thread, args=(deterministic_file,))
-            threads.append(thread)
-            fault_threads.append(thread)
-
-        # start all threads
-        for thread in fault_threads:
-            thread.start()
-            self.check_exit_signal()
-            time.sleep(3)  # Space out threads by 3 seconds
-
-        # checks every second if all threads have concluded before ending the function
-        not_done = True
-        while not_done:
-            not_done = False
-            for thread in fault_threads:
-                if thread.isAlive():
-                    not_done = True
-            # check for exit signal
-            self.check_exit_signal()
-            time.sleep(1)
+            scheduler.schedule(start + 3 * i, self.fault_thread, (deterministic_file,))
 
     def deterministic(self, args):
-        """ Gets executed on its own thread
+        """ Gets executed on its own thread, started by the scheduler once the entry's start time is reached
             Gets arguments from a line in the deterministic file
-            Handles the parsing of the arguments so they're usable in
-            the deterministic fault functions
         """
+        try:
+            fault = self.compile(args)
+        except ValueError as e:
+            print '[deterministic-mode] {}, skipping {}'.format(e, args[1])
+            log.event('deterministic-mode', '{}, skipping {}'.format(e, args[1]), node=args[2])
+            return
+        log.event('deterministic-mode', 'executing {}'.format(args[1]), node=args[2])
+        fault()
 
-        # convert end time to seconds
-        l = args[3].split(':')
-        secs = int(l[0]) * 3600 + int(l[1]) * 60 + int(float(l[2]))
+    def compile(self, args, prepare=True):
+        """ Handles the parsing of the arguments so they're usable in
+            the deterministic fault functions, there is nothing to prepare ahead of time
+        """
+        recovery = self.recovery_limit(args[4])
+        downtime = int(args[5])
 
         # find target node (if it exists)
-        target = None
-        for node in self.deployment.nodes:
-            if node[0].ip.strip() == args[2].strip():
-                target = node
-                break
-
-        # wait until start time
-        while time.time() < int(global_starttime.strftime('%s')) + secs:
-            self.check_exit_signal()
-            time.sleep(1)
+        target = self.deployment.by_ip.get(args[2])
+        if target is None:
+            raise ValueError('no node found at {}'.format(args[2]))
 
-        # call fault
         if args[1] == 'ceph-osd-fault':
-            log.write('{:%Y-%m-%d %H:%M:%S} [deterministic-mode] executing osd-service-fault at {} (osd-{})\n'
-                      .format(datetime.datetime.now(), str(target[0].ip), args[6]))
-            self.det_service_fault(target, 'osd', int(args[5]), int(args[4]), args[6])
-        elif args[1] == 'ceph-mon-fault':
-            log.write('{:%Y-%m-%d %H:%M:%S} [deterministic-mode] executing mon-service-fault at {}\n'
-                      .format(datetime.datetime.now(), str(target[0].ip)))
-            self.det_service_fault(target, 'mon', int(args[5]), int(args[4]), args[6])
-        else:
-            print 'no matching function found'
+            if int(args[6]) not in target.osds:
+                raise ValueError('osd-{} is not on {}'.format(args[6], target.name))
+            return lambda: self.det_service_fault(target, 'osd', downtime, recovery, args[6])
+        if args[1] == 'ceph-mon-fault':
+            if not target.mon:
+                raise ValueError('{} does not run a monitor'.format(target.name))
+            return lambda: self.det_service_fault(target, 'mon', downtime, recovery, args[6])
+        raise ValueError('no matching function found for {}'.format(args[1]))
 
     # check_health is no longer used, may remove in the future
     """
@@ -457,6 +608,18 @@ class Ceph(Fault):
         return False if re.search('HEALTH_OK', response, flags=0) == None else True
     """
 
+    @staticmethod
+    def osd_ready(osd):
+        """ Returns a readiness check for wait_until_ready: every placement group of the osd is active+clean
+        """
+        return lambda seconds: ceph_watcher.wait_for(Ceph_watcher.osd_clean(osd), seconds)
+
+    @staticmethod
+    def mon_ready(node):
+        """ Returns a readiness check for wait_until_ready: the node's monitor is back in the quorum
+        """
+        return lambda seconds: ceph_watcher.wait_for(Ceph_watcher.mon_in_quorum(node), seconds)
+
     # Fault functions below ---------------------------------------------
 
     def fault_thread(self, deterministic_file):
@@ -472,17 +635,12 @@ class Ceph(Fault):
 
             self.print_status()
 
-            row = "{:6}{:2}{:18}{:2}{:18}{:2}{:18}{:2}{:18}{:2}{:4}{:2}{:12}"  # build formatter string
-
-            deterministic_file.write(row.format(self.__repr__(), ' | ', result[0], ' | ', result[1], ' | ', result[2],
-                                                ' | ', result[3], ' | ', result[4], ' | ', result[5]) + '\n')
-            deterministic_file.flush()
-            os.fsync(deterministic_file.fileno())
+            deterministic_file.write_row(self.__repr__(), result)
             # check for exit signal
             self.check_exit_signal()
 
-        # Standard runtime loop
-        while time.time() < timeout:
+        # Standard runtime loop, runs until no fault fits in the time left
+        while not admission.closed():
             # Calls a fault function and stores the results
             fault_function = random.choice(self.functions)
             result = fault_function()
@@ -491,16 +649,12 @@ class Ceph(Fault):
 
             self.print_status()
 
-            row = "{:6}{:2}{:18}{:2}{:18}{:2}{:18}{:2}{:18}{:2}{:4}{:2}{:12}"  # build formatter string
-
-            deterministic_file.write(
-                row.format(self.__repr__(), ' | ', result[0], ' | ', result[1], ' | ', result[2], ' | ',
-                           result[3], ' | ', result[4], ' | ', result[5]) + '\n')
-            deterministic_file.flush()
-            os.fsync(deterministic_file.fileno())
+            deterministic_file.write_row(self.__repr__(), result)
             # check for exit signal
             self.check_exit_signal()
 
+        admission.retire()
+
     def osd_service_fault(self):
         """ Kills a random osd service specified on a random (active) Ceph node
             or osd-compute node
@@ -510,36 +664,21 @@ class Ceph(Fault):
             return
 
         # Look for either osd-compute or ceph nodes
-        candidate_nodes = []
-        for node in self.deployment.nodes:
-            if self.deployment.hci:
-                if 'osd' in node[0].type:
-                    candidate_nodes.append(node)
-            elif 'ceph' in node[0].type:
-                candidate_nodes.append(node)
+        candidate_nodes = self.deployment.osd_nodes()
 
         if len(candidate_nodes) == 0:
-            log.write('{:%Y-%m-%d %H:%M:%S} [ceph-osd-fault] no nodes available, exiting osd-fault\n'
-                      .format(datetime.datetime.now()))
+            log.event('ceph-osd-fault', 'no nodes available, exiting osd-fault')
             return
 
         # check for exit signal
         self.check_exit_signal()
 
         target_node = random.choice(candidate_nodes)
-        host = target_node[0].ip
-        response = subprocess.call(['ping', '-c', '5', '-W', '3', host],
-                                   stdout=open(os.devnull, 'w'),
-                                   stderr=open(os.devnull, 'w'))
-
-        # Count the number of downed osds
-        osds_occupied = 0
-        for osd in self.deployment.osds:
-            if not osd:  # If osd is off
-                osds_occupied += 1
+        host = target_node.ip
+        reachable = prober.is_reachable(host)
 
         # Pick a random osd
-        target_osd = random.choice(target_node[1])
+        target_osd = random.choice(target_node.osds)
 
         # keeps track of how many times the while loop has been executed so it can break after
         # a set amount
@@ -547,153 +686,89 @@ class Ceph(Fault):
         wrote_to_log = False
 
         # node unreachable, target osd is being used, or the number of osds down >= the limit
-        while response != 0 or (not self.deployment.osds[target_osd]) or (
-                    osds_occupied >= self.deployment.min_replication_size - 1):
+        # (the osd is reserved when the condition passes)
+        while not (reachable and self.deployment.budget.acquire_osd(target_osd, target_node)):
 
             # Exit if time limit is reached or loop has executed 5 times
             if self.time_limit_reached() or retries > 4:
                 return
 
-            if osds_occupied >= self.deployment.min_replication_size - 1:
+            if self.deployment.budget.osd_limit_reached():
                 if not wrote_to_log:
-                    log.write('{:%Y-%m-%d %H:%M:%S} [ceph-osd-fault] osd limit reached, waiting to fault another\n'
-                              .format(datetime.datetime.now()))
+                    log.event('ceph-osd-fault', 'osd limit reached, waiting to fault another')
                     wrote_to_log = True
             else:
                 print '[ceph-osd-fault] Target osd down (osd-{}) at IP: {}, trying to find acceptable node' \
-                    .format(str(target_osd), str(target_node[0].ip))
-                log.write('{:%Y-%m-%d %H:%M:%S} [ceph-osd-fault] Target osd down, trying to find an alternate osd...\n'
-                          .format(datetime.datetime.now()))
+                    .format(str(target_osd), str(target_node.ip))
+                log.event('ceph-osd-fault', 'Target osd down (osd-{}), trying to find an alternate osd...'
+                          .format(target_osd), node=host)
             retries += 1
             target_node = random.choice(candidate_nodes)
-            host = target_node[0].ip
-            time.sleep(5)
-            response = subprocess.call(['ping', '-c', '5', '-W', '3', host],
-                                       stdout=open(os.devnull, 'w'),
-                                       stderr=open(os.devnull, 'w'))
-
-            # Count the number of downed osds
-            osds_occupied = 0
-            for osd in self.deployment.osds:
-                if not osd:  # If osd is off
-                    osds_occupied += 1
+            host = target_node.ip
+            self.sleep(5)
+            reachable = prober.is_reachable(host)
 
             # Pick a random osd
-            target_osd = random.choice(target_node[1])
+            target_osd = random.choice(target_node.osds)
 
             # check for exit signal
             self.check_exit_signal()
 
-        target_node[0].occupied = True  # Mark node as being used
-
-        # create tmp file for playbook
-        crash_filename = 'tmp_' + ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(5))
-        restore_filename = 'tmp_' + ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(5))
-
-        with open('playbooks/ceph-service-crash.yml') as f:
-            config = yaml.load(f)
-            config[0]['hosts'] = host
-            for task in config[0]['tasks']:
-                if task['name'] == 'Stopping ceph service':
-                    task['shell'] = 'systemctl stop ceph-osd@' + str(target_osd)
-        with open('playbooks/' + crash_filename, 'w') as f:
-            yaml.dump(config, f, default_flow_style=False)
-
-        with open('playbooks/ceph-service-restore.yml') as f:
-            config = yaml.load(f)
-            config[0]['hosts'] = host
-            for task in config[0]['tasks']:
-                if task['name'] == 'Restoring ceph service':
-                    task['shell'] = 'systemctl start ceph-osd@' + str(target_osd)
+        # Downtime that fits in the time left
+        downtime = admission.admit()
+        if downtime is None:
+            self.deployment.budget.release_osd(target_osd, target_node)
+            return
 
-        with open('playbooks/' + restore_filename, 'w') as f:
-            yaml.dump(config, f, default_flow_style=False)
+        log.begin_fault()
 
         # check for exit signal
         self.check_exit_signal()
 
         # execute fault
         print '[ceph-osd-fault] executing fault on osd-{}'.format(str(target_osd))
-        self.deployment.osds[target_osd] = False
-        start_time = datetime.datetime.now() - global_starttime
-        subprocess.call('ansible-playbook playbooks/' + crash_filename, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                        shell=True)
-
-        # Wait to recover
-        if variability is not None:
-            downtime = random.randint(fault_time, fault_time + variability)
-        else:
-            downtime = fault_time
+        log.event('ceph-osd-fault', 'executing fault on osd-{}'.format(target_osd), node=host, phase='crash')
+        start_time = clock.now() - global_starttime
+        executor.stop_service(host, 'ceph-osd@' + str(target_osd))
 
-        log.write('{:%Y-%m-%d %H:%M:%S} [ceph-osd-fault] waiting {} minutes before introducing OSD again\n'
-                  .format(datetime.datetime.now(), str(downtime)))
+        log.event('ceph-osd-fault', 'waiting {} minutes before introducing OSD again'.format(downtime),
+                  node=host, phase='downtime')
         print '[ceph-osd-fault] waiting {} minutes before restoring osd-{}'.format(str(downtime), str(target_osd))
-        counter = downtime
-        while counter > 0:
-            # check for exit signal
-            self.check_exit_signal()
-            time.sleep(60)
-            counter -= 1
+        self.wait_downtime(downtime, 'ceph-osd-fault', host)
 
         # restore service
-        subprocess.call('ansible-playbook playbooks/' + restore_filename, stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE, shell=True)
+        executor.start_service(host, 'ceph-osd@' + str(target_osd))
         print '[ceph-osd-fault] restoring osd-{}'.format(str(target_osd))
-        log.write('{:%Y-%m-%d %H:%M:%S} [ceph-osd-fault] restoring osd-{}\n'
-                  .format(datetime.datetime.now(), str(target_osd)))
+        log.event('ceph-osd-fault', 'restoring osd-{}'.format(target_osd), node=host, phase='restore')
 
-        # Give the osd time to recover
-        print '[ceph-osd-fault] giving osd-{} {} minutes to recover'.format(str(target_osd), recovery_time)
-        log.write('{:%Y-%m-%d %H:%M:%S} [ceph-osd-fault] giving osd {} minutes to recover\n'
-                  .format(datetime.datetime.now(), recovery_time))
-        time.sleep(60 * recovery_time)
+        # Wait for the osd to recover (all pg have returned to active+clean)
+        print '[ceph-osd-fault] waiting up to {} minutes for osd-{} to recover'.format(recovery_time, target_osd)
+        log.event('ceph-osd-fault', 'waiting up to {} minutes for osd-{} to recover'.format(recovery_time, target_osd),
+                  node=host, phase='recovery')
+        restored = clock.time()
+        recovered = self.wait_until_ready(self.osd_ready(target_osd), recovery_time)
 
-
-        #check if osd have recovered (all pg have returned to normal state)
-        command = "sudo ceph pg ls-by-osd " + str(target_osd) + " | awk 'NR>1 {print $10}' | grep -v 'active+clean'"
-        try:
-            ssh = paramiko.SSHClient()
-            ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            ssh.connect(host, username='heat-admin')
-            ssh_stdin, ssh_stdout, ssh_stderr = ssh.exec_command(command)
-            response = ssh_stdout.read()
-            ssh_stdout.channel.close()
-        except:
-            response=":("
-
-        if response != "":
+        # the osd is only released once it is clean, whatever the time limit
+        if recovered is None:
             print '[ceph-osd-fault] waiting for osd-{} to finish rebalancing'.format(str(target_osd))
-            log.write('{:%Y-%m-%d %H:%M:%S} [ceph-osd-fault] waiting for rebalance to finish on osd-{}\n'
-                      .format(datetime.datetime.now(), str(target_osd)))
+            log.event('ceph-osd-fault', 'waiting for rebalance to finish on osd-{}'.format(target_osd),
+                      node=host, phase='rebalance')
 
-        while response != "":
-            time.sleep(10)
-            try:
-                ssh = paramiko.SSHClient()
-                ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                ssh.connect(host, username='heat-admin')
-                ssh_stdin, ssh_stdout, ssh_stderr = ssh.exec_command(command)
-                response = ssh_stdout.read()
-                ssh_stdout.channel.close()
-            except:
-                response=":("
-            # check for exit signal
-            self.check_exit_signal()
+            while not ceph_watcher.wait_for(ceph_watcher.osd_clean(target_osd), 60):
+                # check for exit signal
+                self.check_exit_signal()
+            recovered = (clock.time() - restored) / 60
+        self.log_recovery('ceph-osd-fault', 'osd-{}'.format(target_osd), host, recovered, recovery_time)
 
         print '[ceph-osd-fault] osd-{} has been restored and rebalanced'.format(str(target_osd))
-        log.write('{:%Y-%m-%d %H:%M:%S} [ceph-osd-fault] osd-{} has been restored and rebalanced\n'
-                  .format(datetime.datetime.now(), str(target_osd)))
-
+        log.event('ceph-osd-fault', 'osd-{} has been restored and rebalanced'.format(target_osd),
+                  node=host, phase='done')
 
-        self.deployment.osds[target_osd] = True
-        end_time = datetime.datetime.now() - global_starttime
-        target_node[0].occupied = False  # Free up the node
 
-        # clean up tmp files
-        os.remove(os.path.join('playbooks/', crash_filename))
-        os.remove(os.path.join('playbooks/', restore_filename))
+        self.deployment.budget.release_osd(target_osd, target_node)
+        end_time = clock.now() - global_starttime
 
-        return ['ceph-osd-fault', target_node[0].ip, str(start_time), str(recovery_time), str(downtime),
+        return ['ceph-osd-fault', target_node.ip, str(start_time), '{:.2f}'.format(recovered), str(downtime),
                 str(target_osd)]
 
     def mon_service_fault(self):
@@ -704,148 +779,93 @@ class Ceph(Fault):
             return
 
         # Look for controller nodes
-        candidate_nodes = []
-        self.deployment.mons_available = 0
-        for node in self.deployment.nodes:
-            if 'control' in node[0].type:
-                candidate_nodes.append(node)
-                if node[2]:
-                    self.deployment.mons_available += 1
+        candidate_nodes = self.deployment.controllers()
 
         if len(candidate_nodes) == 0:
-            log.write('{:%Y-%m-%d %H:%M:%S} [ceph-mon-fault] no nodes available, exiting mon-fault\n'
-                      .format(datetime.datetime.now()))
+            log.event('ceph-mon-fault', 'no nodes available, exiting mon-fault')
             return
 
         target_node = random.choice(candidate_nodes)
-        host = target_node[0].ip
-        response = subprocess.call(['ping', '-c', '5', '-W', '3', host],
-                                   stdout=open(os.devnull, 'w'),
-                                   stderr=open(os.devnull, 'w'))
+        host = target_node.ip
+        reachable = prober.is_reachable(host)
 
         retries = 0
         wrote_to_log = False
 
-        # node unreachable or too few monitors available
-        while not (response == 0 and (
-                    self.deployment.mons_available > (self.deployment.num_mons - self.deployment.max_mon_faults))):
+        # node unreachable, its monitor is already down or too few monitors available
+        # (the monitor is reserved when the condition passes)
+        while not (reachable and self.deployment.budget.acquire_mon(target_node)):
 
             # Exit if time limit is reached or loop has executed 5 times
             if self.time_limit_reached() or retries > 4:
                 return
 
             # If there are not enough monitors available, record appropriate message
-            elif self.deployment.mons_available <= (
-                        self.deployment.num_mons - self.deployment.max_mon_faults) and not wrote_to_log:
-                log.write(
-                    '{:%Y-%m-%d %H:%M:%S} [ceph-mon-fault] {} monitors available, {} monitors needed. Cannot fault '
-                    'another.\n'.format(datetime.datetime.now(), str(self.deployment.mons_available),
-                                        str(self.deployment.num_mons - self.deployment.max_mon_faults)))
+            elif self.deployment.budget.mon_limit_reached():
+                if not wrote_to_log:
+                    log.event('ceph-mon-fault', '{} monitors available, {} monitors needed. Cannot fault another.'
+                              .format(self.deployment.budget.mons_available(),
+                                      self.deployment.num_mons - self.deployment.max_mon_faults))
+                    wrote_to_log = True
 
             # If neither of the previous cases are true, the target node is down
             else:
                 print '[ceph-mon-fault] Target node down at {}, trying to find acceptable node'.format(str(host))
-                log.write('{:%Y-%m-%d %H:%M:%S} [ceph-mon-fault] Target node down, trying to find acceptable node\n'
-                          .format(datetime.datetime.now()))
+                log.event('ceph-mon-fault', 'Target node down, trying to find acceptable node', node=host)
 
             # Try again with another random node
             retries += 1
             target_node = random.choice(candidate_nodes)
-            host = target_node[0].ip
-            time.sleep(5)  # Wait 5 seconds to give nodes time to recover
+            host = target_node.ip
+            self.sleep(5)  # Wait 5 seconds to give nodes time to recover
 
-            response = subprocess.call(['ping', '-c', '5', '-W', '3', host],
-                                       stdout=open(os.devnull, 'w'),
-                                       stderr=open(os.devnull, 'w'))
-
-            self.deployment.mons_available = 0
-            for node in self.deployment.nodes:
-                if 'control' in node[0].type:
-                    candidate_nodes.append(node)
-                    if node[2]:
-                        self.deployment.mons_available += 1
-            if self.deployment.mons_available <= 1:
+            reachable = prober.is_reachable(host)
+
+            if self.deployment.budget.mons_available() <= 1:
                 return
 
             # check for exit signal
             self.check_exit_signal()
 
-        target_node[0].occupied = True
-
-        # create temporary file for playbook
-        crash_filename = 'tmp_' + ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(5))
-        restore_filename = 'tmp_' + ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(5))
-
-        with open('playbooks/ceph-service-crash.yml') as f:
-            config = yaml.load(f)
-            config[0]['hosts'] = host
-            for task in config[0]['tasks']:
-                if task['name'] == 'Stopping ceph service':
-                    task['shell'] = 'systemctl stop ceph-mon.target'
-        with open('playbooks/' + crash_filename, 'w') as f:
-            yaml.dump(config, f, default_flow_style=False)
-
-        with open('playbooks/ceph-service-restore.yml') as f:
-            config = yaml.load(f)
-            config[0]['hosts'] = host
-            for task in config[0]['tasks']:
-                if task['name'] == 'Restoring ceph service':
-                    task['shell'] = 'systemctl start ceph-mon.target'
+        # Downtime that fits in the time left
+        downtime = admission.admit()
+        if downtime is None:
+            self.deployment.budget.release_mon(target_node)
+            return
 
-        with open('playbooks/' + restore_filename, 'w') as f:
-            yaml.dump(config, f, default_flow_style=False)
+        log.begin_fault()
 
         # check for exit signal
         self.check_exit_signal()
 
         # execute fault
-        print '[ceph-mon-fault] faulting a monitor on {}'.format(target_node[0].name)
-        log.write('{:%Y-%m-%d %H:%M:%S} [ceph-mon-fault] faulting a monitor on {}\n'
-                  .format(datetime.datetime.now(), target_node[0].name))
-        self.deployment.mons_available -= 1
-        start_time = datetime.datetime.now() - global_starttime
-        target_node[2] = False
-        subprocess.call('ansible-playbook playbooks/' + crash_filename, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                        shell=True)
-
-        # Wait to recover
-        if variability is not None:
-            downtime = random.randint(fault_time, fault_time + variability)
-        else:
-            downtime = fault_time
+        print '[ceph-mon-fault] faulting a monitor on {}'.format(target_node.name)
+        log.event('ceph-mon-fault', 'faulting a monitor on {}'.format(target_node.name), node=host, phase='crash')
+        start_time = clock.now() - global_starttime
+        executor.stop_service(host, 'ceph-mon.target')
 
-        log.write('{:%Y-%m-%d %H:%M:%S} [ceph-mon-fault] waiting {} minutes before introducing monitor back\n'
-                  .format(datetime.datetime.now(), str(downtime)))
+        log.event('ceph-mon-fault', 'waiting {} minutes before introducing monitor back'.format(downtime),
+                  node=host, phase='downtime')
         print '[ceph-mon-fault] waiting {} minutes before restoring monitor'.format(str(downtime))
-        counter = downtime
-        while counter > 0:
-            # check for exit signal
-            self.check_exit_signal()
-            time.sleep(60)
-            counter -= 1
+        self.wait_downtime(downtime, 'ceph-mon-fault', host)
 
         # restore service
-        subprocess.call('ansible-playbook playbooks/' + restore_filename, stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE, shell=True)
+        executor.start_service(host, 'ceph-mon.target')
         print '[ceph-mon-fault] restoring monitor'
-        log.write('{:%Y-%m-%d %H:%M:%S} [ceph-mon-fault] restoring monitor\n'.format(datetime.datetime.now()))
-
-        # Give the monitor time to recover
-        print '[ceph-mon-fault] giving monitor {} minutes to recover'.format(recovery_time)
-        log.write('{:%Y-%m-%d %H:%M:%S} [ceph-mon-fault] giving monitor {} minutes to recover\n'
-                  .format(datetime.datetime.now(), recovery_time))
-        time.sleep(60 * recovery_time)
+        log.event('ceph-mon-fault', 'restoring monitor', node=host, phase='restore')
 
-        self.deployment.mons_available += 1
-        target_node[2] = True
-        end_time = datetime.datetime.now() - global_starttime
-        target_node[0].occupied = False  # Free up the node
+        # Wait for the monitor to rejoin the quorum
+        print '[ceph-mon-fault] waiting up to {} minutes for the monitor to rejoin the quorum'.format(recovery_time)
+        log.event('ceph-mon-fault', 'waiting up to {} minutes for the monitor to rejoin the quorum'
+                  .format(recovery_time), node=host, phase='recovery')
+        recovered = self.wait_until_ready(self.mon_ready(target_node), recovery_time)
+        self.log_recovery('ceph-mon-fault', 'monitor on {}'.format(target_node.name), host, recovered, recovery_time)
 
-        # clean up tmp files
-        os.remove(os.path.join('playbooks/', crash_filename))
-        os.remove(os.path.join('playbooks/', restore_filename))
+        self.deployment.budget.release_mon(target_node)
+        end_time = clock.now() - global_starttime
 
-        return ['ceph-mon-fault', target_node[0].ip, str(start_time), str(recovery_time), str(downtime), '-']
+        return ['ceph-mon-fault', target_node.ip, str(start_time),
+                self.recovery_field(recovered, recovery_time), str(downtime), '-']
 
     # Deterministic fault functions below ---------------------------------------------
 
@@ -855,115 +875,74 @@ class Ceph(Fault):
             'additional_info' used differently depending on the fault type
         """
 
+        log.begin_fault()
+
         # check for exit signal
         self.check_exit_signal()
 
-        host = target_node[0].ip
-        response = subprocess.call(['ping', '-c', '5', '-W', '3', host],
-                                   stdout=open(os.devnull, 'w'),
-                                   stderr=open(os.devnull, 'w'))
+        host = target_node.ip
+        reachable = prober.is_reachable(host)
 
         # check for exit signal
         self.check_exit_signal()
 
-        # Make sure target node is reachable 
-        if response != 0:
+        # Make sure target node is reachable
+        if not reachable:
             print '[det-service-fault] error: target node unreachable at {}, exiting fault function' \
-                .format(str(target_node[0].ip))
-            log.write('{:%Y-%m-%d %H:%M:%S} [det-service-fault] error: target node unreachable at {}, '
-                      'exiting fault function'.format(datetime.datetime.now(), str(target_node[0].ip)))
+                .format(str(target_node.ip))
+            log.event('det-service-fault', 'error: target node unreachable, exiting fault function',
+                      node=target_node.ip)
             return None
 
-        target_node[0].occupied = True  # Mark node as being used
-
-        # create tmp file for playbook
-        crash_filename = 'tmp_' + ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(5))
-        restore_filename = 'tmp_' + ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(5))
-
-        with open('playbooks/ceph-service-crash.yml') as f:
-            config = yaml.load(f)
-            config[0]['hosts'] = host
-            if fault_type == 'osd':
-                for task in config[0]['tasks']:
-                    if task['name'] == 'Stopping ceph service':
-                        task['shell'] = 'systemctl stop ceph-osd.' + additional_info
-            else:
-                for task in config[0]['tasks']:
-                    if task['name'] == 'Stopping ceph service':
-                        task['shell'] = 'systemctl stop ceph-mon.target'
-
-        with open('playbooks/' + crash_filename, 'w') as f:
-            yaml.dump(config, f, default_flow_style=False)
-
-        # check for exit signal
-        self.check_exit_signal()
-
-        with open('playbooks/ceph-service-restore.yml') as f:
-            config = yaml.load(f)
-            config[0]['hosts'] = host
-            if fault_type == 'osd':
-                for task in config[0]['tasks']:
-                    if task['name'] == 'Restoring ceph service':
-                        task['shell'] = 'systemctl start ceph-osd.' + additional_info
-            else:
-                for task in config[0]['tasks']:
-                    if task['name'] == 'Restoring ceph service':
-                        task['shell'] = 'systemctl start ceph-mon.target'
-        with open('playbooks/' + restore_filename, 'w') as f:
-            yaml.dump(config, f, default_flow_style=False)
-
-        # check for exit signal
-        self.check_exit_signal()
-
-        print '[det-service-fault] executing {} fault at {}'.format(fault_type, str(host))
-        subprocess.call('ansible-playbook playbooks/' + crash_filename, stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE, shell=True)
-        log.write('{:%Y-%m-%d %H:%M:%S} [det-service-fault] waiting {} minutes before restoring\n'
-                  .format(datetime.datetime.now(), str(downtime)))
-
-        while downtime > 0:
+        budget = self.deployment.budget
+        if fault_type == 'osd':
+            service = 'ceph-osd@' + additional_info
+            acquire = lambda: budget.acquire_osd(int(additional_info), target_node)
+            release = lambda: budget.release_osd(int(additional_info), target_node)
+        else:
+            service = 'ceph-mon.target'
+            acquire = lambda: budget.acquire_mon(target_node)
+            release = lambda: budget.release_mon(target_node)
+
+        # Reserve the service so the budget counts it, it is released on every way out of the fault
+        if not budget.acquire_within(acquire):
+            print '[det-service-fault] error: {} on {} is already down or over the budget, exiting fault function' \
+                .format(service, target_node.name)
+            log.event('det-service-fault', 'error: {} is already down or over the budget, exiting fault function'
+                      .format(service), node=host)
+            return None
+        try:
             # check for exit signal
             self.check_exit_signal()
-            time.sleep(60)
-            downtime -= 1
 
-        subprocess.call('ansible-playbook playbooks/' + restore_filename, stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE, shell=True)
+            print '[det-service-fault] executing {} fault at {}'.format(fault_type, str(host))
+            executor.stop_service(host, service)
+            log.event('det-service-fault', '{} stopped'.format(service), node=host, phase='crash')
+            log.event('det-service-fault', 'waiting {} minutes before restoring'.format(downtime),
+                      node=host, phase='downtime')
 
-        # Give the service time to recover
-        time.sleep(60 * recovery_time)
-
-        if fault_type == 'osd':
-            command = "sudo ceph pg ls-by-osd " + str(additional_info) + " | awk 'NR>1 {print $10}' | grep -v 'active+clean'"
-            try:
-                ssh = paramiko.SSHClient()
-                ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                ssh.connect(host, username='heat-admin')
-                ssh_stdin, ssh_stdout, ssh_stderr = ssh.exec_command(command)
-                response = ssh_stdout.read()
-                ssh_stdout.channel.close()
-            except:
-                response=":("
-
-            while response != "":
-                time.sleep(10)
-                try:
-                    ssh = paramiko.SSHClient()
-                    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                    ssh.connect(host, username='heat-admin')
-                    ssh_stdin, ssh_stdout, ssh_stderr = ssh.exec_command(command)
-                    response = ssh_stdout.read()
-                    ssh_stdout.channel.close()
-                except:
-                    response=":("
-                # check for exit signal
-                self.check_exit_signal()
+            self.wait_downtime(downtime, 'det-service-fault', host)
 
+            executor.start_service(host, service)
+            log.event('det-service-fault', '{} started'.format(service), node=host, phase='restore')
 
-        target_node[0].occupied = False  # Free up the node
-        # clean up tmp files
-        os.remove(os.path.join('playbooks/', crash_filename))
-        os.remove(os.path.join('playbooks/', restore_filename))
+            # Wait for the service to recover, the recovery time of the original run is the limit
+            log.event('det-service-fault', 'waiting up to {} minutes for {} to recover'.format(recovery_time, service),
+                      node=host, phase='recovery')
+            if fault_type == 'osd':
+                recovered = self.wait_until_ready(self.osd_ready(int(additional_info)), recovery_time)
+                if recovered is None:
+                    # the osd is only left alone once it is clean, whatever the time limit
+                    log.event('det-service-fault', 'waiting for rebalance to finish on {}'.format(service),
+                              node=host, phase='rebalance')
+                    while not ceph_watcher.wait_for(ceph_watcher.osd_clean(int(additional_info)), 60):
+                        # check for exit signal
+                        self.check_exit_signal()
+            else:
+                recovered = self.wait_until_ready(self.mon_ready(target_node), recovery_time)
+            self.log_recovery('det-service-fault', service, host, recovered, recovery_time)
+        finally:
+            release()
 
         print '[det-service-fault] deterministic step completed'
         return True
@@ -972,34 +951,56 @@ class Ceph(Fault):
         """ Function used to print out the current status of the deployment.
             Currently only called when a fault concludes successfully.
         """
-        osds_occupied = 0
-        for osd in self.deployment.osds:
-            if not osd:  # If osd is off
-                osds_occupied += 1
-
-        self.deployment.mons_available = 0
-        for node in self.deployment.nodes:
-            if 'control' in node[0].type:
-                if node[2]:
-                    self.deployment.mons_available += 1
+        budget = self.deployment.budget
 
         print '\n+----------------------\n' \
               '|Current Status:       \n' \
               '|----------------------\n' \
-              '|osds active: ' + str(self.deployment.num_osds - osds_occupied) + '/' + str(
+              '|osds active: ' + str(self.deployment.num_osds - budget.osds_down) + '/' + str(
             self.deployment.num_osds) + '      ' + \
-              '\n' + '|monitors active: ' + str(self.deployment.mons_available) + '/' + str(self.deployment.num_mons) + \
+              '\n' + '|monitors active: ' + str(budget.mons_available()) + '/' + str(self.deployment.num_mons) + \
               '  \n+----------------------\n'
 
 
-class Node:
-    def __init__(self, node_type, node_ip, node_id, node_name):
+class Node(object):
+    """ A node of the deployment. Uses __slots__ so deployments with hundreds of nodes stay small
+    """
+
+    __slots__ = ['type', 'ip', 'id', 'name', 'role', 'osds', 'services', 'domain', 'mon', 'mon_available',
+                 'occupied']
+
+    def __init__(self, node_type, node_ip, node_id, node_name, osds=(), services=(), domain=None):
         self.type = node_type
         self.ip = node_ip
         self.id = node_id
         self.name = node_name
+        self.role = Node.role_of(node_type)
+        # ids of the OSDs hosted on the node
+        self.osds = tuple(int(osd) for osd in osds)
+        # services that have to be active again before the node counts as recovered
+        self.services = tuple(services)
+        # failure domain (rack, zone, ...) the node shares with others, None if not set in config.yaml
+        self.domain = domain
+        # whether the node runs a ceph monitor and if that monitor is currently up
+        self.mon = self.role == 'controller'
+        self.mon_available = self.mon
         self.occupied = False
 
+    @staticmethod
+    def role_of(node_type):
+        """ Maps a node type to one of the roles the deployment is indexed by:
+            controller, osd-compute, ceph or compute
+        """
+        if 'control' in node_type:
+            return 'controller'
+        if 'osd' in node_type:
+            return 'osd-compute'
+        if 'ceph' in node_type:
+            return 'ceph'
+        if 'compute' in node_type:
+            return 'compute'
+        return node_type
+
 
 class Deployment:
     def __init__(self, filename):
@@ -1008,113 +1009,2545 @@ class Deployment:
         """
         self.nodes = []
 
-        hosts = open('hosts', 'w')
-
         with open(filename, 'r') as f:
             config = yaml.load(f)
 
-            if config is None:
-                sys.exit('Error: config.yaml is empty, please fill it out manually or try running setup.py')
-            if config['deployment']['num_nodes'] == 0:
-                sys.exit('Error: config.yaml is is missing node information, cannot continue')
+        if config is None:
+            sys.exit('Error: config.yaml is empty, please fill it out manually or try running setup.py')
+        if config['deployment']['num_nodes'] == 0:
+            sys.exit('Error: config.yaml is is missing node information, cannot continue')
 
-            # Check for a Ceph deployment
-            ceph_deployment = 'ceph' in config
+        # Check for a Ceph deployment
+        ceph_deployment = 'ceph' in config
+        self.ceph = ceph_deployment
 
-            # Initialize ceph-specific fields
-            if ceph_deployment:
-                self.num_osds = 0
-                self.num_mons = 0
-                self.mons_available = 0
+        self.hci = config['deployment']['hci']
+        self.num_nodes = config['deployment']['num_nodes']
 
-            # The 'nodes' list contains Node instances inside of lists with which you 
-            # can append any data required for your plugins 
-            for node_id in config['deployment']['nodes']:
-                # Fill hosts file with IPs
-                hosts.write((config['deployment']['nodes'][node_id]['node_ip']) + '\n')
+        # Initialize ceph-specific fields
+        if ceph_deployment:
+            self.num_osds = 0
+            self.num_mons = 0
 
-                self.nodes.append([Node(config['deployment']['nodes'][node_id]['node_type'],
-                                        config['deployment']['nodes'][node_id]['node_ip'], node_id,
-                                        config['deployment']['nodes'][node_id]['node_name'])])
+        with open('hosts', 'w') as hosts:
+            for node_id, fields in config['deployment']['nodes'].items():
+                # Fill hosts file with IPs
+                hosts.write(fields['node_ip'] + '\n')
 
-                self.hci = config['deployment']['hci']
-                self.num_nodes = config['deployment']['num_nodes']
+                node = Node(fields['node_type'], fields['node_ip'], node_id, fields['node_name'],
+                            fields.get('osds', ()) if ceph_deployment else (), fields.get('services') or (),
+                            fields.get('failure_domain'))
+                self.nodes.append(node)
                 if ceph_deployment:
-                    # Each node in the list of nodes is now a list which holds the following:
-                    # [Node Object, List of OSDs, Controller Available (bool)]
-                    self.nodes[-1].append(config['deployment']['nodes'][node_id]['osds'])
-                    self.nodes[-1].append(True) if 'control' in config['deployment']['nodes'][node_id]['node_type'] \
-                        else self.nodes[-1].append(False)
-                    self.num_osds += config['deployment']['nodes'][node_id]['num_osds']
-                    if 'control' in config['deployment']['nodes'][node_id]['node_type']:
+                    self.num_osds += fields['num_osds']
+                    if node.mon:
                         self.num_mons += 1
 
-            if ceph_deployment:
-                self.min_replication_size = config['ceph']['minimum_replication_size']
-                self.osds = [True for osd in range(self.num_osds)]  # Set all osds to 'on' aka True
-                self.max_mon_faults = int(math.ceil(self.num_mons / 2))
-
-
-# global var for start time of program
-global_starttime = datetime.datetime.now()
+        if ceph_deployment:
+            self.min_replication_size = config['ceph']['minimum_replication_size']
+            self.max_mon_faults = int(math.ceil(self.num_mons / 2))
 
-# global var for log file
-log = open('FaultInjector.log', 'a')
-
-# global list of all plugins
-plugins = []
+        # fingerprints of what setup.py discovered, used to tell whether the config is stale
+        self.fingerprints = config.get('fingerprints') or {}
 
-# global list of threads
-threads = []
+        self.index()
+        self.budget = Fault_budget(self)
 
-# global exit signal for threads
-stopper = threading.Event()
+    def index(self):
+        """ Builds the lookup tables over self.nodes, must be called whenever the list changes
+        """
+        self.by_ip = {}
+        self.by_name = {}
+        self.by_id = {}
+        self.by_role = {'controller': [], 'osd-compute': [], 'ceph': [], 'compute': []}
+        self.by_type = {}
+        self.by_domain = {}
+        for node in self.nodes:
+            self.by_ip[node.ip.strip()] = node
+            self.by_name[node.name] = node
+            self.by_id[node.id] = node
+            self.by_role.setdefault(node.role, []).append(node)
+            self.by_type.setdefault(node.type, []).append(node)
+            if node.domain is not None:
+                self.by_domain.setdefault(node.domain, []).append(node)
+        # the budget only hands out nodes that are still part of the deployment
+        if getattr(self, 'budget', None) is not None:
+            self.budget.track_nodes(self.nodes)
+
+    def osd_nodes(self):
+        """ Nodes that host OSDs: osd-compute nodes in HCI deployments, ceph nodes otherwise
+        """
+        return self.by_role['osd-compute'] if self.hci else self.by_role['ceph']
 
+    def controllers(self):
+        return self.by_role['controller']
 
-def main():
-    fault_injector_title = """
- _________________________________________________________________________
-|                                                                         |
-|      ______            ____     ____        _           __              |
-|     / ____/___ ___  __/ / /_   /  _/___    (_)__  _____/ /_____  _____  |
-|    / /_  / __ `/ / / / / __/   / // __ \  / / _ \/ ___/ __/ __ \/ ___/  |
-|   / __/ / /_/ / /_/ / / /_   _/ // / / / / /  __/ /__/ /_/ /_/ / /      |
-|  /_/    \__,_/\__,_/_/\__/  /___/_/ /_/_/ /\___/\___/\__/\____/_/       |
-|                                      /___/                              |
-|_________________________________________________________________________|  
+    def exclude(self, names):
+        """ Drops the nodes with the given names
+        """
+        excluded = set(id(self.by_name[name]) for name in names if name in self.by_name)
+        self.nodes = [node for node in self.nodes if id(node) not in excluded]
+        self.index()
 
+    def restrict(self, target):
+        """ Keeps only the nodes whose type contains target
+        """
+        kept = set()
+        for node_type in self.by_type:
+            if target in node_type:
+                kept.update(id(node) for node in self.by_type[node_type])
+        self.nodes = [node for node in self.nodes if id(node) in kept]
+        self.index()
+
+    def groups(self, selector):
+        """ Returns the groups of nodes a correlated fault takes down together, selected by
+            type:<text> (nodes whose type contains text), names:<name>,<name>,... (nodes by name),
+            domain:<domain> (the nodes of a failure domain) or domain (one group per failure domain).
+            Returns None if the selector is not understood
+        """
+        kind, _, value = selector.partition(':')
+        if kind == 'type':
+            return [[node for node in self.nodes if value in node.type]]
+        if kind == 'names':
+            return [[self.by_name[name] for name in value.split(',') if name in self.by_name]]
+        if kind == 'domain':
+            if value:
+                return [self.by_domain.get(value, [])]
+            return [self.by_domain[domain] for domain in sorted(self.by_domain)]
+        return None
+
+
+class Admission_controller:
+    """ Decides without waiting whether a fault still fits in the time left of the run.
+        A fault takes its downtime plus at most the recovery time. Near the end of a run the
+        downtime is cut to whatever still fits, down to shortest minutes, so threads keep
+        faulting until the time limit is used up. The time a thread had left when no fault
+        fitted anymore is counted as wasted
     """
-    print fault_injector_title
-    global timeout
-    global timelimit
-    global fault_time
-    global recovery_time
-    global variability
-    deployment = Deployment('config.yaml')
-    paramiko.util.log_to_file(".paramiko.log")
-
-    # create list of all plugins and one node_fault instance
-    plugins.append(Ceph(deployment))
-    plugins.append(Node_fault(deployment))
-    # plugins.append()
-    node_fault = Node_fault(deployment)
 
-    # signal handler to restore everything to normal
-    signal.signal(signal.SIGINT, signal_handler)
+    def __init__(self, shortest=1):
+        self.shortest = shortest  # minutes of downtime below which a fault is not started
+        self.lock = threading.Lock()
+        self.admitted = 0
+        self.shortened = 0
+        self.wasted = 0.0  # thread-minutes
 
-    # start injector
-    log.write('----------------------------------------\n')
-    log.write('{:%Y-%m-%d %H:%M:%S} Fault Injector Started\n'.format(datetime.datetime.now()))
+    def remaining(self):
+        """ Minutes left in the run, None without a time limit
+        """
+        if timeout == sys.maxsize:
+            return None
+        return (timeout - clock.time()) / 60
 
-    # create argument parser
-    parser = argparse.ArgumentParser(description='Fault Injector')
+    def fits(self):
+        """ Minutes of downtime that still fit, None without a time limit
+        """
+        remaining = self.remaining()
+        return None if remaining is None else int(math.floor(remaining - recovery_time))
 
-    parser.add_argument('-sf', '--stateful', help='injector will run in stateful \
-                            random mode', required=False, action='store_true')
+    def closed(self):
+        fits = self.fits()
+        return fits is not None and fits < self.shortest
 
-    parser.add_argument('-sl', '--stateless', help='injector will run in stateless \
-                            mode with specified number of faults', required=False,
-                        type=int, nargs=1, dest='numfaults')
+    def admit(self):
+        """ Returns the downtime in minutes of a fault starting now, or None if no fault fits anymore
+        """
+        if variability is not None:
+            downtime = random.randint(fault_time, fault_time + variability)
+        else:
+            downtime = fault_time
+        fits = self.fits()
+        with self.lock:
+            if fits is not None:
+                if fits < self.shortest:
+                    return None
+                if fits < downtime:
+                    downtime = fits
+                    self.shortened += 1
+            self.admitted += 1
+        return downtime
+
+    def retire(self):
+        """ Called by a thread that stops faulting, the time it had left is wasted
+        """
+        remaining = self.remaining()
+        if remaining is not None:
+            with self.lock:
+                self.wasted += max(0, remaining)
+
+    def summary(self):
+        return ['{} faults admitted, {} shortened to fit the time limit, {:.1f} thread-minutes left unused'
+                .format(self.admitted, self.shortened, self.wasted)]
+
+
+class Fault_budget:
+    """ Keeps live counts of the nodes, OSDs and monitors that are faulted.
+        Fault functions reserve a slot before injecting and release it after recovery,
+        checks and updates happen under a single lock so concurrent threads can never
+        fault more than the deployment can tolerate.
+        Nodes that are not being faulted are also kept in a list, stateless faults take a
+        random one in O(1) and block on the condition while every node is taken.
+        A node fault holds its node alone, osd and monitor faults share theirs and the node
+        stays occupied until the last of them is released
+    """
+
+    def __init__(self, deployment):
+        # reentrant, so acquire_within can call the acquire methods while it holds the condition
+        self.lock = threading.RLock()
+        self.condition = threading.Condition(self.lock)
+        # waits for a free node end when the exit signal is set
+        stopper.subscribe(self.condition)
+        # nodes that can be taken by acquire_free_node and their positions in the list
+        self.free = []
+        self.positions = {}
+        # nodes handed out by acquire_free_node, number of times a caller had to wait and the clock seconds waited
+        self.acquired = 0
+        self.waits = 0
+        self.waited = 0.0
+        self.track_nodes(deployment.nodes)
+        # id(node) -> number of osd and monitor faults holding the node
+        self.service_holds = {}
+        # number of callers waiting in acquire_within, every release wakes them all
+        self.acquiring = 0
+        # osd id -> True while the osd is up
+        self.osds_up = {}
+        for node in deployment.nodes:
+            for osd in node.osds:
+                self.osds_up[osd] = True
+        self.osds_down = 0
+        self.max_osds_down = getattr(deployment, 'min_replication_size', 1) - 1
+        self.num_mons = getattr(deployment, 'num_mons', 0)
+        self.mons_down = 0
+        self.max_mons_down = getattr(deployment, 'max_mon_faults', 0)
+
+    def track_nodes(self, nodes):
+        """ Makes the free nodes of nodes the ones acquire_free_node picks from
+        """
+        with self.lock:
+            self.free = [node for node in nodes if not node.occupied]
+            self.positions = dict((id(node), i) for i, node in enumerate(self.free))
+
+    def acquire_node(self, node):
+        with self.lock:
+            if node.occupied:
+                return False
+            node.occupied = True
+            self.take(node)
+            return True
+
+    def acquire_nodes(self, nodes):
+        """ Reserves all of nodes, or none of them if any is already taken
+        """
+        with self.lock:
+            if any(node.occupied for node in nodes):
+                return False
+            for node in nodes:
+                node.occupied = True
+                self.take(node)
+            return True
+
+    def acquire_free_node(self):
+        """ Reserves a random free node, waiting while there is none.
+            Returns None once the exit signal is set
+        """
+        with self.condition:
+            if not self.free:
+                self.waits += 1
+                start = clock.time()
+                while not self.free and not stopper.is_set():
+                    clock.wait(self.condition, 60)
+                self.waited += clock.time() - start
+            if stopper.is_set():
+                return None
+            node = self.free[random.randrange(len(self.free))]
+            node.occupied = True
+            self.take(node)
+            self.acquired += 1
+            return node
+
+    def acquire_free_group(self, groups):
+        """ Reserves a random group of groups whose nodes are all free, waiting while there is none.
+            Returns None once the exit signal is set
+        """
+        with self.condition:
+            free = [group for group in groups if not any(node.occupied for node in group)]
+            if not free:
+                self.waits += 1
+                start = clock.time()
+                while not free and not stopper.is_set():
+                    clock.wait(self.condition, 60)
+                    free = [group for group in groups if not any(node.occupied for node in group)]
+                self.waited += clock.time() - start
+            if stopper.is_set():
+                return None
+            group = random.choice(free)
+            for node in group:
+                node.occupied = True
+                self.take(node)
+            self.acquired += 1
+            return group
+
+    def release_node(self, node):
+        with self.condition:
+            node.occupied = False
+            self.put(node)
+            self.wake()
+
+    def release_nodes(self, nodes):
+        # a waiter may need all of the nodes, so every waiter is woken up
+        with self.condition:
+            for node in nodes:
+                node.occupied = False
+                self.put(node)
+            self.condition.notify_all()
+
+    def wake(self):
+        # Must be called with the condition held. A waiter in acquire_within may need what was released
+        if self.acquiring:
+            self.condition.notify_all()
+        else:
+            self.condition.notify()
+
+    def acquire_within(self, acquire, seconds=30):
+        """ Calls acquire, one of the acquire methods, until it returns True, waiting for a release
+            in between, for at most seconds of clock time. Returns False if it never did or the exit
+            signal is set. A recorded fault may have started right as the one before it released its
+            target, a replayed one can get there first
+        """
+        deadline = clock.time() + seconds
+        with self.condition:
+            self.acquiring += 1
+            try:
+                while not acquire():
+                    if clock.time() >= deadline or stopper.is_set():
+                        return False
+                    clock.wait(self.condition, deadline - clock.time())
+                return True
+            finally:
+                self.acquiring -= 1
+
+    def put(self, node):
+        # Must be called with the lock held. Adds the node to the end of the free list
+        if id(node) not in self.positions:
+            self.positions[id(node)] = len(self.free)
+            self.free.append(node)
+
+    def take(self, node):
+        # Must be called with the lock held. Swaps the node with the last free one and drops it
+        position = self.positions.pop(id(node), None)
+        if position is None:
+            return
+        last = self.free.pop()
+        if last is not node:
+            self.free[position] = last
+            self.positions[id(last)] = position
+
+    def hold_service(self, node):
+        # Must be called with the lock held. Returns False if a node fault has the node
+        if node.occupied and id(node) not in self.service_holds:
+            return False
+        self.service_holds[id(node)] = self.service_holds.get(id(node), 0) + 1
+        node.occupied = True
+        self.take(node)
+        return True
+
+    def release_service(self, node):
+        # Must be called with the condition held. Frees the node once no osd or monitor fault holds it
+        self.service_holds[id(node)] -= 1
+        if not self.service_holds[id(node)]:
+            del self.service_holds[id(node)]
+            node.occupied = False
+            self.put(node)
+
+    def acquire_osd(self, osd, node):
+        """ Reserves the osd on node if it is up, taking it down stays within the minimum replication size
+            and no node fault has the node. The node stays occupied until the osd is released
+        """
+        with self.lock:
+            if not self.osds_up.get(osd, False) or self.osds_down >= self.max_osds_down:
+                return False
+            if not self.hold_service(node):
+                return False
+            self.osds_up[osd] = False
+            self.osds_down += 1
+            return True
+
+    def release_osd(self, osd, node):
+        with self.condition:
+            if not self.osds_up.get(osd, True):
+                self.osds_up[osd] = True
+                self.osds_down -= 1
+                self.release_service(node)
+                self.wake()
+
+    def osd_limit_reached(self):
+        return self.osds_down >= self.max_osds_down
+
+    def acquire_mon(self, node):
+        """ Reserves the node's monitor if it is up, enough monitors would remain for quorum
+            and no node fault has the node. The node stays occupied until the monitor is released
+        """
+        with self.lock:
+            if not node.mon_available or self.mons_down >= self.max_mons_down:
+                return False
+            if not self.hold_service(node):
+                return False
+            node.mon_available = False
+            self.mons_down += 1
+            return True
+
+    def release_mon(self, node):
+        with self.condition:
+            if node.mon and not node.mon_available:
+                node.mon_available = True
+                self.mons_down -= 1
+                self.release_service(node)
+                self.wake()
+
+    def mon_limit_reached(self):
+        return self.mons_down >= self.max_mons_down
+
+    def mons_available(self):
+        return self.num_mons - self.mons_down
+
+
+class SSH_pool:
+    """ Keeps one authenticated SSH connection per host which is shared by all fault threads.
+        Connections are kept alive, closed after sitting idle and transparently re-established
+        when the host drops them (e.g. after a node fault). Connect and exec latencies are
+        counted per host
+    """
+
+    def __init__(self, username='heat-admin', keepalive=30, idle_timeout=300, connect_timeout=10):
+        self.username = username
+        self.keepalive = keepalive  # seconds between keepalive packets
+        self.idle_timeout = idle_timeout  # seconds a connection may sit unused before it is closed
+        self.connect_timeout = connect_timeout
+        self.lock = threading.Lock()
+        # host -> [SSHClient, time last used]
+        self.connections = {}
+        # host -> lock held while connecting, so a host is never dialed twice at once
+        self.host_locks = {}
+        # host -> latency counters
+        self.counters = {}
+
+    def exec_command(self, host, command, timeout=60):
+        """ Runs a command on the host over its pooled connection and returns stdout.
+            A pooled connection the host dropped is only noticed when a channel is opened on it,
+            before the command is sent, so that connection is dialed again once. An error once the
+            command was sent is raised, the command may have run and the caller decides what to do
+        """
+        for attempt in range(2):
+            with self.lock:
+                pooled = host in self.connections
+            client = self.get_client(host)
+            start = time.time()
+            try:
+                transport = client.get_transport()
+                if transport is None:
+                    raise paramiko.SSHException('connection closed')
+                channel = transport.open_session(timeout=timeout)
+            except (paramiko.SSHException, socket.error, EOFError):
+                self.record(host, 'failures')
+                self.evict(host, client)
+                if attempt > 0 or not pooled:
+                    raise
+                continue
+            try:
+                channel.settimeout(timeout)
+                channel.exec_command(command)
+                response = channel.makefile('r', -1).read()
+            except (paramiko.SSHException, socket.error, EOFError):
+                self.record(host, 'failures')
+                self.evict(host, client)
+                raise
+            finally:
+                channel.close()
+            self.record(host, 'exec', time.time() - start)
+            return response
+
+    def get_client(self, host):
+        """ Returns a live SSHClient for the host, connecting if there is none
+        """
+        with self.lock:
+            host_lock = self.host_locks.setdefault(host, threading.Lock())
+            self.counters.setdefault(host, {'connects': 0, 'connect_time': 0.0, 'connect_max': 0.0,
+                                            'execs': 0, 'exec_time': 0.0, 'exec_max': 0.0, 'failures': 0})
+        self.evict_idle()
+
+        with host_lock:
+            with self.lock:
+                entry = self.connections.get(host)
+            if entry is not None:
+                transport = entry[0].get_transport()
+                if transport is not None and transport.is_active():
+                    entry[1] = time.time()
+                    return entry[0]
+                self.evict(host, entry[0])
+
+            start = time.time()
+            client = paramiko.SSHClient()
+            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            try:
+                client.connect(host, username=self.username, timeout=self.connect_timeout)
+            except Exception:
+                self.record(host, 'failures')
+                client.close()
+                raise
+            client.get_transport().set_keepalive(self.keepalive)
+            self.record(host, 'connect', time.time() - start)
+            with self.lock:
+                self.connections[host] = [client, time.time()]
+            return client
+
+    def evict(self, host, client):
+        """ Drops the host's connection if it is still the given client
+        """
+        with self.lock:
+            entry = self.connections.get(host)
+            if entry is not None and entry[0] is client:
+                del self.connections[host]
+        client.close()
+
+    def evict_idle(self):
+        """ Closes every connection that has not been used within the idle timeout
+        """
+        idle = []
+        with self.lock:
+            for host, entry in self.connections.items():
+                if time.time() - entry[1] > self.idle_timeout:
+                    idle.append(entry[0])
+                    del self.connections[host]
+        for client in idle:
+            client.close()
+
+    def record(self, host, counter, elapsed=None):
+        with self.lock:
+            counters = self.counters[host]
+            if elapsed is None:
+                counters[counter] += 1
+            else:
+                counters[counter + 's'] += 1
+                counters[counter + '_time'] += elapsed
+                counters[counter + '_max'] = max(counters[counter + '_max'], elapsed)
+
+    def summary(self):
+        """ Returns one line of latency counters per host
+        """
+        lines = []
+        with self.lock:
+            for host in sorted(self.counters):
+                c = self.counters[host]
+                lines.append('{}: {} connects (avg {:.3f}s, max {:.3f}s), {} execs (avg {:.3f}s, max {:.3f}s), '
+                             '{} failures'.format(host, c['connects'], c['connect_time'] / max(c['connects'], 1),
+                                                  c['connect_max'], c['execs'], c['exec_time'] / max(c['execs'], 1),
+                                                  c['exec_max'], c['failures']))
+        return lines
+
+    def close(self):
+        with self.lock:
+            clients = [entry[0] for entry in self.connections.values()]
+            self.connections = {}
+        for client in clients:
+            client.close()
+
+
+class Reachability_prober:
+    """ Probes every node of the deployment on a fixed cadence from one background thread.
+        A probe is a non-blocking TCP connect to the ssh port, all nodes are probed at once.
+        Results are cached so fault functions can ask whether a node is reachable without
+        waiting, a result older than the ttl is refreshed by probing that node right away
+    """
+
+    def __init__(self, hosts, interval=10, ttl=30, port=22, connect_timeout=3):
+        self.hosts = list(hosts)
+        self.interval = interval  # seconds between probes of all nodes
+        self.ttl = ttl  # seconds a result is trusted
+        self.port = port
+        self.connect_timeout = connect_timeout
+        self.lock = threading.Lock()
+        # host -> (reachable, time probed)
+        self.results = {}
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while not stopper.is_set():
+            self.probe(self.hosts)
+            stopper.wait(self.interval)
+
+    def is_reachable(self, host):
+        with self.lock:
+            result = self.results.get(host)
+        if result is not None and time.time() - result[1] <= self.ttl:
+            return result[0]
+        return self.probe([host])[host]
+
+    def probe(self, hosts):
+        """ Probes the hosts concurrently, stores and returns {host: reachable}
+        """
+        reachable = {}
+        # select() only handles a limited number of sockets at once
+        for i in range(0, len(hosts), 500):
+            reachable.update(self.probe_batch(hosts[i:i + 500]))
+        now = time.time()
+        with self.lock:
+            for host in reachable:
+                self.results[host] = (reachable[host], now)
+        return reachable
+
+    def probe_batch(self, hosts):
+        reachable = {}
+        pending = {}
+        for host in hosts:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(0)
+            try:
+                error = sock.connect_ex((host, self.port))
+            except socket.error:
+                error = errno.EHOSTUNREACH
+            if error in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+                pending[sock] = host
+            else:
+                reachable[host] = error == 0
+                sock.close()
+
+        deadline = time.time() + self.connect_timeout
+        while pending and time.time() < deadline:
+            writable = select.select([], list(pending), [], deadline - time.time())[1]
+            for sock in writable:
+                reachable[pending.pop(sock)] = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0
+                sock.close()
+
+        # anything that did not answer in time is unreachable
+        for sock, host in pending.items():
+            reachable[host] = False
+            sock.close()
+        return reachable
+
+
+class Ceph_watcher:
+    """ Pulls the state of the Ceph cluster from one thread and shares it with every fault.
+        A poll runs ceph status, ceph pg dump, ceph osd dump and ceph quorum_status on a reachable
+        controller and parses them once into a snapshot: the health, the placement groups that are not
+        active+clean by osd, the osds that are up in the osdmap and the monitors in quorum.
+        Faults wait on the watcher's condition for a snapshot that satisfies them instead of
+        querying the cluster themselves, the watcher only polls while a fault is waiting
+    """
+
+    commands = [('status', 'sudo ceph status -f json'),
+                ('pgs', 'sudo ceph pg dump pgs_brief -f json'),
+                ('osds', 'sudo ceph osd dump -f json'),
+                ('quorum', 'sudo ceph quorum_status -f json')]
+
+    def __init__(self, deployment, interval=10):
+        self.deployment = deployment
+        self.interval = interval  # seconds between polls while a fault is waiting
+        self.condition = threading.Condition()
+        self.snapshot = None
+        # number of faults waiting, and whether one of them asked for a poll right away
+        self.waiting = 0
+        self.requested = False
+        self.next_poll = 0
+        self.host = None
+        self.polls = 0
+        self.failures = 0
+        self.stopped = False
+        self.thread = None
+
+    def start(self):
+        # waits of the faults end as soon as the exit signal is set
+        stopper.subscribe(self.condition)
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        # keeps running after the exit signal, the signal handler waits on it for the cluster to be healthy
+        while not self.stopped:
+            with self.condition:
+                while not (self.stopped or self.requested or (self.waiting and clock.time() >= self.next_poll)):
+                    if self.waiting:
+                        clock.wait(self.condition, self.next_poll - clock.time())
+                    else:
+                        self.condition.wait(1)
+                self.requested = False
+                self.next_poll = clock.time() + self.interval
+            snapshot = self.poll()
+            with self.condition:
+                if snapshot is not None:
+                    self.snapshot = snapshot
+                self.condition.notify_all()
+
+    def poll(self):
+        """ Returns a new snapshot or None if the cluster could not be queried
+        """
+        started = clock.time()
+        if self.host is None or not prober.is_reachable(self.host):
+            self.host = None
+            for node in self.deployment.controllers():
+                if prober.is_reachable(node.ip):
+                    self.host = node.ip
+                    break
+        try:
+            if self.host is None:
+                raise socket.error('no controller reachable')
+            responses = {}
+            for name, command in self.commands:
+                responses[name] = json.loads(ssh_pool.exec_command(self.host, command))
+        except Exception as e:
+            self.failures += 1
+            log.event('ceph-watcher', 'poll failed: {}'.format(e), node=self.host)
+            self.host = None
+            return None
+        self.polls += 1
+        return self.parse(started, responses['status'], responses['pgs'], responses['osds'], responses['quorum'])
+
+    @staticmethod
+    def parse(started, status, pgs, osds, quorum):
+        # newer releases wrap the list of pgs
+        if isinstance(pgs, dict):
+            pgs = pgs.get('pg_stats', [])
+        unclean = {}
+        # an osd that maps no placement groups is still up in the osdmap
+        osds_up = set(osd['osd'] for osd in osds.get('osds', []) if osd.get('up'))
+        for pg in pgs:
+            if pg['state'] != 'active+clean':
+                for osd in set(pg.get('up', [])) | set(pg.get('acting', [])):
+                    unclean.setdefault(osd, []).append(pg['state'])
+        health = status.get('health', {})
+        return {'time': started,
+                'health': health.get('status') or health.get('overall_status'),
+                'unclean': unclean,
+                'osds_up': osds_up,
+                'quorum': quorum.get('quorum_names', [])}
+
+    def wait_for(self, predicate, timeout=None, interruptible=True):
+        """ Blocks until a snapshot taken after the call satisfies predicate(snapshot).
+            Returns False once timeout seconds have passed or, if interruptible, the exit signal is set
+        """
+        since = clock.time()
+        deadline = None if timeout is None else since + timeout
+        with self.condition:
+            self.waiting += 1
+            self.requested = True
+            self.condition.notify_all()
+            try:
+                while not (interruptible and stopper.is_set()) and not self.stopped:
+                    snapshot = self.snapshot
+                    if snapshot is not None and snapshot['time'] >= since and predicate(snapshot):
+                        return True
+                    wait = self.interval
+                    if deadline is not None:
+                        # a timeout of 0 still waits for the poll it asked for
+                        if clock.time() >= deadline and snapshot is not None and snapshot['time'] >= since:
+                            return False
+                        wait = max(0, min(wait, deadline - clock.time())) or self.interval
+                    clock.wait(self.condition, wait)
+                return False
+            finally:
+                self.waiting -= 1
+
+    @staticmethod
+    def osd_clean(osd):
+        """ Predicate for wait_for: the osd is up and all of its placement groups are active+clean
+        """
+        return lambda snapshot: osd in snapshot['osds_up'] and not snapshot['unclean'].get(osd)
+
+    @staticmethod
+    def mon_in_quorum(node):
+        """ Predicate for wait_for: the monitor on the node is part of the quorum
+        """
+        return lambda snapshot: any(name == node.name or name.endswith('-' + node.name)
+                                    for name in snapshot['quorum'])
+
+    def stop(self):
+        stopper.unsubscribe(self.condition)
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        if self.thread is not None:
+            while self.thread.is_alive():
+                self.thread.join(1)
+
+    def summary(self):
+        return ['{} polls, {} failed'.format(self.polls, self.failures)]
+
+
+class Nova_client:
+    """ Runs nova for the whole injector. The credentials in stackrc are sourced once and passed
+        to every nova command as its environment. The state of the servers is kept in one table
+        shared by all threads, refreshed from a background thread every interval seconds and
+        on demand when a caller needs something newer. Power actions asked for within
+        batch_window seconds of each other are sent as a single nova command
+    """
+
+    def __init__(self, rc='~/stackrc', interval=30, batch_window=0.2):
+        self.rc = rc
+        self.interval = interval
+        self.batch_window = batch_window
+        self.lock = threading.Lock()
+        # held while nova list runs, so callers that need a refresh at the same time share one
+        self.refresh_lock = threading.Lock()
+        self.env = None
+        # id -> {name, status, task_state, power_state, ip}, the ctlplane rows and the time they were listed
+        self.table = {}
+        self.rows = []
+        self.updated = 0
+        # action -> batch of power actions waiting to be sent
+        self.batches = {}
+        # command -> number of nova commands run, action -> number of servers powered on or off
+        self.counters = collections.Counter()
+        self.powered = collections.Counter()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def __repr__(self):
+        return 'nova'
+
+    def credentials(self):
+        """ Returns the environment of stackrc, sourcing it on first use
+        """
+        with self.lock:
+            if self.env is None:
+                output = subprocess.check_output(['bash', '-c', '. {} > /dev/null && env -0'.format(self.rc)])
+                self.env = dict(variable.split('=', 1) for variable in output.split('\0') if '=' in variable)
+            return self.env
+
+    def run(self, *args):
+        with self.lock:
+            self.counters[args[0]] += 1
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(('nova',) + args, env=self.credentials(), stderr=devnull)
+
+    def refresh(self):
+        """ Lists the servers and replaces the table
+        """
+        with self.refresh_lock:
+            listed = time.time()
+            output = self.run('list')
+            table = {}
+            rows = []
+            for line in output.split('\n'):
+                # | id | name | status | task state | power state | networks |
+                fields = [field.strip() for field in line.split('|')]
+                if len(fields) < 8 or fields[1] in ('', 'ID'):
+                    continue
+                table[fields[1]] = {'name': fields[2], 'status': fields[3], 'task_state': fields[4],
+                                    'power_state': fields[5], 'ip': fields[6].partition('ctlplane=')[-1]}
+                if 'ctlplane' in line:
+                    rows.append(line)
+            with self.lock:
+                self.table = table
+                self.rows = rows
+                self.updated = listed
+
+    def servers(self, max_age=None):
+        """ Returns the server table, listing the servers again if it is older than max_age seconds
+            (the refresh interval by default)
+        """
+        max_age = self.interval if max_age is None else max_age
+        if time.time() - self.updated > max_age:
+            self.refresh()
+        with self.lock:
+            return self.table
+
+    def nodes(self, max_age=None):
+        """ Returns the overcloud nodes like setup.py stores them, {id: {node_type, node_ip, node_name}}
+        """
+        self.servers(max_age)
+        with self.lock:
+            return parse_nova_list(self.rows)
+
+    def shutoff_nodes(self, poll=5, timeout=300):
+        """ Waits up to timeout seconds for servers that are still powering off,
+            returns (id, ip) of every server that is off. Failed listings are retried until
+            the timeout, if nova could not be listed at all nothing is returned
+        """
+        deadline = clock.time() + timeout
+        servers = None
+        while True:
+            try:
+                servers = self.servers(0)
+                if not any(server['task_state'] == 'powering-off' for server in servers.values()):
+                    break
+            except (OSError, subprocess.CalledProcessError) as e:
+                print '[nova] listing the servers failed: {}'.format(e)
+                log.event('nova', 'listing the servers failed: {}'.format(e))
+            if clock.time() >= deadline:
+                break
+            # runs after the exit signal, so the wait is not cut short by it
+            clock.sleep(poll)
+        if servers is None:
+            return []
+        return [(server_id, server['ip']) for server_id, server in servers.items()
+                if server['status'] == 'SHUTOFF' and server['ip']]
+
+    def power(self, action, server_id):
+        """ Runs nova start or stop on the server and returns its exit status. The first caller waits
+            batch_window seconds and sends the servers of every caller that joined in the meantime
+        """
+        with self.lock:
+            batch = self.batches.get(action)
+            leader = batch is None
+            if leader:
+                batch = self.batches[action] = {'ids': [], 'done': threading.Event(), 'status': None}
+            batch['ids'].append(server_id)
+        if not leader:
+            batch['done'].wait()
+            return batch['status'][server_id]
+
+        time.sleep(self.batch_window)
+        with self.lock:
+            del self.batches[action]
+        try:
+            self.run(action, *batch['ids'])
+            batch['status'] = dict((server, 0) for server in batch['ids'])
+        except (OSError, subprocess.CalledProcessError):
+            batch['status'] = self.batch_status(action, batch['ids'])
+        with self.lock:
+            self.powered[action] += len(batch['ids'])
+            # the table no longer shows these servers as they are
+            self.updated = 0
+        batch['done'].set()
+        return batch['status'][server_id]
+
+    def batch_status(self, action, ids):
+        """ Returns the exit status of every server of a batch nova failed. nova fails the whole command
+            when one server fails (e.g. one that is already ACTIVE on start), so a server counts as done
+            if the table lists it in the state the action asks for or on its way there
+        """
+        status, task_state = {'start': ('ACTIVE', 'powering-on'), 'stop': ('SHUTOFF', 'powering-off')}[action]
+        try:
+            servers = self.servers(0)
+        except (OSError, subprocess.CalledProcessError):
+            return dict((server, 1) for server in ids)
+        return dict((server, 0 if server in servers and (servers[server]['status'] == status or
+                                                      servers[server]['task_state'] == task_state) else 1)
+                    for server in ids)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.keep_fresh)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def keep_fresh(self):
+        while not self.stopped.is_set():
+            try:
+                self.servers()
+            except (OSError, subprocess.CalledProcessError):
+                pass
+            self.stopped.wait(self.interval)
+
+    def summary(self):
+        lines = []
+        with self.lock:
+            for command, count in sorted(self.counters.items()):
+                if command in self.powered:
+                    lines.append('{}: {} servers in {} commands'.format(command, self.powered[command], count))
+                else:
+                    lines.append('{}: {} commands'.format(command, count))
+        return lines
+
+    def close(self):
+        self.stopped.set()
+
+
+class Restorer:
+    """ Brings the deployment back to a clean state once a run is interrupted.
+        Nodes that are off are powered on and every other node is restarted, so services
+        stopped by faults come back. All nodes are handled at once by a bounded pool of
+        worker threads, each waits for its own node to be ready again (ssh up and the
+        recorded services active), so restoring takes as long as the slowest node
+    """
+
+    def __init__(self, deployment, workers=8, timeout=600):
+        self.deployment = deployment
+        self.workers = workers
+        self.timeout = timeout  # seconds a node may take to be ready again
+        self.jobs = Queue.Queue()
+        self.lock = threading.Lock()
+        # ips of nodes that were not ready in time
+        self.failed = []
+
+    def run(self, since=None):
+        """ Restores every node and waits for ceph to be healthy, returns the seconds it took.
+            since is the clock time of the exit signal, the time from then is reported as well
+        """
+        start = clock.time()
+        shutoff = nova.shutoff_nodes(timeout=self.timeout)
+        off = set(ip for node_id, ip in shutoff)
+        for node_id, ip in shutoff:
+            self.jobs.put(('restore', ip, node_id))
+        for node in self.deployment.nodes:
+            if node.ip not in off:
+                self.jobs.put(('restart', node.ip, node.id))
+        print '[restore] powering on {} nodes and restarting {}, {} at a time' \
+            .format(len(off), self.jobs.qsize() - len(off), self.workers)
+
+        threads = []
+        for i in range(min(self.workers, self.jobs.qsize())):
+            thread = threading.Thread(target=self.work)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            while thread.is_alive():
+                # join with a timeout so the main thread keeps handling signals
+                thread.join(1)
+
+        healthy = True
+        if ceph_watcher is not None:
+            healthy = ceph_watcher.wait_for(lambda snapshot: snapshot['health'] == 'HEALTH_OK', self.timeout,
+                                            interruptible=False)
+
+        elapsed = clock.time() - start
+        print '[restore] environment restored in {:.1f}s, {} nodes not ready{}'.format(
+            elapsed, len(self.failed), '' if healthy else ', ceph not healthy')
+        log.event('restore', 'environment restored in {:.1f}s, {} nodes not ready ({}), ceph {}healthy'
+                  .format(elapsed, len(self.failed), ', '.join(self.failed), '' if healthy else 'not '))
+        if since is not None:
+            print '[restore] {} {:.1f}s after the exit signal'.format(
+                'healthy' if healthy and not self.failed else 'gave up', clock.time() - since)
+            log.event('restore', '{} {:.1f}s after the exit signal'.format(
+                'healthy' if healthy and not self.failed else 'gave up', clock.time() - since))
+        return elapsed
+
+    def work(self):
+        while True:
+            try:
+                action, ip, node_id = self.jobs.get_nowait()
+            except Queue.Empty:
+                return
+            start = clock.time()
+            if action == 'restore':
+                executor.restore_node(ip, node_id)
+            else:
+                executor.restart_node(ip, node_id)
+            node = self.deployment.by_ip.get(ip)
+            ready = node is not None and self.wait_until_ready(node)
+            if not ready:
+                with self.lock:
+                    self.failed.append(ip)
+            log.event('restore', '{} {} in {:.1f}s'.format(action, 'done' if ready else 'not ready',
+                                                          clock.time() - start), node=ip, phase=action)
+
+    def wait_until_ready(self, node):
+        # the exit signal is already set, so this does not go through Fault.wait_until_ready
+        ready = Node_fault.node_ready(node, interruptible=False)
+        deadline = clock.time() + self.timeout
+        while not ready(min(60, max(0, deadline - clock.time()))):
+            if clock.time() >= deadline:
+                return False
+        return True
+
+class Playbooks:
+    """ Parses the crash and restore playbook templates once at startup. Faults get their
+        own copy of a template rendered in memory, which is piped straight to ansible-playbook
+        so nothing is written to the playbooks directory
+    """
+
+    templates = ['system-crash', 'system-restore', 'ceph-service-crash', 'ceph-service-restore', 'restart-nodes']
+
+    def __init__(self, directory='playbooks/'):
+        self.cache = {}
+        for name in self.templates:
+            with open(os.path.join(directory, name + '.yml')) as f:
+                self.cache[name] = yaml.load(f)
+
+    def render(self, name, host, tasks):
+        """ Returns the named template as YAML text with its hosts set to host
+            and the fields given in tasks ({task name: {field: value}}) replaced,
+            a task given as None is left out
+        """
+        config = copy.deepcopy(self.cache[name])
+        config[0]['hosts'] = host
+        config[0]['tasks'] = [task for task in config[0]['tasks'] if tasks.get(task['name'], {}) is not None]
+        for task in config[0]['tasks']:
+            if task['name'] in tasks:
+                task.update(tasks[task['name']])
+        return yaml.dump(config, default_flow_style=False)
+
+    # the power tasks are left to the nova client, which batches them
+
+    def node_crash(self, ip):
+        return self.render('system-crash', ip, {'Power off server': None})
+
+    def node_restore(self, ip):
+        return self.render('system-restore', ip, {
+            'Power on server': None,
+            'waiting 30 secs for server to come back': {
+                'local_action': 'wait_for host=' + ip + ' port=22 state=started delay=30 timeout=120'}})
+
+    def node_restart(self, ip):
+        return self.render('restart-nodes', ip, {
+            'Waiting for server to come back after reboot': {
+                'local_action': 'wait_for host=' + ip + ' state=started port=22 delay=30 timeout=300 connect_timeout=15'}})
+
+    def service_crash(self, host, command):
+        return self.render('ceph-service-crash', host, {'Stopping ceph service': {'shell': command}})
+
+    def service_restore(self, host, command):
+        return self.render('ceph-service-restore', host, {'Restoring ceph service': {'shell': command}})
+
+    def run(self, playbook, quiet=True):
+        """ Feeds a rendered playbook to ansible-playbook on stdin and returns its exit status
+        """
+        output = subprocess.PIPE if quiet else None
+        process = subprocess.Popen(['ansible-playbook', '/dev/stdin'], stdin=subprocess.PIPE, stdout=output,
+                                   stderr=output)
+        process.communicate(playbook)
+        return process.returncode
+
+
+class Executor:
+    """ Template class for the backend that runs the crash and restore steps of faults.
+        Fault functions only call the four step methods below, so the backend can be swapped
+        per run. Every step is timed so backends can be compared
+    """
+
+    # Same as the 'Crash server' task of system-crash.yml: fire and forget, the connection dies with the kernel
+    crash_command = "sudo nohup sh -c 'sleep 2 && echo c > /proc/sysrq-trigger' > /dev/null 2>&1 &"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # step -> [count, total seconds, max seconds]
+        self.timings = {}
+
+    def __repr__(self):
+        raise NotImplementedError
+
+    def crash_node(self, ip, node_id, quiet=True):
+        return self.timed('crash-node', ip, self.do_crash_node, ip, node_id, quiet)
+
+    def restore_node(self, ip, node_id, quiet=True):
+        return self.timed('restore-node', ip, self.do_restore_node, ip, node_id, quiet)
+
+    def restart_node(self, ip, node_id, quiet=True):
+        return self.timed('restart-node', ip, self.do_restart_node, ip, node_id, quiet)
+
+    def prepare_crash_node(self, ip, node_id, quiet=True):
+        """ Does the part of crash_node that can be done ahead of time and returns a function that
+            does the rest, so the crashes of a correlated fault can be fired together.
+            The function returns the time the crash was delivered to the node, None if it was not
+        """
+        def crash():
+            if self.crash_node(ip, node_id, quiet):
+                return None
+            return time.time()
+        return crash
+
+    @staticmethod
+    def connect(pool, ip):
+        # opens the pooled connection ahead of time, so sending a command later needs no handshake
+        if prober.is_reachable(ip):
+            try:
+                pool.get_client(ip)
+            except Exception:
+                pass
+
+    def deliver_crash(self, pool, ip):
+        """ Sends the crash command over a pooled ssh connection, returns the time it was delivered or None
+        """
+        try:
+            pool.exec_command(ip, self.crash_command, timeout=10)
+        except Exception:
+            return None
+        return time.time()
+
+    def stop_service(self, host, service, quiet=True):
+        return self.timed('stop-service', host, self.do_stop_service, host, service, quiet)
+
+    def start_service(self, host, service, quiet=True):
+        return self.timed('start-service', host, self.do_start_service, host, service, quiet)
+
+    def do_crash_node(self, ip, node_id, quiet):
+        raise NotImplementedError
+
+    def do_restore_node(self, ip, node_id, quiet):
+        raise NotImplementedError
+
+    def do_restart_node(self, ip, node_id, quiet):
+        raise NotImplementedError
+
+    def do_stop_service(self, host, service, quiet):
+        raise NotImplementedError
+
+    def do_start_service(self, host, service, quiet):
+        raise NotImplementedError
+
+    def timed(self, step, host, function, *args):
+        start = time.time()
+        result = function(*args)
+        elapsed = time.time() - start
+        with self.lock:
+            timing = self.timings.setdefault(step, [0, 0.0, 0.0])
+            timing[0] += 1
+            timing[1] += elapsed
+            timing[2] = max(timing[2], elapsed)
+        log.event('executor', '{} {} took {:.2f}s'.format(self.__repr__(), step, elapsed), node=host, phase=step)
+        return result
+
+    def summary(self):
+        """ Returns one line of wall time statistics per step
+        """
+        lines = []
+        with self.lock:
+            for step in sorted(self.timings):
+                count, total, longest = self.timings[step]
+                lines.append('{} {}: {} steps (avg {:.2f}s, max {:.2f}s)'
+                             .format(self.__repr__(), step, count, total / count, longest))
+        return lines
+
+
+class Ansible_executor(Executor):
+    """ Runs each step by rendering its playbook and spawning ansible-playbook
+    """
+
+    def __init__(self, playbooks):
+        Executor.__init__(self)
+        self.playbooks = playbooks
+
+    def __repr__(self):
+        return 'ansible'
+
+    def prepare_crash_node(self, ip, node_id, quiet=True):
+        # ansible-playbook takes seconds to start, so crashes that have to land together are sent over the
+        # pooled ssh connection instead. The rendered playbook is kept for a node that can not be reached that way
+        playbook = self.playbooks.node_crash(ip)
+        return lambda: self.timed('crash-node', ip, self.fire_crash, ip, node_id, playbook, quiet)
+
+    def fire_crash(self, ip, node_id, playbook, quiet):
+        delivered = self.deliver_crash(ssh_pool, ip)
+        if delivered is None:
+            print '[executor] crash of {} could not be sent over ssh, running its playbook, ' \
+                  'it may land seconds after the others'.format(ip)
+            log.event('executor', 'crash could not be sent over ssh, running its playbook, it may land seconds '
+                      'after the others', node=ip, phase='crash-node')
+            if not self.playbooks.run(playbook, quiet):
+                # the playbook only returns once the crash is sent, so this is when it was delivered at the latest
+                delivered = time.time()
+        nova.power('stop', node_id)
+        return delivered
+
+    def do_crash_node(self, ip, node_id, quiet):
+        status = self.playbooks.run(self.playbooks.node_crash(ip), quiet)
+        return nova.power('stop', node_id) or status
+
+    def do_restore_node(self, ip, node_id, quiet):
+        status = nova.power('start', node_id)
+        return self.playbooks.run(self.playbooks.node_restore(ip), quiet) or status
+
+    def do_restart_node(self, ip, node_id, quiet):
+        return self.playbooks.run(self.playbooks.node_restart(ip), quiet)
+
+    def do_stop_service(self, host, service, quiet):
+        return self.playbooks.run(self.playbooks.service_crash(host, 'systemctl stop ' + service), quiet)
+
+    def do_start_service(self, host, service, quiet):
+        return self.playbooks.run(self.playbooks.service_restore(host, 'systemctl start ' + service), quiet)
+
+
+class SSH_executor(Executor):
+    """ Runs each step directly over the shared ssh pool, power actions go through the nova client.
+        Performs the same actions as the playbooks without starting ansible for every step
+    """
+
+    def __init__(self, pool):
+        Executor.__init__(self)
+        self.pool = pool
+
+    def __repr__(self):
+        return 'ssh'
+
+    def prepare_crash_node(self, ip, node_id, quiet=True):
+        # the connection is opened ahead of time, so firing the crash is a single command on it
+        return lambda: self.timed('crash-node', ip, self.fire_crash, ip, node_id)
+
+    def fire_crash(self, ip, node_id):
+        delivered = self.deliver_crash(self.pool, ip)
+        nova.power('stop', node_id)
+        return delivered
+
+    def do_crash_node(self, ip, node_id, quiet):
+        self.deliver_crash(self.pool, ip)
+        return nova.power('stop', node_id)
+
+    def do_restore_node(self, ip, node_id, quiet):
+        status = nova.power('start', node_id)
+        # Same as the 'waiting 30 secs for server to come back' task. Restores also run after the
+        # exit signal, so this waits on the clock rather than the stopper
+        clock.sleep(30)
+        self.wait_for_port(ip, 22, 90)
+        return status
+
+    def do_restart_node(self, ip, node_id, quiet):
+        # Same as restart-nodes.yml: reboot in the background and wait for ssh to come back
+        try:
+            self.pool.exec_command(ip, "sudo nohup sh -c 'sleep 2 && reboot' > /dev/null 2>&1 &", timeout=10)
+        except Exception:
+            return 1
+        clock.sleep(30)
+        return 0 if self.wait_for_port(ip, 22, 270) else 1
+
+    def do_stop_service(self, host, service, quiet):
+        return self.systemctl(host, 'stop', service)
+
+    def do_start_service(self, host, service, quiet):
+        return self.systemctl(host, 'start', service)
+
+    def systemctl(self, host, action, service):
+        # Return systemctl's exit status like the playbook run would
+        try:
+            response = self.pool.exec_command(host, 'sudo systemctl {} {}; echo $?'.format(action, service))
+            return int(response.split()[-1])
+        except Exception:
+            return 1
+
+    def wait_for_port(self, host, port, timeout):
+        """ Returns True once the port accepts connections or False after timeout seconds of clock time
+        """
+        deadline = clock.time() + timeout
+        while clock.time() < deadline:
+            try:
+                socket.create_connection((host, port), 5).close()
+                return True
+            except socket.error:
+                clock.sleep(1)
+        return False
+
+
+class Simulated_executor(Executor):
+    """ Applies each step to a Simulated_cluster instead of a deployment
+    """
+
+    def __init__(self, cluster):
+        Executor.__init__(self)
+        self.cluster = cluster
+
+    def __repr__(self):
+        return 'simulated'
+
+    def do_crash_node(self, ip, node_id, quiet):
+        return self.cluster.crash_node(ip)
+
+    def do_restore_node(self, ip, node_id, quiet):
+        return self.cluster.restore_node(ip)
+
+    def do_restart_node(self, ip, node_id, quiet):
+        # a reboot: every service of the node is stopped and comes back once it has booted
+        return self.cluster.crash_node(ip) or self.cluster.restore_node(ip)
+
+    def do_stop_service(self, host, service, quiet):
+        return self.cluster.stop_service(host, service)
+
+    def do_start_service(self, host, service, quiet):
+        return self.cluster.start_service(host, service)
+
+
+class Simulated_cluster:
+    """ In-process stand-in for the deployment described by config.yaml, used with --simulate.
+        Keeps the power state of every node, the state of every osd and monitor and the
+        placement groups of every osd, all in clock time so it runs on any clock.
+        Stands in for the ssh pool (ceph json commands), the prober (reachability) and the nova
+        client (server table and power actions), the Simulated_executor applies crash and restore steps to it.
+        A node that is started again is reachable after boot_time seconds. Placement groups of
+        a restarted osd return to active+clean one by one within recovery_base seconds plus
+        recovery_per_minute seconds for every minute the osd was down
+    """
+
+    def __init__(self, deployment, pgs_per_osd=32, boot_time=120, recovery_base=30, recovery_per_minute=10):
+        self.boot_time = boot_time
+        self.recovery_base = recovery_base
+        self.recovery_per_minute = recovery_per_minute
+        self.lock = threading.Lock()
+        now = clock.time()
+        self.nodes_by_ip = dict((node.ip, node) for node in deployment.nodes)
+        # ip -> node id, whether the node is powered on and the time it is reachable from
+        self.ids = {}
+        self.powered = {}
+        self.booted = {}
+        # osd -> ip of its node, time it went down (None while up) and the time each of its pgs is clean from
+        self.osd_hosts = {}
+        self.osds_down = {}
+        self.pgs = {}
+        # ip -> whether the monitor on the node is running, and the monitor's name
+        self.mons = {}
+        self.mon_names = {}
+        for node in deployment.nodes:
+            self.ids[node.ip] = node.id
+            self.powered[node.ip] = True
+            self.booted[node.ip] = now
+            for osd in node.osds:
+                self.osd_hosts[osd] = node.ip
+                self.osds_down[osd] = None
+                self.pgs[osd] = [now] * pgs_per_osd
+            if node.mon:
+                self.mons[node.ip] = True
+                self.mon_names[node.ip] = node.name
+        self.commands = collections.Counter()
+
+    def __repr__(self):
+        return 'simulated'
+
+    # Node and service steps, called by the Simulated_executor ---------------------------------------------
+
+    def crash_node(self, ip):
+        with self.lock:
+            if ip not in self.powered:
+                return 1
+            self.powered[ip] = False
+            for osd in self.osds_of(ip):
+                self.stop_osd(osd)
+            if ip in self.mons:
+                self.mons[ip] = False
+            return 0
+
+    def restore_node(self, ip):
+        with self.lock:
+            if ip not in self.powered:
+                return 1
+            if not self.powered[ip]:
+                self.powered[ip] = True
+                self.booted[ip] = clock.time() + self.boot_time
+                # services are enabled, they come back once the node has booted
+                for osd in self.osds_of(ip):
+                    self.start_osd(osd, self.booted[ip])
+                if ip in self.mons:
+                    self.mons[ip] = True
+            return 0
+
+    def stop_service(self, host, service):
+        with self.lock:
+            if not self.reachable(host):
+                return 1
+            osd = self.osd_of(service)
+            if osd is not None and self.osd_hosts.get(osd) == host:
+                self.stop_osd(osd)
+            elif service == 'ceph-mon.target' and host in self.mons:
+                self.mons[host] = False
+            else:
+                return 1
+            return 0
+
+    def start_service(self, host, service):
+        with self.lock:
+            if not self.reachable(host):
+                return 1
+            osd = self.osd_of(service)
+            if osd is not None and self.osd_hosts.get(osd) == host:
+                self.start_osd(osd, clock.time())
+            elif service == 'ceph-mon.target' and host in self.mons:
+                self.mons[host] = True
+            else:
+                return 1
+            return 0
+
+    # Must be called with the lock held
+
+    def osds_of(self, ip):
+        return [osd for osd in self.osd_hosts if self.osd_hosts[osd] == ip]
+
+    @staticmethod
+    def osd_of(service):
+        # the systemd unit of osd N is ceph-osd@N
+        match = re.match(r'ceph-osd@(\d+)$', service)
+        return int(match.group(1)) if match else None
+
+    def stop_osd(self, osd):
+        if self.osds_down[osd] is None:
+            self.osds_down[osd] = clock.time()
+            self.pgs[osd] = [float('inf')] * len(self.pgs[osd])
+
+    def start_osd(self, osd, start):
+        if self.osds_down[osd] is not None:
+            minutes_down = max(0, start - self.osds_down[osd]) / 60
+            recovery = self.recovery_base + self.recovery_per_minute * minutes_down
+            self.osds_down[osd] = None
+            self.pgs[osd] = sorted(start + random.uniform(0, recovery) for pg in self.pgs[osd])
+
+    def reachable(self, host):
+        return self.powered.get(host, False) and clock.time() >= self.booted[host]
+
+    def pg_states(self, osd):
+        if self.osds_down[osd] is not None:
+            return ['active+undersized+degraded'] * len(self.pgs[osd])
+        now = clock.time()
+        return ['active+clean' if clean <= now else 'active+recovering+degraded' for clean in self.pgs[osd]]
+
+    def osd_clean(self, osd):
+        return self.osds_down[osd] is None and max(self.pgs[osd] or [0]) <= clock.time()
+
+    # Stand-ins for the prober, the ssh pool and nova ---------------------------------------------
+
+    def start(self):
+        pass
+
+    def is_reachable(self, host):
+        with self.lock:
+            return self.reachable(host)
+
+    def exec_command(self, host, command, timeout=60):
+        """ Answers the ceph and systemctl commands the faults run, raises for anything else
+        """
+        with self.lock:
+            self.commands[command.split('|')[0].strip()] += 1
+            if not self.reachable(host):
+                raise socket.error('{} is unreachable'.format(host))
+            if command == 'true':
+                return ''
+            if command.startswith('systemctl is-active '):
+                # services are enabled, they run as soon as the node is reachable
+                return '\n'.join('active' for service in command.split()[2:]) + '\n'
+            if 'ceph status' in command:
+                clean = all(self.osd_clean(osd) for osd in self.pgs)
+                quorum = self.mons.values().count(True) > len(self.mons) / 2
+                return json.dumps({'health': {'status': 'HEALTH_OK' if clean and quorum else 'HEALTH_WARN'}})
+            if 'ceph pg dump' in command:
+                pgs = []
+                for osd in sorted(self.pgs):
+                    up = [osd] if self.osds_down[osd] is None else []
+                    for i, state in enumerate(self.pg_states(osd)):
+                        pgs.append({'pgid': '{}.{:x}'.format(osd, i), 'state': state, 'up': up, 'acting': up})
+                return json.dumps(pgs)
+            if 'ceph osd dump' in command:
+                return json.dumps({'osds': [{'osd': osd, 'up': int(self.osds_down[osd] is None), 'in': 1}
+                                            for osd in sorted(self.osds_down)]})
+            if 'ceph quorum_status' in command:
+                # a monitor can only be in quorum while a majority of them is running
+                running = [self.mon_names[ip] for ip in sorted(self.mons) if self.mons[ip]]
+                quorum = running if len(running) > len(self.mons) / 2 else []
+                return json.dumps({'quorum_names': quorum,
+                                   'monmap': {'mons': [{'name': self.mon_names[ip]} for ip in sorted(self.mons)]}})
+        raise ValueError('command not supported by the simulator: {}'.format(command))
+
+    def servers(self, max_age=None):
+        with self.lock:
+            return dict((self.ids[ip], {'name': 'overcloud-' + node.name,
+                                        'status': 'ACTIVE' if self.powered[ip] else 'SHUTOFF', 'task_state': '-',
+                                        'power_state': 'Running' if self.powered[ip] else 'Shutdown', 'ip': ip})
+                        for ip, node in self.nodes_by_ip.items())
+
+    def nodes(self, max_age=None):
+        return dict((node.id, {'node_type': node.type, 'node_ip': node.ip, 'node_name': node.name})
+                    for node in self.nodes_by_ip.values())
+
+    def shutoff_nodes(self, poll=5, timeout=300):
+        """ Returns (id, ip) of every powered off node, nothing powers off gradually in the simulator
+        """
+        with self.lock:
+            return [(self.ids[ip], ip) for ip in self.powered if not self.powered[ip]]
+
+    def power(self, action, server_id):
+        with self.lock:
+            self.commands[action] += 1
+        ip = next((ip for ip in self.ids if self.ids[ip] == server_id), None)
+        return self.crash_node(ip) if action == 'stop' else self.restore_node(ip)
+
+    def summary(self):
+        with self.lock:
+            lines = ['{} nodes off, {} osds down, {} monitors down'
+                     .format(self.powered.values().count(False),
+                             len([osd for osd in self.osds_down if self.osds_down[osd] is not None]),
+                             self.mons.values().count(False))]
+            for command in sorted(self.commands):
+                lines.append('{}: {} commands'.format(command, self.commands[command]))
+        return lines
+
+    def close(self):
+        pass
+
+
+class Clock:
+    """ Time source of the faults and the scheduler, the real wall clock.
+        Every wait of a fault goes through a clock so runs can be replayed faster than real time.
+        Time is the wall clock when the clock was created plus the monotonic time since, so
+        setting the wall clock during a run does not move the start of any fault
+    """
+
+    def __init__(self):
+        self.origin = time.time() - monotonic()
+
+    def __repr__(self):
+        return 'real'
+
+    def time(self):
+        return self.origin + monotonic()
+
+    def now(self):
+        return datetime.datetime.fromtimestamp(self.time())
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def wait(self, condition, seconds=None):
+        """ Waits on a held condition until it is notified or seconds of clock time have passed
+        """
+        condition.wait(seconds)
+
+    def stop(self):
+        pass
+
+
+class Scaled_clock(Clock):
+    """ Clock that runs speedup times faster than the wall clock from start onwards
+    """
+
+    def __init__(self, start, speedup):
+        Clock.__init__(self)
+        self.start = start
+        self.speedup = float(speedup)
+
+    def __repr__(self):
+        return 'x{:g}'.format(self.speedup)
+
+    def time(self):
+        return self.start + (Clock.time(self) - self.start) * self.speedup
+
+    def sleep(self, seconds):
+        time.sleep(seconds / self.speedup)
+
+    def wait(self, condition, seconds=None):
+        condition.wait(None if seconds is None else seconds / self.speedup)
+
+
+class Virtual_clock(Clock):
+    """ Clock that only moves while every thread using it is waiting.
+        Waiting threads are kept in a heap of wake up times, once no thread has started or
+        finished a wait for settle (real) seconds the clock jumps straight to the earliest
+        wake up time. A run takes as long as the work it does rather than the time it waits,
+        work that takes longer than settle without waiting lets the clock move on underneath it
+    """
+
+    def __init__(self, start, settle=0.02):
+        self.current = start
+        self.settle = settle
+        self.condition = threading.Condition()
+        # heap of (wake up time, sequence number, callback)
+        self.sleepers = []
+        self.sequence = 0
+        # bumped on every wait and wake up, the clock only advances while it stays the same
+        self.activity = 0
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __repr__(self):
+        return 'virtual'
+
+    def time(self):
+        with self.condition:
+            return self.current
+
+    def sleep(self, seconds):
+        event = threading.Event()
+        self.add(seconds, event.set)
+        event.wait()
+
+    def wait(self, condition, seconds=None):
+        if seconds is not None:
+            self.add(seconds, lambda: self.notify(condition))
+        condition.wait()
+
+    @staticmethod
+    def notify(condition):
+        with condition:
+            condition.notify_all()
+
+    def add(self, seconds, callback):
+        with self.condition:
+            heapq.heappush(self.sleepers, (self.current + max(0, seconds), self.sequence, callback))
+            self.sequence += 1
+            self.activity += 1
+
+    def run(self):
+        while not self.stopped:
+            with self.condition:
+                seen = self.activity
+            time.sleep(self.settle)
+            due = []
+            with self.condition:
+                if self.activity != seen or not self.sleepers:
+                    continue
+                self.current = max(self.current, self.sleepers[0][0])
+                while self.sleepers and self.sleepers[0][0] <= self.current:
+                    due.append(heapq.heappop(self.sleepers)[2])
+                self.activity += 1
+            # callbacks take other locks, so they run after releasing the clock's
+            for callback in due:
+                callback()
+
+    def stop(self):
+        self.stopped = True
+        while self.thread.is_alive():
+            self.thread.join(1)
+
+
+class Stopper:
+    """ Exit signal of the run, set by the signal handler.
+        Conditions subscribed to it are notified when it is set, so a thread waiting on one of
+        them through the clock wakes up right away instead of at the end of its wait
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.conditions = set()
+
+    def set(self):
+        self.event.set()
+        with self.lock:
+            conditions = list(self.conditions)
+        for condition in conditions:
+            with condition:
+                condition.notify_all()
+
+    def is_set(self):
+        return self.event.is_set()
+
+    def wait(self, timeout=None):
+        """ Waits up to timeout seconds of real time, returns whether the signal is set
+        """
+        return self.event.wait(timeout)
+
+    def subscribe(self, condition):
+        with self.lock:
+            self.conditions.add(condition)
+
+    def unsubscribe(self, condition):
+        with self.lock:
+            self.conditions.discard(condition)
+
+    def sleep(self, seconds):
+        """ Sleeps seconds of clock time, returns True as soon as the signal is set
+        """
+        condition = threading.Condition()
+        self.subscribe(condition)
+        try:
+            with condition:
+                deadline = clock.time() + seconds
+                while not self.is_set() and clock.time() < deadline:
+                    clock.wait(condition, deadline - clock.time())
+        finally:
+            self.unsubscribe(condition)
+        return self.is_set()
+
+
+class Barrier:
+    """ Blocks the threads calling wait() until parties of them have, then releases them all at once.
+        Python 2 has no threading.Barrier. Every party waits on its own Event without a timeout, which
+        blocks on a lock rather than polling every few milliseconds like a wait with a timeout does
+        under Python 2, so all parties are released right after the last one arrives
+    """
+
+    def __init__(self, parties):
+        self.parties = parties
+        self.lock = threading.Lock()
+        self.events = []
+
+    def wait(self):
+        event = threading.Event()
+        with self.lock:
+            self.events.append(event)
+            last = len(self.events) >= self.parties
+        if last:
+            for waiting in self.events:
+                waiting.set()
+        event.wait()
+
+
+class Scheduler:
+    """ Starts every worker of the injector and keeps track of them.
+        Timed starts are kept in a min-heap of due times, a single dispatcher thread
+        sleeps until the earliest one is due. Work runs on a pool of reusable threads
+        that only grows to the number of workers running at once, so the number of
+        threads follows the actual concurrency rather than the number of entries.
+        Finished workers notify the scheduler so waiting for them does not require
+        polling every thread
+    """
+
+    def __init__(self, idle_timeout=60):
+        self.condition = threading.Condition()
+        # heap of (due time, sequence number, function, args)
+        self.queue = []
+        self.sequence = 0
+        # work that is due and waiting for a pool thread
+        self.jobs = collections.deque()
+        # number of jobs handed out that have not finished yet
+        self.active = 0
+        # number of pool threads waiting for work
+        self.idle = 0
+        self.idle_timeout = idle_timeout  # seconds before an unused pool thread exits
+        # number of feeders still reading entries
+        self.feeding = 0
+        self.stopped = False
+        self.dispatcher = None
+
+    def schedule(self, due, function, args=()):
+        """ Runs function(*args) once clock.time() reaches due
+        """
+        with self.condition:
+            self.push(due, function, args)
+
+    def push(self, due, function, args):
+        # Must be called with the condition held
+        heapq.heappush(self.queue, (due, self.sequence, function, args))
+        self.sequence += 1
+        if self.dispatcher is None:
+            self.dispatcher = threading.Thread(target=self.dispatch)
+            self.dispatcher.daemon = True
+            self.dispatcher.start()
+        self.condition.notify_all()
+
+    def feed(self, entries, window=1000):
+        """ Schedules (due, function, args) entries from an iterable on a background thread,
+            keeping at most window entries queued so long files are never held in memory.
+            Entries only need to be roughly in order: any entry up to window places late
+            in the iterable is still started on time
+        """
+        with self.condition:
+            self.feeding += 1
+        feeder = threading.Thread(target=self.run_feeder, args=(entries, window))
+        feeder.daemon = True
+        feeder.start()
+
+    def run_feeder(self, entries, window):
+        try:
+            for due, function, args in entries:
+                with self.condition:
+                    while len(self.queue) >= window and not self.stopped:
+                        self.condition.wait()
+                    if self.stopped:
+                        return
+                    self.push(due, function, args)
+        finally:
+            with self.condition:
+                self.feeding -= 1
+                self.condition.notify_all()
+
+    def spawn(self, function, args=()):
+        """ Runs function(*args) right away
+        """
+        with self.condition:
+            self.start(function, args)
+
+    def start(self, function, args):
+        # Must be called with the condition held
+        self.active += 1
+        self.jobs.append((function, args))
+        if self.idle > len(self.jobs) - 1:
+            self.condition.notify_all()
+        else:
+            thread = threading.Thread(target=self.work)
+            thread.daemon = True
+            thread.start()
+
+    def work(self):
+        """ Loop of a pool thread, exits after sitting idle for idle_timeout seconds or once stopped
+        """
+        while True:
+            with self.condition:
+                if not self.jobs:
+                    self.idle += 1
+                    deadline = time.time() + self.idle_timeout
+                    while not self.jobs and not self.stopped and time.time() < deadline:
+                        self.condition.wait(deadline - time.time())
+                    self.idle -= 1
+                    if not self.jobs:
+                        self.condition.notify_all()
+                        return
+                function, args = self.jobs.popleft()
+            try:
+                function(*args)
+            except SystemExit:
+                pass
+            finally:
+                # records of the next job on this thread must not carry the old fault id
+                log.end_fault()
+                with self.condition:
+                    self.active -= 1
+                    self.condition.notify_all()
+
+    def dispatch(self):
+        with self.condition:
+            while True:
+                if not self.queue:
+                    self.condition.wait()
+                    continue
+                delay = self.queue[0][0] - clock.time()
+                if delay > 0:
+                    clock.wait(self.condition, delay)
+                    continue
+                due, sequence, function, args = heapq.heappop(self.queue)
+                self.start(function, args)
+                # lets a feeder waiting on a full window continue
+                self.condition.notify_all()
+
+    def stop(self):
+        """ Drops every start that is not due yet and stops all feeders and idle pool threads
+        """
+        with self.condition:
+            self.stopped = True
+            self.queue = []
+            self.jobs.clear()
+            self.condition.notify_all()
+
+    def shutdown(self):
+        """ Stops the scheduler and waits for the idle pool threads to exit
+        """
+        self.stop()
+        with self.condition:
+            while self.idle > 0:
+                self.condition.wait(1)
+
+    def wait_all(self):
+        """ Blocks until nothing is scheduled and every worker has finished
+        """
+        with self.condition:
+            while self.queue or self.feeding > 0 or self.active > 0:
+                # Waits with a timeout so the main thread still receives SIGINT under Python 2
+                self.condition.wait(1)
+
+
+class Deterministic_writer:
+    """ Writes the rows of a deterministic run file from a single thread.
+        Fault threads only put their results on a queue, so rows can not interleave.
+        The file is flushed and fsynced once per batch, a batch ends after batch_size rows
+        or sync_interval seconds, whichever comes first. close() syncs what is left
+    """
+
+    row = "{:6}{:2}{:18}{:2}{:18}{:2}{:18}{:2}{:18}{:2}{:4}{:2}{:12}"  # build formatter string
+
+    def __init__(self, filename, sync_interval=1, batch_size=64):
+        self.filename = filename
+        self.file = open(filename, 'w')
+        self.sync_interval = sync_interval
+        self.batch_size = batch_size
+        self.queue = Queue.Queue()
+        self.rows = 0
+        self.syncs = 0
+        # (start offset, byte position, line number) of every row, written as the index of the file on close
+        self.index = []
+        self.closed = False
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write_row(self, plugin, result):
+        """ Queues the result of a fault function as one row of the file
+        """
+        self.queue.put(self.row.format(plugin, ' | ', result[0], ' | ', result[1], ' | ', result[2], ' | ',
+                                       result[3], ' | ', result[4], ' | ', result[5]) + '\n')
+
+    def run(self):
+        pending = 0
+        while True:
+            # wait for a row, without a batch in progress there is nothing to sync
+            try:
+                if pending == 0:
+                    line = self.queue.get()
+                else:
+                    line = self.queue.get(timeout=max(0, deadline - time.time()))
+            except Queue.Empty:
+                line = ''
+            if line is None:
+                break
+            if line:
+                if pending == 0:
+                    deadline = time.time() + self.sync_interval
+                position = self.file.tell()
+                self.file.write(line)
+                pending += 1
+                self.rows += 1
+                try:
+                    self.index.append((Replay_plan.offset(line.split('|')[3].replace(' ', '')), position, self.rows))
+                except (ValueError, IndexError):
+                    pass
+            if pending > 0 and (pending >= self.batch_size or time.time() >= deadline):
+                self.sync()
+                pending = 0
+        if pending > 0:
+            self.sync()
+        self.file.close()
+        try:
+            Replay_index(self.filename).write(self.index)
+        except (IOError, OSError) as e:
+            log.event('writer', 'index not written: {}'.format(e))
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.syncs += 1
+
+    def close(self):
+        """ Writes out all queued rows and closes the file, safe to call more than once
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        while self.thread.is_alive():
+            # join with a timeout so the main thread still receives SIGINT under Python 2
+            self.thread.join(1)
+        log.event('writer', '{} rows written with {} syncs'.format(self.rows, self.syncs))
+
+
+
+class Replay_index:
+    """ Sidecar index of a deterministic file, written to <file>.idx, so a time window of a long
+        file can be replayed without reading the rest of it. The index holds one fixed width record
+        per row sorted by start offset: the offset, the byte position of the row and its line number.
+        A window is found by binary search over the records. The first record holds the size and
+        modification time of the file the index was built from, so an outdated index can be told apart
+    """
+
+    record = '{:15.3f} {:15d} {:10d}\n'
+    header = '{:15d} {:15d} {:10d}\n'  # file size, file modification time, number of records
+    width = 43
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.path = filepath + '.idx'
+
+    def is_current(self):
+        try:
+            with open(self.path) as f:
+                fields = f.readline().split()
+        except IOError:
+            return False
+        stat = os.stat(self.filepath)
+        return len(fields) == 3 and int(fields[0]) == stat.st_size and int(fields[1]) == int(stat.st_mtime)
+
+    def build(self):
+        """ Reads the file once and writes its index, returns the number of rows indexed.
+            Rows without a valid start time are left out, they are in no window
+        """
+        entries = []
+        with open(self.filepath, 'rb') as f:
+            position = 0
+            number = 0
+            # readline rather than iterating, which reads ahead and hides the position of each row
+            for line in iter(f.readline, ''):
+                number += 1
+                try:
+                    entries.append((Replay_plan.offset(line.split('|')[3].replace(' ', '')), position, number))
+                except (ValueError, IndexError):
+                    pass
+                position += len(line)
+        self.write(entries)
+        return len(entries)
+
+    def write(self, entries):
+        """ Writes (start offset, byte position, line number) entries through a temporary file
+        """
+        entries = sorted(entries)
+        stat = os.stat(self.filepath)
+        with open(self.path + '.tmp', 'w') as f:
+            f.write(self.header.format(stat.st_size, int(stat.st_mtime), len(entries)))
+            for entry in entries:
+                f.write(self.record.format(*entry))
+        os.rename(self.path + '.tmp', self.path)
+
+    def window(self, start=None, end=None):
+        """ Yields (line number, row) of every row that starts between start and end seconds in order of start,
+            only the records of the window are read besides the ones the binary search looks at
+        """
+        with open(self.path, 'rb') as index:
+            count = int(index.readline().split()[2])
+
+            def offset_at(i):
+                index.seek((i + 1) * self.width)
+                return float(index.read(self.width).split()[0])
+
+            low, high = 0, count
+            if start is not None:
+                while low < high:
+                    middle = (low + high) // 2
+                    if offset_at(middle) < start:
+                        low = middle + 1
+                    else:
+                        high = middle
+
+            index.seek((low + 1) * self.width)
+            with open(self.filepath, 'rb') as rows:
+                for i in range(low, count):
+                    offset, position, number = index.read(self.width).split()
+                    if end is not None and float(offset) > end:
+                        break
+                    rows.seek(int(position))
+                    yield int(number), rows.readline()
+
+
+class Replay_plan:
+    """ A deterministic file checked ahead of its replay.
+        compile() reads the file once and checks every row before anything is started: the plugin,
+        the start time, the fault, its targets and fields. Rows are not kept, only the targets, and
+        every target is probed and connected to over the ssh pool.
+        start() then reads the file again on the scheduler's feeder, each row becomes a function with
+        its targets resolved and crash steps prepared by its plugin as the feeder pulls it, at most
+        the feed window ahead of its start, so memory does not grow with the length of the file.
+        Faults are scheduled relative to the clock time start() is called at, so the checks do not
+        delay them. Every fault logs its planned and actual start
+    """
+
+    def __init__(self, plugins, warm_workers=32):
+        self.plugins = dict((plugin.__repr__(), plugin) for plugin in plugins)
+        self.warm_workers = warm_workers  # targets connected to at once
+        # file and (start, end) window in seconds of the recorded run being replayed
+        self.filepath = None
+        self.window = (None, None)
+        # number of rows that passed the checks
+        self.count = 0
+        # 'line N: reason' of every row that can not be replayed
+        self.errors = []
+        self.hosts = set()
+        self.reachable = 0
+        self.connected = 0
+        self.base = None
+        # seconds into the recorded run of the first fault of a window, the replay starts there
+        self.shift = 0
+        self.lock = threading.Lock()
+        # seconds every fault started after its planned start
+        self.drifts = []
+
+    @staticmethod
+    def offset(text):
+        """ [N days,]h:mm[:ss[.ffffff]] without spaces -> seconds. Start times of runs longer than
+            a day are written with a day count, e.g. 2days,1:00:05
+        """
+        days = 0
+        if ',' in text:
+            days, text = text.split(',')
+            days = int(days.replace('days', '').replace('day', ''))
+        fields = text.split(':')
+        if len(fields) == 2:
+            fields.append('0')
+        hours, minutes, seconds = fields
+        return days * 86400 + int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+    def compile(self, filepath, start=None, end=None):
+        """ Reads and checks the rows of filepath in one pass, returns False if any row is invalid.
+            With start or end (seconds into the recorded run) only the rows starting in that window
+            are read through the index of the file, and the first fault of the window starts right away
+        """
+        self.filepath = filepath
+        self.window = (start, end)
+        first = None
+        for number, words in self.rows():
+            try:
+                plugin, offset = self.resolve(words)
+                plugin.compile(words, prepare=False)
+            except (ValueError, IndexError) as e:
+                self.errors.append('line {}: {}'.format(number, e))
+                continue
+            self.count += 1
+            self.hosts.update(words[2].split(','))
+            first = offset if first is None else min(first, offset)
+
+        # a window is replayed from its first fault rather than from where it was cut
+        if (start is not None or end is not None) and first is not None:
+            self.shift = first
+
+        if self.errors:
+            return False
+        self.warm(sorted(self.hosts))
+        return True
+
+    def rows(self):
+        """ Yields (line number, fields) of every row to replay, with the filler characters stripped off
+        """
+        for number, line in self.lines(self.filepath, *self.window):
+            if not line.strip():
+                continue
+            yield number, [word.replace(' ', '').replace('\n', '') for word in line.split('|')]
+
+    def resolve(self, words):
+        """ Returns the plugin and the start offset of a row, raises ValueError if either is invalid
+        """
+        plugin = self.plugins.get(words[0])
+        if plugin is None:
+            raise ValueError('no plugin named {}'.format(words[0]))
+        try:
+            return plugin, self.offset(words[3])
+        except (ValueError, IndexError):
+            raise ValueError('invalid start time')
+
+    def lines(self, filepath, start, end):
+        """ Yields (line number, row) of the rows to replay
+        """
+        if start is None and end is None:
+            with open(filepath) as f:
+                for number, line in enumerate(f, 1):
+                    yield number, line
+            return
+        index = Replay_index(filepath)
+        if not index.is_current():
+            begin = time.time()
+            count = index.build()
+            print 'Indexed {} rows of {} in {:.2f}s'.format(count, filepath, time.time() - begin)
+            log.event('deterministic-mode', 'indexed {} rows in {:.2f}s'.format(count, time.time() - begin))
+        for number, line in index.window(start, end):
+            yield number, line
+
+    def warm(self, hosts):
+        """ Probes the hosts and opens a pooled ssh connection to every reachable one
+        """
+        def connect(host):
+            if not prober.is_reachable(host):
+                return False
+            ssh_pool.exec_command(host, 'true', timeout=30)
+            return True
+
+        for i in range(0, len(hosts), self.warm_workers):
+            batch = hosts[i:i + self.warm_workers]
+            results = in_parallel([lambda host=host: connect(host) for host in batch], 'deterministic-mode')
+            for host, result in zip(batch, results):
+                # None is a reachable host that could not be connected to
+                if result is False:
+                    log.event('deterministic-mode', 'target is unreachable', node=host)
+                    continue
+                self.reachable += 1
+                if result:
+                    self.connected += 1
+
+    def start(self):
+        """ Schedules every fault, start offsets count from now
+        """
+        self.base = clock.time()
+        scheduler.feed(self.entries())
+
+    def entries(self):
+        """ Yields the scheduler entry of every row, rows are only prepared as the feeder pulls them
+        """
+        for number, words in self.rows():
+            try:
+                plugin, offset = self.resolve(words)
+                function = plugin.compile(words)
+            except (ValueError, IndexError) as e:
+                # only if the file changed after compile() checked it
+                log.event('deterministic-mode', 'line {}: {}, skipping it'.format(number, e))
+                continue
+            offset -= self.shift
+            yield self.base + offset, self.fire, (offset, number, words[1], words[2], function)
+
+    def fire(self, offset, number, name, host, function):
+        started = clock.time() - self.base
+        drift = started - offset
+        with self.lock:
+            self.drifts.append(drift)
+        log.event('deterministic-mode', 'line {} {} planned at {:.3f}s, started at {:.3f}s ({:+.1f}ms)'
+                  .format(number, name, offset, started, drift * 1000), node=host, phase='start')
+        function()
+
+    def summary(self):
+        lines = ['{} faults compiled, {} targets of which {} reachable and {} connected to'
+                 .format(self.count, len(self.hosts), self.reachable, self.connected)]
+        with self.lock:
+            drifts = sorted(self.drifts)
+        if drifts:
+            lines.append('{} faults started, drift from the planned start: median {:.1f}ms, p99 {:.1f}ms, '
+                         'max {:.1f}ms'.format(len(drifts), drifts[len(drifts) // 2] * 1000,
+                                               drifts[min(len(drifts) - 1, int(len(drifts) * 0.99))] * 1000,
+                                               drifts[-1] * 1000))
+        return lines
+
+
+class Event_log:
+    """ Structured log of the injector, written as one JSON object per line.
+        Threads only put records on a queue and never wait for the disk, a single writer
+        thread serializes them. Every record carries a monotonic timestamp and the id of the
+        fault the calling thread is working on. The file is rotated once it grows past
+        max_bytes, rotated files are gzipped and only the newest backups are kept
+    """
+
+    def __init__(self, filename, max_bytes=10 * 1024 * 1024, backups=5, max_queued=100000):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.queue = Queue.Queue(max_queued)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.next_fault_id = 1
+        self.dropped = 0
+        self.file = None
+        self.thread = None
+
+    def start(self):
+        """ Opens the log file and starts the writer thread, records made before are kept
+        """
+        self.file = open(self.filename, 'a')
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def begin_fault(self):
+        """ Gives the calling thread a new fault id, which is added to all its records until the next one
+        """
+        with self.lock:
+            self.local.fault_id = self.next_fault_id
+            self.next_fault_id += 1
+        return self.local.fault_id
+
+    def end_fault(self):
+        self.local.fault_id = None
+
+    def event(self, source, message, node=None, phase=None):
+        """ Queues a record, never blocks, drops the record if the writer has fallen too far behind
+        """
+        record = collections.OrderedDict([
+            ('time', '{:%Y-%m-%d %H:%M:%S.%f}'.format(datetime.datetime.now())),
+            ('monotonic', round(monotonic(), 6)),
+            ('source', source),
+            ('fault_id', getattr(self.local, 'fault_id', None)),
+            ('phase', phase),
+            ('node', node),
+            ('message', message)])
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            with self.lock:
+                self.dropped += 1
+
+    def run(self):
+        size = os.path.getsize(self.filename)
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            line = json.dumps(record) + '\n'
+            if size > 0 and size + len(line) > self.max_bytes:
+                self.rotate()
+                size = 0
+            self.file.write(line)
+            size += len(line)
+            # flush once the queue has been drained rather than after every record
+            if self.queue.empty():
+                self.file.flush()
+        if self.dropped:
+            self.file.write(json.dumps(collections.OrderedDict([
+                ('time', '{:%Y-%m-%d %H:%M:%S.%f}'.format(datetime.datetime.now())),
+                ('monotonic', round(monotonic(), 6)), ('source', 'log'),
+                ('message', '{} records dropped'.format(self.dropped))])) + '\n')
+        self.file.close()
+
+    def rotate(self):
+        """ Moves FaultInjector.log to FaultInjector.log.1.gz, shifting older backups up by one
+        """
+        self.file.close()
+        for i in range(self.backups - 1, 0, -1):
+            older = '{}.{}.gz'.format(self.filename, i)
+            if os.path.exists(older):
+                os.rename(older, '{}.{}.gz'.format(self.filename, i + 1))
+        with open(self.filename, 'rb') as source:
+            with gzip.open(self.filename + '.1.gz', 'wb') as target:
+                shutil.copyfileobj(source, target)
+        self.file = open(self.filename, 'w')
+
+    def close(self):
+        """ Writes out all queued records and closes the file, safe to call more than once
+        """
+        if self.thread is None or not self.thread.is_alive():
+            return
+        self.queue.put(None)
+        while self.thread.is_alive():
+            # join with a timeout so the main thread still receives SIGINT under Python 2
+            self.thread.join(1)
+
+
+class Timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+def load_clock_gettime():
+    """ Returns clock_gettime from the C library, None if it can not be found
+    """
+    for library in ('librt.so.1', 'libc.so.6'):
+        try:
+            function = ctypes.CDLL(library, use_errno=True).clock_gettime
+        except (OSError, AttributeError):
+            continue
+        function.argtypes = [ctypes.c_int, ctypes.POINTER(Timespec)]
+        return function
+    return None
+
+
+clock_gettime = load_clock_gettime()
+
+
+def monotonic():
+    """ Seconds from CLOCK_MONOTONIC, which does not jump when the wall clock is changed.
+        Falls back to the wall clock where clock_gettime is not available
+    """
+    if clock_gettime is None:
+        return time.time()
+    timespec = Timespec()
+    if clock_gettime(1, ctypes.byref(timespec)) != 0:  # 1 is CLOCK_MONOTONIC on linux
+        return time.time()
+    return timespec.tv_sec + timespec.tv_nsec / 1000000000.0
+
+
+def in_parallel(functions, source):
+    """ Calls every function on its own thread and returns their results once all have returned,
+        the result of a function that raised is None and the error is logged under source
+    """
+    results = [None] * len(functions)
+
+    def run(i):
+        try:
+            results[i] = functions[i]()
+        except Exception as e:
+            log.event(source, 'step failed: {}'.format(str(e) or e.__class__.__name__))
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(len(functions))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def fingerprint(value):
+    """ Short hash of anything that can be dumped as json, equal values give equal fingerprints
+    """
+    return hashlib.sha1(json.dumps(value, sort_keys=True)).hexdigest()[:16]
+
+
+def parse_nova_list(lines):
+    """ Parses the ctlplane rows of 'nova list' into {id: {node_type, node_ip, node_name}}
+        Returns None if the output is not a nova table
+    """
+    lines = filter(None, lines)
+    if not lines or '|' not in lines[0]:
+        return None
+    nodes = {}
+    for line in lines:
+        node_fields = line[1:-1].split('|')
+        node_id = node_fields[0].strip()
+        node_type = node_fields[1].partition('-')[-1].rpartition('-')[0]
+        node_name = node_fields[1].partition('-')[-1].rpartition(' ')[0].strip()
+        node_ip = node_fields[5].partition('=')[-1].strip()
+        nodes[node_id] = {'node_type': node_type, 'node_ip': node_ip, 'node_name': node_name}
+    return nodes
+
+
+def config_is_stale(deployment):
+    """ Compares the nodes nova lists now with the fingerprint setup.py stored in config.yaml.
+        Returns None when there is nothing to compare against or nova can not be asked
+    """
+    if 'nodes' not in deployment.fingerprints:
+        return None
+    try:
+        nodes = nova.nodes(0)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    if nodes is None:
+        return None
+    return fingerprint(nodes) != deployment.fingerprints['nodes']
+
+
+# global var for start time of program
+global_starttime = datetime.datetime.now()
+
+# global clock used for every wait of the faults and the scheduler, chosen in main()
+clock = Clock()
+
+# global structured log, the file is opened in main()
+log = Event_log('FaultInjector.log')
+
+# global list of all plugins
+plugins = []
+
+# global scheduler that starts and keeps track of all threads
+scheduler = Scheduler()
+
+# global exit signal for threads
+stopper = Stopper()
+
+# global admission controller deciding which faults fit in the time limit
+admission = Admission_controller()
+
+# global pool of ssh connections shared by all threads
+ssh_pool = SSH_pool()
+
+# global executor that runs crash and restore steps, chosen in main()
+executor = None
+
+# global prober that tracks which nodes are reachable, started in main()
+prober = None
+
+# global simulated cluster, only set when running with --simulate
+simulator = None
+
+# global nova client, chosen in main()
+nova = None
+
+# global watcher of the ceph cluster state, started in main() for ceph deployments
+ceph_watcher = None
+
+# global longest time in minutes a fault waits for its target to recover (-rt), set in main()
+recovery_time = None
+
+# global writer for the deterministic file of a stateful or stateless run
+deterministic_writer = None
+
+# global restorer run by the signal handler, created in main()
+restorer = None
+
+
+def main():
+    fault_injector_title = """
+ _________________________________________________________________________
+|                                                                         |
+|      ______            ____     ____        _           __              |
+|     / ____/___ ___  __/ / /_   /  _/___    (_)__  _____/ /_____  _____  |
+|    / /_  / __ `/ / / / / __/   / // __ \  / / _ \/ ___/ __/ __ \/ ___/  |
+|   / __/ / /_/ / /_/ / / /_   _/ // / / / / /  __/ /__/ /_/ /_/ / /      |
+|  /_/    \__,_/\__,_/_/\__/  /___/_/ /_/_/ /\___/\___/\__/\____/_/       |
+|                                      /___/                              |
+|_________________________________________________________________________|  
+
+    """
+    print fault_injector_title
+    global timeout
+    global timelimit
+    global fault_time
+    global recovery_time
+    global variability
+    global executor
+    global prober
+    global clock
+    global simulator
+    global ssh_pool
+    global ceph_watcher
+    global restorer
+    global nova
+    deployment = Deployment('config.yaml')
+    paramiko.util.log_to_file(".paramiko.log")
+
+    # create list of all plugins and one node_fault instance
+    plugins.append(Ceph(deployment))
+    plugins.append(Node_fault(deployment))
+    # plugins.append()
+    node_fault = Node_fault(deployment)
+
+    # start injector
+    log.start()
+    log.event('injector', 'Fault Injector Started')
+
+    # create argument parser
+    parser = argparse.ArgumentParser(description='Fault Injector')
+
+    parser.add_argument('-sf', '--stateful', help='injector will run in stateful \
+                            random mode', required=False, action='store_true')
+
+    parser.add_argument('-sl', '--stateless', help='injector will run in stateless \
+                            mode with specified number of faults', required=False,
+                        type=int, nargs=1, dest='numfaults')
 
     parser.add_argument('-ex', '--exclude',
                         help='exclude node(s) by name in stateless mode (for the purpose of monitoring)',
@@ -1123,24 +3556,109 @@ def main():
     parser.add_argument('-tg', '--target', help='specific a node type that will be the target of stateless faults',
                         required=False, type=str, nargs=1, default=None, dest='target')
 
+    parser.add_argument('-cf', '--correlated', help='stateless faults crash every node of a group at the same \
+                            moment instead of a single node, groups are selected by type:<text>, \
+                            names:<name>,<name>, domain:<failure domain> or domain (one group per failure domain)',
+                        required=False, type=str, nargs='+', default=None, dest='correlated')
+
     parser.add_argument('-d', '--deterministic', help='injector will follow the \
                          list of tasks in the file specified', action='store',
                         nargs=1, dest='filepath')
 
+    parser.add_argument('-fr', '--from', help='only replay the faults of the deterministic file that start at or \
+                         after this time of the recorded run ([days,]h:mm[:ss]), the first one starts right away',
+                        required=False, type=str, dest='window_from')
+
+    parser.add_argument('-to', '--to', help='only replay the faults of the deterministic file that start at or \
+                         before this time of the recorded run ([days,]h:mm[:ss]), the first one starts right away',
+                        required=False, type=str, dest='window_to')
+
     parser.add_argument('-t', '--timelimit', help='timelimit for injector to run \
                          (mins)', required=False, type=int)
 
     parser.add_argument('-ft', '--fault_time', help='amount of time faults are active for \
                              (mins)', required=False, type=int)
 
-    parser.add_argument('-rt', '--recovery_time', help='amount of time to give faults to recover \
-                             (mins)', required=False, type=int)
+    parser.add_argument('-rt', '--recovery_time', help='maximum amount of time to give faults to recover, \
+                             a fault ends as soon as its target has recovered (mins)', required=False, type=int)
 
     parser.add_argument('-v', '--variability', help='range of time that can be added to fault time and recovery time \
                              (mins)', required=False, type=int)
 
+    parser.add_argument('-e', '--executor', help='how crash and restore steps are run: by spawning ansible-playbook \
+                             or directly over pooled ssh connections', required=False, choices=['ansible', 'ssh'],
+                        default='ansible')
+
+    parser.add_argument('-s', '--speedup', help='run the clock of the faults N times faster than real time, \
+                             mostly useful to replay a deterministic file in less time', required=False, type=float)
+
+    parser.add_argument('-vc', '--virtual-clock', help='run on a virtual clock that skips ahead whenever every \
+                             fault is waiting (for testing against a stand-in backend)', required=False,
+                        action='store_true', dest='virtual_clock')
+
+    parser.add_argument('-sim', '--simulate', help='run against an in-process simulation of the deployment in \
+                             config.yaml instead of the deployment itself', required=False, action='store_true')
+
+    parser.add_argument('-rw', '--restore-workers', help='number of nodes restored at once after ctrl-c \
+                             (default: 8)', required=False, type=int, default=8, dest='restore_workers')
+
     args = parser.parse_args()
 
+    # Clock used for all waits, the run starts at global_starttime on every clock
+    start = time.mktime(global_starttime.timetuple()) + global_starttime.microsecond / 1000000.0
+    if args.virtual_clock:
+        clock = Virtual_clock(start)
+        # its thread is stopped on every exit, including the ones on invalid flags below
+        atexit.register(clock.stop)
+    elif args.speedup is not None:
+        if args.speedup <= 0:
+            sys.exit('Speedup must be greater than 0')
+        clock = Scaled_clock(start, args.speedup)
+    if args.virtual_clock or args.speedup is not None:
+        log.event('injector', 'Running on the {} clock'.format(clock.__repr__()))
+        print 'Running on the {} clock\n'.format(clock.__repr__())
+
+    # Backend that runs crash and restore steps
+    if args.simulate:
+        # the simulated cluster answers everything that would go to the deployment
+        simulator = Simulated_cluster(deployment)
+        executor = Simulated_executor(simulator)
+        ssh_pool = simulator
+        prober = simulator
+        nova = simulator
+        log.event('injector', 'Simulating the deployment in config.yaml')
+        print 'Simulating the deployment in config.yaml\n'
+    else:
+        nova = Nova_client()
+        if args.executor == 'ssh':
+            executor = SSH_executor(ssh_pool)
+        else:
+            executor = Ansible_executor(Playbooks('playbooks/'))
+
+    # Warn if the deployment has changed since setup.py wrote config.yaml
+    if not args.simulate and config_is_stale(deployment):
+        log.event('injector', 'config.yaml is stale, the nodes in nova have changed since setup.py ran')
+        print 'Warning: config.yaml is stale, the nodes in nova have changed since setup.py ran.\n' \
+              'Run ./setup.py --refresh to update it\n'
+
+    # Start probing the nodes in the background
+    if prober is None:
+        prober = Reachability_prober([node.ip for node in deployment.nodes])
+    prober.start()
+    nova.start()
+
+    # One view of the ceph cluster shared by every ceph fault
+    if deployment.ceph:
+        ceph_watcher = Ceph_watcher(deployment)
+        ceph_watcher.start()
+        atexit.register(ceph_watcher.stop)
+
+    # Used by the signal handler to bring the deployment back
+    restorer = Restorer(deployment, args.restore_workers)
+
+    # signal handler to restore everything to normal
+    signal.signal(signal.SIGINT, signal_handler)
+
     # Time management arguments
     fault_time = args.fault_time
     recovery_time = args.recovery_time
@@ -1149,13 +3667,21 @@ def main():
 
 
     # check mode
+    if (args.window_from is not None or args.window_to is not None) and not args.filepath:
+        print 'Time window only applicable in deterministic mode'
     if args.timelimit is None:
         timelimit = sys.maxsize
         timeout = sys.maxsize
     if args.filepath:
         if args.timelimit:
             print 'Time Limit not applicable in deterministic mode'
-        deterministic_start(args.filepath)
+        window = []
+        for flag, text in (('--from', args.window_from), ('--to', args.window_to)):
+            try:
+                window.append(None if text is None else Replay_plan.offset(text.replace(' ', '')))
+            except ValueError:
+                sys.exit('Invalid {} time "{}", expected [days,]h:mm[:ss]'.format(flag, text))
+        deterministic_start(args.filepath, window[0], window[1])
     elif args.stateful:
         if recovery_time < 1:
             sys.exit("Recovery time must be at least 1 minute")
@@ -1164,7 +3690,7 @@ def main():
         else:
             if args.timelimit is not None:
                 timelimit = args.timelimit
-                timeout = time.time() + (timelimit * 60)
+                timeout = clock.time() + (timelimit * 60)
             if (fault_time is None) or (recovery_time is None):
                 sys.exit('fault time/recovery time flags are required to run stateful mode!')
             stateful_start()
@@ -1172,37 +3698,36 @@ def main():
         if recovery_time < 1:
             sys.exit("Recovery time must be at least 1 minute")
         if args.exclude is not None:  # User provided a node name to exclude
-            log.write(
-                '{:%Y-%m-%d %H:%M:%S} Excluding {} from faults\n'.format(datetime.datetime.now(), args.exclude[0]))
-            print 'Excluding {} from faults\n'.format(args.exclude[0])
-            # Iterate through the deployment's node list and exclude any nodes specified in the passed in
-            # exclusion nodes
-            new_node_list = []
-            for node in deployment.nodes:
-                exclude = False
-                for excluded_node in args.exclude:
-                    if node[0].name == excluded_node:
-                        exclude = True
-                        break
-                if not exclude:
-                    new_node_list.append(node)
-            deployment.nodes = new_node_list
+            log.event('injector', 'Excluding {} from faults'.format(', '.join(args.exclude)))
+            print 'Excluding {} from faults\n'.format(', '.join(args.exclude))
+            # Drop the excluded nodes (looked up by name) from the deployment
+            deployment.exclude(args.exclude)
 
         if args.target is not None:  # User provided a target
             # Construct and replace deployment's node list to only include those targeted by the -tg flag
-            log.write('{:%Y-%m-%d %H:%M:%S} Targeting nodes including "{}" in the type\n'
-                      .format(datetime.datetime.now(), args.target))
-            print 'Targeting nodes including "{}" in the type\n'.format(args.target)
-            new_node_list = []
-            for node in deployment.nodes:
-                if args.target in node[0].type:
-                    new_node_list.append(node)
-            deployment.nodes = new_node_list
-            if len(new_node_list) < args.numfaults[0]:
+            log.event('injector', 'Targeting nodes including "{}" in the type'.format(args.target[0]))
+            print 'Targeting nodes including "{}" in the type\n'.format(args.target[0])
+            deployment.restrict(args.target[0])
+            if len(deployment.nodes) < args.numfaults[0]:
                 sys.exit('Not enough nodes fit the target provided by the -tg flag, exiting...')
+
+        if args.correlated is not None:  # User chose correlated faults
+            groups = []
+            for selector in args.correlated:
+                selected = deployment.groups(selector)
+                if selected is None:
+                    sys.exit('Unknown selector "{}" for the -cf flag, exiting...'.format(selector))
+                groups.extend(group for group in selected if group)
+            if not groups:
+                sys.exit('No nodes fit the groups provided by the -cf flag, exiting...')
+            for group in groups:
+                log.event('injector', 'Correlated faults on {}'.format(', '.join(node.name for node in group)))
+                print 'Correlated faults on {}'.format(', '.join(node.name for node in group))
+            print ''
+            node_fault.correlate(groups)
         if args.timelimit is not None:
             timelimit = args.timelimit
-            timeout = time.time() + (timelimit * 60)
+            timeout = clock.time() + (timelimit * 60)
         if (fault_time is None) or (recovery_time is None):
             sys.exit('fault time/recovery time flags are required to run stateful mode!')
         stateless_start(node_fault, args.numfaults[0])
@@ -1210,43 +3735,63 @@ def main():
     else:
         print 'No Mode Chosen'
 
+    # record step timings and ssh connection counters and close the pool
+    if executor is not None:
+        for line in executor.summary():
+            log.event('executor', line)
+    for line in ssh_pool.summary():
+        log.event('ssh-pool', line)
+    if nova is not None and nova is not simulator:
+        for line in nova.summary():
+            log.event('nova', line)
+        nova.close()
+    if ceph_watcher is not None:
+        ceph_watcher.stop()
+        for line in ceph_watcher.summary():
+            log.event('ceph-watcher', line)
+    ssh_pool.close()
+    scheduler.shutdown()
+    clock.stop()
+
     # end injector
     print '\n+-------------------------+\n| Fault Injector Finished |\n+-------------------------+\n'
-    log.write('{:%Y-%m-%d %H:%M:%S} Fault Injector Finished\n'.format(datetime.datetime.now()))
+    log.event('injector', 'Fault Injector Finished')
     log.close()
 
 
-def deterministic_start(filepath):
-    """ func that will read deterministic log
-        will create all threads (one per entry in log) and spawn them
-        will wait for all threads to complete
+def deterministic_start(filepath, window_start=None, window_end=None):
+    """ func that will compile the deterministic log into a replay plan
+        every row is checked and prepared before the first fault is started
+        with a window only the faults starting in it are replayed, the first one starting now
+        will wait for all faults to complete
     """
-    log.write('{:%Y-%m-%d %H:%M:%S} Deterministic Mode Started\n'.format(datetime.datetime.now()))
-
-    # open file
-    with open(filepath[0]) as f:
-        # read line by line
-        for line in f:
-            # break into list and strip off filler characters
-            words = line.split('|')
-            words = [word.replace(' ', '').replace('\n', '') for word in words]
-            # find matching plugin
-            for plugin in plugins:
-                if plugin.__repr__() == words[0].strip(' '):
-                    # create thread
-                    threads.append(threading.Thread(target=plugin.deterministic, args=(words,)))
-
-    # start all threads
-    for thread in threads:
-        thread.start()
-    # wait for all threads to end
-    not_done = True
-    while not_done:
-        not_done = False
-        for thread in threads:
-            if thread.isAlive():
-                not_done = True
-        time.sleep(1)
+    log.event('injector', 'Deterministic Mode Started')
+    if window_start is not None or window_end is not None:
+        window = '{} to {}'.format(datetime.timedelta(seconds=window_start or 0),
+                                   'the end' if window_end is None else datetime.timedelta(seconds=window_end))
+        log.event('deterministic-mode', 'replaying {} of the recorded run'.format(window))
+        print 'Replaying {} of the recorded run\n'.format(window)
+
+    plan = Replay_plan(plugins)
+    start = time.time()
+    if not plan.compile(filepath[0], window_start, window_end):
+        for error in plan.errors:
+            print error
+            log.event('deterministic-mode', error)
+        print '{} invalid rows in {}, nothing was replayed'.format(len(plan.errors), filepath[0])
+        log.event('deterministic-mode', '{} invalid rows, nothing was replayed'.format(len(plan.errors)))
+        return
+    log.event('deterministic-mode', 'compiled in {:.2f}s'.format(time.time() - start))
+
+    # only the entries waiting for their start time are held by the scheduler
+    plan.start()
+
+    # wait for all faults to end
+    scheduler.wait_all()
+
+    for line in plan.summary():
+        print line
+        log.event('deterministic-mode', line)
 
 
 def stateful_start(target=None):
@@ -1255,14 +3800,15 @@ def stateful_start(target=None):
         will spawn all threads
         will wait for all threads to complete or for ctrl-c
     """
-    log.write('{:%Y-%m-%d %H:%M:%S} Stateful Mode Started\n'.format(datetime.datetime.now()))
+    global deterministic_writer
+    log.event('injector', 'Stateful Mode Started')
     print 'Stateful Mode Selected'
 
     if timelimit == sys.maxsize:  # No time limit provided by the user
-        log.write('{:%Y-%m-%d %H:%M:%S} Indefinite Timelimit\n'.format(datetime.datetime.now()))
+        log.event('injector', 'Indefinite Timelimit')
         print 'Indefinite Time Limit: Press ctrl-c to quit at any time\n'
     else:
-        log.write('{:%Y-%m-%d %H:%M:%S} {} Minute Timelimit\n'.format(datetime.datetime.now(), timelimit))
+        log.event('injector', '{} Minute Timelimit'.format(timelimit))
         print '{} Minute Time Limit: Press ctrl-c to quit at any time\n'.format(timelimit)
 
         # writes a file that can feed into a deterministic run
@@ -1271,29 +3817,21 @@ def stateful_start(target=None):
     if not os.path.exists(dir_path):
         os.makedirs(dir_path)
     deterministic_filename = dir_path + str(global_starttime).replace(' ', '_') + '-run.txt'
-    deterministic_file = open(deterministic_filename, 'w')
+    deterministic_writer = Deterministic_writer(deterministic_filename)
 
     # create thread for every plugin
-    stateful_threads = []
-
     for plugin in plugins:
         if plugin.__repr__() != 'Node_fault':
-            thread = threading.Thread(target=plugin.stateful, args=(deterministic_file,))
-            stateful_threads.append(thread)
-            threads.append(thread)
+            scheduler.spawn(plugin.stateful, (deterministic_writer,))
 
-    # start all threads
-    for thread in stateful_threads:
-        thread.start()
+    # wait for all threads (including the ones the plugins start) to end
+    scheduler.wait_all()
 
-    # wait for all threads to end
-    not_done = True
-    while not_done:
-        not_done = False
-        for thread in threads:
-            if thread.isAlive():
-                not_done = True
-        time.sleep(1)
+    deterministic_writer.close()
+
+    for line in admission.summary():
+        print line
+        log.event('stateful-mode', line)
 
 
 def stateless_start(node_fault, numfaults):
@@ -1301,14 +3839,15 @@ def stateless_start(node_fault, numfaults):
         will run Node_fault stateless mode on main thread
         will pass the time limit (could be infinity)
     """
-    log.write('{:%Y-%m-%d %H:%M:%S} Stateless Mode Started\n'.format(datetime.datetime.now()))
+    global deterministic_writer
+    log.event('injector', 'Stateless Mode Started')
     print 'Beginning Node Stateless Mode'
 
     if timelimit == sys.maxsize:  # No time limit provided by user
-        log.write('{:%Y-%m-%d %H:%M:%S} Indefinite Time Limit Enabled\n'.format(datetime.datetime.now()))
+        log.event('injector', 'Indefinite Time Limit Enabled')
         print 'Indefinite Time Limit: Press ctrl-c to quit at any time\n'
     else:
-        log.write('{:%Y-%m-%d %H:%M:%S} {} Minute Time Limit\n'.format(datetime.datetime.now(), timelimit))
+        log.event('injector', '{} Minute Time Limit'.format(timelimit))
         print '{} Minute Time Limit: Press ctrl-c to quit at any time\n'.format(timelimit)
 
     # writes a file that can feed into a deterministic run
@@ -1317,99 +3856,78 @@ def stateless_start(node_fault, numfaults):
     if not os.path.exists(dir_path):
         os.makedirs(dir_path)
     deterministic_filename = dir_path + str(global_starttime).replace(' ', '_') + '-run.txt'
-    deterministic_file = open(deterministic_filename, 'w')
-
-    stateless_threads = []
+    deterministic_writer = Deterministic_writer(deterministic_filename)
 
     # create thread for number of faults
+    start = clock.time()
+    threads = numfaults
     while numfaults > 0:
-        threads.append(threading.Thread(target=node_fault.stateless, args=(deterministic_file,)))
+        scheduler.spawn(node_fault.stateless, (deterministic_writer,))
         numfaults -= 1
 
-    # start all threads
-    for thread in threads:
-        thread.start()
-
     # wait for all threads to end
-    not_done = True
-    while not_done:
-        not_done = False
-        for thread in threads:
-            if thread.isAlive():
-                not_done = True
-        time.sleep(1)
+    scheduler.wait_all()
+
+    deterministic_writer.close()
 
-    deterministic_file.close()
+    # throughput of the run, waits show how often threads had no free node to fault
+    budget = node_fault.deployment.budget
+    minutes = max(clock.time() - start, 1.0) / 60
+    faults = deterministic_writer.rows
+    print '{} faults on {} threads in {:.1f} minutes ({:.1f} faults per hour), {} waits for a free node ' \
+          '({:.1f} minutes)'.format(faults, threads, minutes, faults * 60 / minutes, budget.waits, budget.waited / 60)
+    log.event('stateless-mode', '{} faults on {} threads in {:.1f} minutes ({:.1f} faults per hour), {} waits for '
+              'a free node ({:.1f} minutes)'.format(faults, threads, minutes, faults * 60 / minutes, budget.waits,
+                                                   budget.waited / 60))
+    for line in admission.summary():
+        print line
+        log.event('stateless-mode', line)
 
 
 def signal_handler(signal, frame):
     print '\n----------------\n\nExit signal received.\nPlease wait while your environment is restored.\n' \
-          'Must allow all fault threads to finish.\nThis may take some time...\n\n----------------\n'
+          'Faults in progress restore their targets first.\nThis may take some time...\n\n----------------\n'
 
-    log.write('{:%Y-%m-%d %H:%M:%S} Exit signal received\n'.format(datetime.datetime.now()))
+    log.event('injector', 'Exit signal received')
+    # the restorer reports on the same clock, so every time from here is in clock seconds
+    interrupted = clock.time()
 
+    # every wait of the faults ends right away, faults in progress restore their targets and exit
     stopper.set()
 
-    for thread in threads:
-        if thread.isAlive():
-            thread.join()
-
-    # get list of ($id ctlplane=$ip) of nodes that are off
-    node_response = []
-
-    # get nodes that are powering off
-    node_response = subprocess.check_output(
-        '. ~/stackrc && nova list | grep powering-off || true', shell=True,
-        stderr=subprocess.STDOUT).split('\n')
-    node_response = filter(None, node_response)
-
-    # wait for no node to be powering off
-    while len(node_response) > 0:
-        time.sleep(30)
-        node_response = subprocess.check_output(
-            '. ~/stackrc && nova list | grep powering-off || true', shell=True,
-            stderr=subprocess.STDOUT).split('\n')
-        node_response = filter(None, node_response)
-
-    # get powered off nodes
-    node_response.extend(
-        subprocess.check_output(". ~/stackrc && nova list | grep SHUTOFF | awk '{ print $2 $12 }' || true", shell=True,
-                                stderr=subprocess.STDOUT).split('\n'))
-    node_response = filter(None, node_response)
-
-    for node in node_response:
-
-        # break ($id ctlplane=$ip) into list
-        info = node.split('ctlplane=')
-
-        # modify playbook to boot off node
-        with open('playbooks/system-restore.yml') as f:
-            restore_config = yaml.load(f)
-            restore_config[0]['hosts'] = info[1]
-            for task in restore_config[0]['tasks']:
-                if task['name'] == 'Power on server':
-                    task['local_action'] = 'shell . ~/stackrc && nova start ' + info[0]
-                if task['name'] == 'waiting 30 secs for server to come back':
-                    task['local_action'] = 'wait_for host=' + info[1] + ' port=22 state=started delay=30 timeout=120'
-
-        with open('playbooks/system-restore.yml', 'w') as f:
-            yaml.dump(restore_config, f, default_flow_style=False)
-
-        # boot node
-        subprocess.call('ansible-playbook playbooks/system-restore.yml', stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                        shell=True)
-
-    # restart all nodes
-    subprocess.call('ansible-playbook playbooks/restart-nodes.yml', stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                    shell=True)
-
-    # clean up tmp files
-    for f in os.listdir('playbooks/'):
-        if re.search('tmp_.*', f):
-            os.remove(os.path.join('playbooks/', f))
+    # drop faults that have not started yet and wait for running ones to finish
+    scheduler.stop()
+    scheduler.wait_all()
+    log.event('injector', 'fault threads stopped {:.2f}s after the exit signal'.format(clock.time() - interrupted))
+
+    # every fault thread has finished, write out the rows still queued
+    if deterministic_writer is not None:
+        deterministic_writer.close()
+
+    # power on the nodes that are off and restart the others, all at once
+    if restorer is not None:
+        restorer.run(interrupted)
+
+    # record step timings and ssh connection counters and close the pool
+    if executor is not None:
+        for line in executor.summary():
+            log.event('executor', line)
+    for line in ssh_pool.summary():
+        log.event('ssh-pool', line)
+    if nova is not None and nova is not simulator:
+        for line in nova.summary():
+            log.event('nova', line)
+        nova.close()
+    if ceph_watcher is not None:
+        ceph_watcher.stop()
+        for line in ceph_watcher.summary():
+            log.event('ceph-watcher', line)
+    ssh_pool.close()
+    scheduler.shutdown()
+    clock.stop()
 
     print '\n+-------------------------+\n| Fault Injector Finished |\n+-------------------------+\n'
-    log.write('{:%Y-%m-%d %H:%M:%S} Fault Injector Finished\n'.format(datetime.datetime.now()))
+    log.event('injector', 'Fault Injector Finished')
     log.close()
 
     sys.exit(0)
@@ -2,11 +2,17 @@
 
 import argparse
 import json
-import paramiko
+import os
+import Queue
+import re
 import subprocess
 import sys
+import threading
+import time
 import yaml
 
+from fault_injector import Nova_client, SSH_pool, fingerprint
+
 """
 The purpose of this file is to attempt to fill the config file
 as thoroughly as possible. Note that some parameters in the config
@@ -14,58 +20,197 @@ like "HCI" may not be filled in certain cases, so the config should
 be checked before running the main program
 """
 
+
+class Discovery:
+    """ Runs discovery probes on the nodes of the deployment from a bounded pool of worker threads.
+        Every probe is one command on one host, all probes of a host share its pooled ssh connection.
+        A probe that fails or runs past its timeout is recorded as an error and the rest carry on,
+        so the time taken follows the slowest host rather than the number of hosts
+    """
+
+    def __init__(self, pool, workers=16):
+        self.pool = pool
+        self.workers = workers
+        self.probes = Queue.Queue()
+        self.lock = threading.Lock()
+        # (key, probe name) -> parsed result
+        self.results = {}
+        self.errors = []
+
+    def add(self, key, host, name, command, parse, timeout=30):
+        """ Queues command to run on host, parse(output) is stored as results[(key, name)]
+        """
+        self.probes.put((key, host, name, command, parse, timeout))
+
+    def run(self):
+        count = self.probes.qsize()
+        threads = []
+        for i in range(min(self.workers, count)):
+            thread = threading.Thread(target=self.work)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            while thread.is_alive():
+                # join with a timeout so ctrl-c still works under Python 2
+                thread.join(1)
+        return self.results
+
+    def work(self):
+        while True:
+            try:
+                key, host, name, command, parse, timeout = self.probes.get_nowait()
+            except Queue.Empty:
+                return
+            start = time.time()
+            try:
+                result = parse(self.pool.exec_command(host, command, timeout=timeout))
+            except Exception as e:
+                with self.lock:
+                    self.errors.append('{} ({}) {}: {}'.format(key, host, name, str(e) or e.__class__.__name__))
+                continue
+            with self.lock:
+                self.results[(key, name)] = result
+                print '  {} {} ({:.1f}s)'.format(host, name, time.time() - start)
+
+
+def parse_disks(output):
+    """ lsblk -d -n -b -o NAME,SIZE,ROTA,TYPE -> [{name, size_gb, rotational}] of whole disks
+    """
+    disks = []
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) == 4 and fields[3] == 'disk':
+            disks.append({'name': fields[0], 'size_gb': round(int(fields[1]) / 1024.0 ** 3, 1),
+                          'rotational': fields[2] == '1'})
+    return disks
+
+
+def parse_osd_devices(output):
+    """ mount lines of /var/lib/ceph/osd/ceph-N -> {N: device}
+    """
+    devices = {}
+    for line in output.splitlines():
+        match = re.match(r'(\S+) on /var/lib/ceph/osd/\S+-(\d+) ', line)
+        if match:
+            devices[int(match.group(2))] = match.group(1)
+    return devices
+
+
+def osd_hosts(osd_tree):
+    """ Only the hosts of ceph osd tree and their osds, which do not change while osds go up and down
+    """
+    return sorted([ceph_node['name'], sorted(ceph_node['children'])] for ceph_node in osd_tree['nodes']
+                  if ceph_node['type'] == 'host')
+
+
+def write_config(config):
+    """ Writes config.yaml through a temporary file so an interrupted run never leaves it half written
+    """
+    with open('config.yaml.tmp', 'w') as f:
+        yaml.safe_dump(config, f, default_flow_style=False)
+    os.rename('config.yaml.tmp', 'config.yaml')
+
+
+def parse_services(output):
+    """ Running units of systemctl list-units -> sorted names without the .service suffix
+    """
+    services = set()
+    for line in output.splitlines():
+        fields = line.split()
+        if fields and fields[0].endswith('.service'):
+            services.add(fields[0][:-len('.service')])
+    return sorted(services)
+
+
 # Manage arguments passed with the script
 
 parser = argparse.ArgumentParser(description='Fault Injector Setup')
 parser.add_argument('-c', '--ceph', help='setup will look for ceph fields in the deployment', required=False,
                     dest='activate_ceph', action='store_true')
+parser.add_argument('-r', '--refresh', help='only probe nodes that are new or changed since the last run, \
+                    everything else in config.yaml is kept as it is', required=False, action='store_true')
+parser.add_argument('-w', '--workers', help='number of probes run at once (default: 16)', required=False,
+                    type=int, default=16)
+parser.add_argument('-t', '--timeout', help='seconds a single probe may take (default: 30)', required=False,
+                    type=int, default=30)
+parser.add_argument('-s', '--services', help='regular expression of the running services to record on every node',
+                    required=False, default='ceph|openstack|neutron|nova|pacemaker|corosync|docker')
 parser.set_defaults(activate_ceph=False)
 args = parser.parse_args()
 
-# Open config file  
-f = open('config.yaml', 'w+')
-config = yaml.load(f)
+# Load the existing config, discovered fields are updated in place so anything added by hand is kept
+config = None
+if os.path.exists('config.yaml'):
+    with open('config.yaml') as f:
+        config = yaml.safe_load(f)
 if config is None:
     config = {}
+if not config.get('fingerprints'):
+    config['fingerprints'] = {}
+fingerprints = config['fingerprints']
 
 # General deployment fields -----------------------------------------------
 
 print "Discovering general deployment information..."
 
-config['deployment'] = {'nodes': {}, 'hci': False, 'num_nodes': 0}
+if not config.get('deployment'):
+    config['deployment'] = {}
+config['deployment'].setdefault('nodes', {})
+config['deployment'].setdefault('hci', False)
+config['deployment'].setdefault('num_nodes', 0)
+
+# Nodes that need probing
+changed_nodes = []
 
 # Discover node properties
-node_response = subprocess.check_output('. ~/stackrc && nova list | grep ctlplane || true', shell=True,
-                                        stderr=subprocess.STDOUT).split('\n')[:-1]
-if "|" not in node_response[0]:
+try:
+    discovered_nodes = Nova_client().nodes()
+except (OSError, subprocess.CalledProcessError):
+    discovered_nodes = None
+if discovered_nodes is None:
     print "'nova list' command outputted an unexpected response, skipping the collection of general deployment " \
           "information... "
 else:
-    for line in node_response:
-        node_fields = line[1:-1].split('|')
-        node_id = node_fields[0].strip()
-        node_type = node_fields[1].partition('-')[-1].rpartition('-')[0]
-        node_name = node_fields[1].partition('-')[-1].rpartition(' ')[0].strip()
-        if 'osd' in node_type:
-            config['deployment']['hci'] = True
-        node_ip = node_fields[5].partition('=')[-1].strip()
-        config['deployment']['nodes'][node_id] = {'node_type': node_type, 'node_ip': node_ip, 'node_name': node_name}
-
-    config['deployment']['num_nodes'] = len(config['deployment']['nodes'])
+    nodes = config['deployment']['nodes']
+    known = fingerprints.get('node', {})
+    removed_nodes = [node_id for node_id in nodes if node_id not in discovered_nodes]
+    for node_id in removed_nodes:
+        del nodes[node_id]
+    for node_id, fields in discovered_nodes.items():
+        if not args.refresh or node_id not in nodes or known.get(node_id) != fingerprint(fields):
+            changed_nodes.append(node_id)
+            nodes.setdefault(node_id, {}).update(fields)
+            if 'ceph' in config:
+                # osds are only assigned with -c, the injector still expects the fields
+                nodes[node_id].setdefault('num_osds', 0)
+                nodes[node_id].setdefault('osds', [])
 
-# Ceph specific fields -----------------------------------------------------
+    config['deployment']['hci'] = any('osd' in fields['node_type'] for fields in discovered_nodes.values())
+    config['deployment']['num_nodes'] = len(nodes)
+    fingerprints['node'] = dict((node_id, fingerprint(fields)) for node_id, fields in discovered_nodes.items())
+    fingerprints['nodes'] = fingerprint(discovered_nodes)
+    print "{} nodes, {} new or changed, {} removed".format(len(nodes), len(changed_nodes), len(removed_nodes))
 
-if args.activate_ceph:
-
-    print "Discovering Ceph-specific information..."
+# Queue probes -------------------------------------------------------------
 
-    config['ceph'] = {}
+# All probes below run at the same time, one pooled connection per node
+discovery = Discovery(SSH_pool(connect_timeout=args.timeout), args.workers)
+services_pattern = re.compile(args.services)
 
-    # Find deployment pools' replica sizes
-    replica_size_command = 'sudo ceph osd pool ls detail -f json'
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+for node_id in changed_nodes:
+    node = config['deployment']['nodes'][node_id]
+    discovery.add(node_id, node['node_ip'], 'disks', 'lsblk -d -n -b -o NAME,SIZE,ROTA,TYPE', parse_disks,
+                  args.timeout)
+    discovery.add(node_id, node['node_ip'], 'services',
+                  'systemctl list-units --type=service --state=running --no-legend --no-pager',
+                  lambda output: [service for service in parse_services(output) if services_pattern.search(service)],
+                  args.timeout)
+    if args.activate_ceph and ('osd' in node['node_type'] or 'ceph' in node['node_type']):
+        discovery.add(node_id, node['node_ip'], 'osd_devices', 'mount | grep /var/lib/ceph/osd/ || true',
+                      parse_osd_devices, args.timeout)
 
+if args.activate_ceph:
     # Find a controller node
     controller_ip = None
     for node_id in config['deployment']['nodes']:
@@ -74,50 +219,84 @@ if args.activate_ceph:
             break
 
     if controller_ip is None:
-        yaml.safe_dump(config, f, default_flow_style=False)
-        f.close()
+        write_config(config)
         sys.exit("No controller node found, cannot continue with Ceph setup")
 
-    ssh.connect(controller_ip, username='heat-admin')
-    ssh_stdin, ssh_stdout, ssh_stderr = ssh.exec_command(replica_size_command)
-    replica_response = ssh_stdout.read()
-    ssh_stdout.channel.close()
-    json_response = json.loads(replica_response)
-    config['ceph']['pools_and_replication_size'] = {}
-    pool_sizes = []  # List of sizes used to find the min
-    for pool in json_response:
-        config['ceph']['pools_and_replication_size'][pool['pool_name']] = pool['size']
-        pool_sizes.append(pool['size'])
-    config['ceph']['minimum_replication_size'] = min(pool_sizes)
+    # Find deployment pools' replica sizes and the osds of every node, both are always
+    # queried since their fingerprints tell whether anything changed
+    discovery.add('ceph', controller_ip, 'pools', 'sudo ceph osd pool ls detail -f json', json.loads, args.timeout)
+    discovery.add('ceph', controller_ip, 'osd_tree', 'sudo ceph osd tree -f json', json.loads, args.timeout)
 
-    # Find osd count
-    osd_count_command = 'sudo ceph osd tree -f json'
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    ssh.connect(controller_ip, username='heat-admin')
-    ssh_stdin, ssh_stdout, ssh_stderr = ssh.exec_command(osd_count_command)
-    osd_count_response = ssh_stdout.read()
-    ssh_stdout.channel.close()
-    json_response = json.loads(osd_count_response)
-
-    # Initialize osds and num_osds fields
-    for node_id in config['deployment']['nodes']:
-        config['deployment']['nodes'][node_id]['num_osds'] = 0
-        config['deployment']['nodes'][node_id]['osds'] = []
+print "Running {} probes on {} nodes ({} at a time)...".format(discovery.probes.qsize(), len(changed_nodes),
+                                                              args.workers)
+start = time.time()
+results = discovery.run()
+discovery.pool.close()
+print "Probes finished in {:.1f}s".format(time.time() - start)
+for error in discovery.errors:
+    print "  probe failed: " + error
+
+# Node facts ---------------------------------------------------------------
+
+for node_id in changed_nodes:
+    node = config['deployment']['nodes'][node_id]
+    for name in ('disks', 'services', 'osd_devices'):
+        if (node_id, name) in results:
+            node[name] = results[(node_id, name)]
+
+# Ceph specific fields -----------------------------------------------------
+
+if args.activate_ceph:
+
+    print "Discovering Ceph-specific information..."
 
-    # Count number of osds in each node and assign them appropriately
-    for ceph_node in json_response['nodes']:
-        node_name = ceph_node['name'].partition('-')[-1]
+    if ('ceph', 'pools') not in results or ('ceph', 'osd_tree') not in results:
+        # the injector can not run on a ceph section without these, so an incomplete one is never written
+        if 'minimum_replication_size' not in config.get('ceph', {}):
+            sys.exit("Could not query Ceph on {}, config.yaml was not written".format(controller_ip))
+        write_config(config)
+        sys.exit("Could not query Ceph on {}, kept the Ceph fields of the previous run".format(controller_ip))
+
+    if not config.get('ceph'):
+        config['ceph'] = {}
+
+    pools = dict((pool['pool_name'], pool['size']) for pool in results[('ceph', 'pools')])
+    if not args.refresh or fingerprint(pools) != fingerprints.get('pools') \
+            or 'minimum_replication_size' not in config['ceph']:
+        # Only the pools that were added, removed or resized change
+        pool_sizes = config['ceph'].setdefault('pools_and_replication_size', {})
+        for pool_name in pool_sizes.keys():
+            if pool_name not in pools:
+                del pool_sizes[pool_name]
+        for pool_name, size in pools.items():
+            if pool_sizes.get(pool_name) != size:
+                pool_sizes[pool_name] = size
+        config['ceph']['minimum_replication_size'] = min(pools.values())
+        fingerprints['pools'] = fingerprint(pools)
+        print "Pools updated"
+
+    # Find osd count
+    json_response = results[('ceph', 'osd_tree')]
+    if not args.refresh or changed_nodes or fingerprint(osd_hosts(json_response)) != fingerprints.get('osd_tree'):
+        # Initialize osds and num_osds fields
         for node_id in config['deployment']['nodes']:
-            if ('osd' in config['deployment']['nodes'][node_id]['node_type']) \
-                    or ('ceph' in config['deployment']['nodes'][node_id]['node_type']):
-                if node_name == config['deployment']['nodes'][node_id]['node_name']:
-                    config['deployment']['nodes'][node_id]['num_osds'] = len(ceph_node['children'])
-                    config['deployment']['nodes'][node_id]['osds'] = ceph_node['children']
+            config['deployment']['nodes'][node_id]['num_osds'] = 0
+            config['deployment']['nodes'][node_id]['osds'] = []
+
+        # Count number of osds in each node and assign them appropriately
+        for ceph_node in json_response['nodes']:
+            node_name = ceph_node['name'].partition('-')[-1]
+            for node_id in config['deployment']['nodes']:
+                if ('osd' in config['deployment']['nodes'][node_id]['node_type']) \
+                        or ('ceph' in config['deployment']['nodes'][node_id]['node_type']):
+                    if node_name == config['deployment']['nodes'][node_id]['node_name']:
+                        config['deployment']['nodes'][node_id]['num_osds'] = len(ceph_node['children'])
+                        config['deployment']['nodes'][node_id]['osds'] = ceph_node['children']
+        fingerprints['osd_tree'] = fingerprint(osd_hosts(json_response))
+        print "Osds updated"
 
 # --------------------------------------------------------------------------
 
-# Dump changes to file and close it
-yaml.safe_dump(config, f, default_flow_style=False)
-f.close()
+# Dump changes to file
+write_config(config)
 print "Completed!"